@@ -0,0 +1,305 @@
+"""
+Benchmark the whole download stage against a local HTTP server
+
+The server serves synthetic mp4/m4a files with a configurable latency, bandwidth per connection and
+failures, video2dataset downloads them with the multiprocessing distributor for each point of a grid of
+processes_count/thread_count/number_sample_per_shard. This helps choosing the distribution settings
+without downloading from the internet:
+
+    python benchmark_e2e.py --config_file e2e_config.yaml --output_file e2e_results.json
+"""
+import glob
+import json
+import os
+import random
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fire
+import numpy as np
+import pandas as pd
+import yaml
+
+from benchmark_subsamplers import create_parameter_grid, gather_system_info, generate_video
+from video2dataset import video2dataset
+from video2dataset.logger import StageStats
+
+CHUNK_SIZE = 64 * 1024
+
+
+def generate_audio(folder, duration, sample_rate=44100):
+    """Encode (once) a sine wave m4a, returns its path"""
+    path = os.path.join(folder, f"sine_{duration}s_{sample_rate}hz.m4a")
+    if os.path.exists(path):
+        return path
+    os.makedirs(folder, exist_ok=True)
+    subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-f", "lavfi"]
+        + ["-i", f"sine=frequency=440:sample_rate={sample_rate}:duration={duration}"]
+        + ["-c:a", "aac", "-b:a", "128k", "-fflags", "+bitexact", path + ".tmp.m4a"],
+        check=True,
+    )
+    os.replace(path + ".tmp.m4a", path)
+    return path
+
+
+class VideoRequestHandler(BaseHTTPRequestHandler):
+    """Serves /{i}.{ext} with the i-th file of that extension (modulo the number of files)"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def _file(self):
+        name = self.path.lstrip("/").split("?")[0]
+        index, _, ext = name.partition(".")
+        files = self.server.files.get(ext)
+        if not files or not index.isdigit():
+            return None
+        return files[int(index) % len(files)]
+
+    def _failure(self):
+        """How this url fails, if it does. Always the same for the same url so the runs are comparable"""
+        rng = random.Random(f"{self.server.seed}{self.path}")
+        if rng.random() < self.server.failure_rate:
+            return rng.choice(self.server.failure_modes)
+        return None
+
+    def _send_headers(self, data):
+        """Sends the headers for the whole file or the requested range, returns the range to send"""
+        start, end = 0, len(data)
+        range_header = self.headers.get("Range")
+        if range_header and range_header.startswith("bytes="):
+            first, _, last = range_header[len("bytes=") :].partition("-")
+            start, end = int(first), min(int(last) + 1 if last else len(data), len(data))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        return start, end
+
+    def _send_body(self, data):
+        sent, started = 0, time.perf_counter()
+        for offset in range(0, len(data), CHUNK_SIZE):
+            chunk = data[offset : offset + CHUNK_SIZE]
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            if self.server.bandwidth:
+                time.sleep(max(0.0, sent / self.server.bandwidth - (time.perf_counter() - started)))
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        time.sleep(self.server.latency)
+        data = self._file()
+        if data is None:
+            self.send_error(404)
+            return
+        self._send_headers(data)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        time.sleep(self.server.latency)
+        data = self._file()
+        failure = self._failure()
+        try:
+            if data is None:
+                self.send_error(404)
+            elif failure == "status":
+                self.send_error(503)
+            elif failure == "stall":
+                # longer than any reasonable timeout, then drop the connection
+                time.sleep(self.server.stall_time)
+                self.close_connection = True
+            else:
+                start, end = self._send_headers(data)
+                if failure == "truncate":
+                    self._send_body(data[start : start + (end - start) // 2])
+                    self.close_connection = True
+                else:
+                    self._send_body(data[start:end])
+        except ConnectionError:  # client gave up
+            self.close_connection = True
+
+
+class VideoServer(ThreadingHTTPServer):
+    """
+    Local HTTP server for the synthetic files
+
+    files: {extension: [file bytes, ...]}
+    latency: seconds before answering each request
+    bandwidth: bytes per second per connection, None for no limit
+    failure_rate: fraction of the urls that fail
+    failure_modes: how they fail, one of
+        - status: 503 response
+        - truncate: the connection is closed after half the file
+        - stall: nothing is sent for stall_time seconds
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        files,
+        latency=0.0,
+        bandwidth=None,
+        failure_rate=0.0,
+        failure_modes=("status",),
+        stall_time=120,
+        seed=0,
+    ):
+        super().__init__(("127.0.0.1", 0), VideoRequestHandler)
+        self.files = files
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.failure_modes = list(failure_modes)
+        self.stall_time = stall_time
+        self.seed = seed
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+def load_files(files_config, video_folder):
+    """Generate the synthetic files and load them for the server"""
+    files = {"mp4": [], "m4a": []}
+    for spec in files_config.get("videos", []):
+        path = generate_video(
+            video_folder, spec["width"], spec["height"], spec["fps"], spec["duration"], spec.get("scenes", 1)
+        )
+        with open(path, "rb") as f:
+            files["mp4"].append(f.read())
+    for spec in files_config.get("audios", []):
+        with open(generate_audio(video_folder, spec["duration"]), "rb") as f:
+            files["m4a"].append(f.read())
+    return files
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    return {**{f"p{p}": float(np.percentile(values, p)) for p in [50, 95, 99]}, "max": float(max(values))}
+
+
+def run_benchmark(url_list, output_folder, tmp_dir, benchmark_config, distribution):
+    """Downloads the urls of url_list with the given distribution settings, returns the metrics of the run"""
+    config = {
+        "subsampling": benchmark_config.get("subsampling") or {},
+        "reading": {"yt_args": {}, "timeout": benchmark_config.get("timeout", 60), "sampler": None},
+        "storage": {
+            "number_sample_per_shard": distribution["number_sample_per_shard"],
+            "oom_shard_count": 5,
+            "captions_are_subtitles": False,
+        },
+        "distribution": {
+            "processes_count": distribution["processes_count"],
+            "thread_count": distribution["thread_count"],
+            "subjob_size": 1000,
+            "distributor": "multiprocessing",
+        },
+    }
+
+    cpu_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    video2dataset(
+        url_list,
+        output_folder=output_folder,
+        output_format=benchmark_config.get("output_format", "webdataset"),
+        input_format="csv",
+        encode_formats=benchmark_config.get("encode_formats", {"video": "mp4"}),
+        tmp_dir=tmp_dir,
+        config=config,
+    )
+    duration = time.perf_counter() - start
+    # the worker processes are waited for by the pool, and they waited for the ffmpeg processes they started
+    cpu_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_time = cpu_end.ru_utime + cpu_end.ru_stime - cpu_start.ru_utime - cpu_start.ru_stime
+
+    shards = []
+    stage_stats = StageStats()
+    for stats_file in glob.glob(os.path.join(output_folder, "*_stats.json")):
+        with open(stats_file, "r", encoding="utf-8") as f:
+            shards.append(json.load(f))
+        if "stage_stats" in shards[-1]:
+            stage_stats.update(StageStats.load(shards[-1]["stage_stats"]))
+    count = sum(s["count"] for s in shards)
+    successes = sum(s["successes"] for s in shards)
+    bytes_downloaded = sum(s["bytes_downloaded"] for s in shards)
+    return {
+        "time": duration,
+        "count": count,
+        "successes": successes,
+        "success_rate": successes / count if count else 0.0,
+        "videos_per_s": successes / duration,
+        "samples_per_s": count / duration,
+        "bytes_per_s": bytes_downloaded / duration,
+        # of the cores the run could use
+        "cpu_utilization": cpu_time / (duration * len(os.sched_getaffinity(0))),
+        "shard_latency": percentiles([s["duration"] for s in shards]),
+        "stages": {
+            stage: {k: stats[k] for k in ["count", "p50", "p95", "p99", "max"]}
+            for stage, stats in stage_stats.summary().items()
+        },
+    }
+
+
+def main(config_file="e2e_config.yaml", output_file="e2e_results.json", video_folder="videos"):
+    """
+    config_file: yaml with the files to serve, the server behaviour, the samples to download and the grid of
+        distribution settings to try
+    output_file: where to write the results
+    video_folder: where the generated files are cached
+    """
+    with open(config_file, "r", encoding="utf-8") as f:
+        benchmark_config = yaml.safe_load(f)
+    files = load_files(benchmark_config["files"], video_folder)
+    server_config = benchmark_config.get("server") or {}
+
+    results = []
+    with VideoServer(files, **server_config) as server, tempfile.TemporaryDirectory() as work_dir:
+        # the same urls for every run, m4a_fraction of them audio files
+        rng = random.Random(0)
+        samples = benchmark_config["samples"]
+        m4a_fraction = benchmark_config.get("m4a_fraction", 0.0) if files["m4a"] else 0.0
+        urls = [f"{server.url}/{i}.{'m4a' if rng.random() < m4a_fraction else 'mp4'}" for i in range(samples)]
+        url_list = os.path.join(work_dir, "urls.csv")
+        pd.DataFrame({"url": urls}).to_csv(url_list, index=False)
+
+        for i, distribution in enumerate(create_parameter_grid(benchmark_config["grid"])):
+            output_folder = os.path.join(work_dir, f"output_{i}")
+            tmp_dir = os.path.join(work_dir, f"tmp_{i}")
+            os.makedirs(tmp_dir)
+            metrics = run_benchmark(url_list, output_folder, tmp_dir, benchmark_config, distribution)
+            print(
+                f"{distribution}: {metrics['videos_per_s']:.2f} videos/s - {metrics['bytes_per_s'] / 1e6:.1f} MB/s"
+                f" - cpu {metrics['cpu_utilization']:.0%} - shard p95 {metrics['shard_latency'].get('p95', 0):.1f}s"
+            )
+            results.append({"config": distribution, "metrics": metrics})
+
+    data = {
+        "system_info": gather_system_info(),
+        "benchmark_config": benchmark_config,
+        "results": results,
+    }
+    with open(output_file, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=4)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -1,48 +1,88 @@
+"""
+Benchmark subsampler speed on synthetic videos
+
+Videos are generated locally with ffmpeg test sources so runs are reproducible and need no network. Each
+subsampler config runs in its own process pinned to a fixed number of cores, the results are written as JSON
+that can be compared with the results of another commit to catch regressions:
+
+    python benchmark_subsamplers.py --output_file new.json --baseline old.json
+"""
+import json
 import os
+import platform
+import resource
+import subprocess
 import sys
-import cv2
+import threading
 import time
-import tempfile
 import itertools
-import platform
-import psutil
-import json
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from multiprocessing.pool import ThreadPool
+
+import fire
 import yaml
-from omegaconf import OmegaConf
-from webdataset import WebLoader
 
-from video2dataset import subsamplers
-from video2dataset.dataloader import get_video_dataset
+# ffmpeg sources that look different enough from each other for every scene change to be a cut
+SCENE_SOURCES = ["testsrc", "testsrc2", "smptebars", "rgbtestsrc", "yuvtestsrc"]
+# subsamplers that run after the broadcasting subsampler and get the list of the clips metadata
+MODAL_SUBSAMPLERS = ["ResolutionSubsampler", "FrameSubsampler", "AudioRateSubsampler"]
+# metrics where higher is better, compared with the baseline
+THROUGHPUT_METRICS = ["samples_per_s_per_core", "frames_per_s_per_core", "mb_per_s_per_core"]
 
 
-# Add this function to gather system information
 def gather_system_info():
-    cpu_count = os.cpu_count()
-    cpu_info = platform.processor()
-    gpu_info = [None]
+    """Describe the machine and the code the benchmark runs on"""
 
-    # TODO: how do you get GPU info on non linux
-    if platform.system() == "Linux":
+    def run(args):
         try:
-            gpu_info = os.popen("nvidia-smi --query-gpu=gpu_name --format=csv,noheader").read().splitlines()
-            gpu_count = len(gpu_info)
-        except KeyError:
-            pass
+            return subprocess.run(args, capture_output=True, text=True, check=True).stdout.splitlines()[0]
+        except (OSError, subprocess.CalledProcessError, IndexError):
+            return None
 
     return {
         "platform": platform.system(),
-        "cpu_count": cpu_count,
-        "cpu_info": cpu_info,
-        "gpu_info": gpu_info[0],
-        "gpu_count": len(gpu_info),
+        "cpu_count": os.cpu_count(),
+        "cpu_info": platform.processor(),
+        "python": platform.python_version(),
+        "ffmpeg": run(["ffmpeg", "-version"]),
+        "commit": run(["git", "rev-parse", "HEAD"]),
     }
 
 
-# Add this function to load and parse the config file
-def load_config(filepath):
-    with open(filepath, "r") as f:
-        config = yaml.safe_load(f)
-    return OmegaConf.create(config)
+def generate_video(folder, width, height, fps, duration, scenes):
+    """Encode (once) a video made of scenes from different ffmpeg test sources, returns its path"""
+    path = os.path.join(folder, f"testsrc_{width}x{height}_{fps}fps_{duration}s_{scenes}scenes.mp4")
+    if os.path.exists(path):
+        return path
+
+    scene_duration = duration / scenes
+    inputs = []
+    for i in range(scenes):
+        source = SCENE_SOURCES[i % len(SCENE_SOURCES)]
+        inputs += ["-f", "lavfi", "-i", f"{source}=size={width}x{height}:rate={fps}:duration={scene_duration}"]
+    concat = "".join(f"[{i}:v]" for i in range(scenes)) + f"concat=n={scenes}:v=1:a=0[v]"
+    os.makedirs(folder, exist_ok=True)
+    # single threaded bitexact encoding so the same config always gives the same file
+    subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", *inputs, "-filter_complex", concat, "-map", "[v]"]
+        + ["-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p", "-g", str(2 * fps), "-threads", "1"]
+        + ["-fflags", "+bitexact", "-flags:v", "+bitexact", path + ".tmp.mp4"],
+        check=True,
+    )
+    os.replace(path + ".tmp.mp4", path)
+    return path
+
+
+def generate_video_set(video_set, folder):
+    """List of (path, frame count, duration) of the videos of the set"""
+    videos = []
+    for spec in video_set:
+        path = generate_video(
+            folder, spec["width"], spec["height"], spec["fps"], spec["duration"], spec.get("scenes", 1)
+        )
+        videos += [(path, spec["fps"] * spec["duration"], spec["duration"])] * spec.get("count", 1)
+    return videos
 
 
 def create_parameter_grid(params):
@@ -51,104 +91,189 @@ def create_parameter_grid(params):
     return [dict(zip(keys, combination)) for combination in combinations]
 
 
-def make_fake_clips(time, n):
-    clip_duration = time / n
+def make_fake_clips(duration, n):
+    clip_duration = duration / n
     return [(i * clip_duration, (i + 1) * clip_duration) for i in range(n)]
 
 
-def main(config_file="subsamplers_config.yaml"):
-    # Gather system information
-    system_info = gather_system_info()
+def rss(pid):
+    """Resident memory in bytes of the process and its children (read from /proc)"""
+    try:
+        with open(f"/proc/{pid}/statm", "r", encoding="utf-8") as f:
+            total = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children", "r", encoding="utf-8") as f:
+                total += sum(rss(int(child)) for child in f.read().split())
+    except (FileNotFoundError, ProcessLookupError):  # exited while reading
+        return 0
+    return total
 
-    # Load config
-    benchmark_config = load_config(config_file)
 
-    # Dataloader
-    ds = get_video_dataset(
-        urls=benchmark_config.video_set[0].path,
-        batch_size=1,
-        decoder_kwargs={},  # load bytes
-    )
-    ds = WebLoader(ds, batch_size=None, num_workers=12)
-
-    # Initialize all configs
-    benchmarks = {}
-    for subsampler_config in benchmark_config.subsamplers:
-        subsampler_name = subsampler_config.name
-        params_grid = create_parameter_grid(OmegaConf.to_container(subsampler_config.parameters, resolve=True)[0])
-        benchmarks[subsampler_name] = [
-            {
-                "subsampler": getattr(subsamplers, subsampler_name)(**cfg),
-                "config": cfg,
-                "metrics": {"time": 0.0},
-            }
-            for cfg in params_grid
-        ]
-
-    for subsampler, bm_cfgs in benchmarks.items():
-        print(f"Benchmarking {subsampler}...")
-        size_metrics = {
-            "samples": 0,
-            "frames": 0,
-            "bytes": 0.0,
+class PeakMemory:
+    """Samples the memory of this process and the ffmpeg processes it starts to find the peak"""
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, rss(os.getpid()))
+
+    def __enter__(self):
+        self.peak = rss(os.getpid())
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+def run_benchmark(name, config, videos, cores, clips_per_video, repeats):
+    """
+    Runs in a new process: pins itself to cores, runs the subsampler on every video repeats times and
+    returns the metrics of the median run
+    """
+    from video2dataset import subsamplers  # pylint: disable=import-outside-toplevel
+
+    # ffmpeg processes started by the subsampler inherit the affinity
+    os.sched_setaffinity(0, sorted(os.sched_getaffinity(0))[:cores])
+    cores = len(os.sched_getaffinity(0))
+    subsampler = getattr(subsamplers, name)(**config)
+
+    video_bytes, keyframes = {}, {}
+    for path, _, _ in videos:
+        if path not in video_bytes:
+            with open(path, "rb") as f:
+                video_bytes[path] = f.read()
+            # for the keyframe_adjusted clipping, like the FFProbeSubsampler running before it in the workers
+            _, meta, _ = subsamplers.FFProbeSubsampler(extract_keyframes=True)({"video": [video_bytes[path]]}, {})
+            keyframes[path] = meta["video_metadata"]["keyframe_timestamps"]
+
+    def process(video):
+        path, _, duration = video
+        meta = {
+            "key": "0",
+            "clips": make_fake_clips(duration, clips_per_video),
+            "video_metadata": {"keyframe_timestamps": list(keyframes[path])},
         }
-        for sample in ds:
-            # TODO: parallelize this in a safe way i.e. each benchmarker gets certain amount of cores (no interference)
-            # TODO: report per-core metrics
-            # Update size metrics:
-            with tempfile.NamedTemporaryFile(delete=True, suffix=".mp4") as temp_vid:
-                temp_vid.write(sample["mp4"])
-                vid = cv2.VideoCapture(temp_vid.name)
-                size_metrics["samples"] += 1
-                size_metrics["bytes"] += len(sample["mp4"])
-                size_metrics["frames"] += int(vid.get(cv2.CAP_PROP_FRAME_COUNT))
-                seconds = int(vid.get(cv2.CAP_PROP_FRAME_COUNT)) / int(vid.get(cv2.CAP_PROP_FPS))
-
-            # TODO: construct streams based on subsampler (maybe we want audio or sth
-            streams = {"video": [sample["mp4"]]}
-            metadata = {
-                "key": sample["__key__"],
-                "clips": make_fake_clips(seconds, 5),  # TODO: parameterize this, dense/sparse
-            }
-
-            for cfg in bm_cfgs:
-                t0 = time.time()
-                strm, md, err_msg = cfg["subsampler"](streams, metadata)
-                tf = time.time()
-
-                if err_msg is not None:
-                    print(err_msg)
-
-                cfg["metrics"]["time"] += tf - t0
-
-                metadata["clips"] = make_fake_clips(seconds, 5)  # gets popped
-
-        # TODO: Normalize metrics for core count
-        # Update and normalize cfg metrics
-        for cfg in bm_cfgs:
-            for m in size_metrics:
-                cfg["metrics"][m + "/s"] = size_metrics[m] / cfg["metrics"]["time"]
-
-    # TODO: visualize in nice way - visual repr but also raw numbers in some json or something
-    # For now just output JSON
-    data = {
-        "system_info": system_info,
-        "dataset_info": size_metrics,
-        "subsamplers": {},
+        streams = {"video": [video_bytes[path]]}
+        _, _, error_message = subsampler(streams, [meta] if name in MODAL_SUBSAMPLERS else meta)
+        return error_message
+
+    process(videos[0])  # warm up
+    cpu_start = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    durations = []
+    with ThreadPool(cores) as pool, PeakMemory() as peak_memory:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            errors = [e for e in pool.imap_unordered(process, videos) if e is not None]
+            durations.append(time.perf_counter() - start)
+    duration = sorted(durations)[len(durations) // 2]
+    cpu_end = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_time = sum(end.ru_utime + end.ru_stime - (s.ru_utime + s.ru_stime) for s, end in zip(cpu_start, cpu_end))
+
+    samples = len(videos)
+    frames = sum(n_frames for _, n_frames, _ in videos)
+    megabytes = sum(len(video_bytes[path]) for path, _, _ in videos) / 1e6
+    return {
+        "cores": cores,
+        "time": duration,
+        "cpu_time": cpu_time / repeats,
+        "errors": len(errors),
+        "samples_per_s": samples / duration,
+        "frames_per_s": frames / duration,
+        "mb_per_s": megabytes / duration,
+        "samples_per_s_per_core": samples / duration / cores,
+        "frames_per_s_per_core": frames / duration / cores,
+        "mb_per_s_per_core": megabytes / duration / cores,
+        # of the benchmark process and the ffmpeg processes together
+        "peak_rss_mb": peak_memory.peak / 1e6,
     }
 
-    for ss, bm_cfgs in benchmarks.items():
-        cfg_metrics = [{"config": bm["config"], "metrics": bm["metrics"]} for bm in bm_cfgs]
-        data["subsamplers"][ss] = sorted(cfg_metrics, key=lambda cfg: cfg["metrics"]["time"])
 
-    with open("subsampler_results.json", "w") as f:
+def benchmark_id(result):
+    return f"{result['name']}({json.dumps(result['config'], sort_keys=True)})"
+
+
+def compare(baseline, results, tolerance):
+    """Print the throughput of results relative to baseline, returns the ids of the benchmarks that regressed"""
+    baseline_results = {benchmark_id(r): r for r in baseline["results"]}
+    regressions = []
+    for result in results["results"]:
+        bm_id = benchmark_id(result)
+        if bm_id not in baseline_results:
+            print(f"{bm_id}: not in baseline")
+            continue
+        ratios = {
+            m: result["metrics"][m] / baseline_results[bm_id]["metrics"][m]
+            for m in THROUGHPUT_METRICS
+            if baseline_results[bm_id]["metrics"][m]
+        }
+        regressed = any(ratio < 1 - tolerance for ratio in ratios.values())
+        if regressed:
+            regressions.append(bm_id)
+        print(" - ".join([bm_id] + [f"{m}: {ratio:.2f}x" for m, ratio in ratios.items()] + ["REGRESSION"] * regressed))
+    return regressions
+
+
+def main(
+    config_file="subsampler_config.yaml",
+    output_file="subsampler_results_new.json",
+    video_folder="videos",
+    cores=None,
+    baseline=None,
+    tolerance=0.1,
+):
+    """
+    config_file: yaml with the video set to generate and the parameter grid of each subsampler
+    output_file: where to write the results, not subsampler_results.json which holds the historical results
+    video_folder: where the generated videos are cached
+    cores: number of cores each subsampler config gets (default: cores in the config file, else 1)
+    baseline: results of an earlier run to compare to, exits with an error if a throughput regressed
+    tolerance: relative throughput drop considered a regression
+    """
+    with open(config_file, "r", encoding="utf-8") as f:
+        benchmark_config = yaml.safe_load(f)
+    cores = cores or benchmark_config.get("cores", 1)
+    videos = generate_video_set(benchmark_config["video_set"], video_folder)
+
+    results = []
+    for subsampler_config in benchmark_config["subsamplers"]:
+        name = subsampler_config["name"]
+        for config in create_parameter_grid(subsampler_config["parameters"]):
+            # a new process for each config so peak memory and cpu affinity don't leak between them
+            with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+                metrics = executor.submit(
+                    run_benchmark,
+                    name,
+                    config,
+                    videos,
+                    cores,
+                    benchmark_config.get("clips_per_video", 5),
+                    benchmark_config.get("repeats", 3),
+                ).result()
+            result = {"name": name, "config": config, "metrics": metrics}
+            print(f"{benchmark_id(result)}: {metrics['samples_per_s_per_core']:.3f} samples/s/core")
+            results.append(result)
+
+    data = {
+        "system_info": gather_system_info(),
+        "video_set": benchmark_config["video_set"],
+        "results": results,
+    }
+    with open(output_file, "w", encoding="utf-8") as f:
         json.dump(data, f, indent=4)
 
+    if baseline is not None:
+        with open(baseline, "r", encoding="utf-8") as f:
+            regressions = compare(json.load(f), data, tolerance)
+        if regressions:
+            sys.exit(f"{len(regressions)} benchmarks regressed by more than {tolerance:.0%}")
+
 
 if __name__ == "__main__":
-    if len(sys.argv) == 2:
-        main(sys.argv[1])
-    elif len(sys.argv) == 1:
-        main()
-    else:
-        print("Usage: python yourscript.py [config_file]")
+    fire.Fire(main)
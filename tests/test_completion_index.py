@@ -0,0 +1,47 @@
+"""test the completion index"""
+import os
+
+import pytest
+
+from video2dataset.completion_index import CompletionIndex, record_done_shard
+from video2dataset.logger import CappedCounter, write_stats
+
+
+def test_completion_index(tmp_path):
+    index = CompletionIndex(str(tmp_path))
+    assert not index.exists()
+    record_done_shard(str(tmp_path), 3)  # no index yet, nothing is recorded
+
+    index.create({0, 1})
+    assert index.done_shards() == {0, 1}
+
+    for shard_id in [7, 2]:
+        index.add(shard_id)
+    assert index.done_shards() == {0, 1, 2, 7}
+    shard_ids, offset = index.read_journal()
+    assert shard_ids == [7, 2]
+    assert index.read_journal(offset) == ([], offset)
+
+    index.compact()
+    bitmap_size = os.path.getsize(tmp_path / "_index" / "bitmap")
+    record_done_shard(str(tmp_path), 12)
+    assert index.done_shards() == {0, 1, 2, 7, 12}
+    assert index.read_journal(offset) == ([12], offset + 4)
+
+    index.compact()
+    assert index.done_shards() == {0, 1, 2, 7, 12}
+    assert os.path.getsize(tmp_path / "_index" / "bitmap") == bitmap_size + 1
+
+
+def test_write_stats_records_shards(tmp_path):
+    index = CompletionIndex(str(tmp_path))
+    index.create()
+    for shard_id in [5, "00006", "00007_00001"]:
+        write_stats(str(tmp_path), shard_id, 1, 1, 0, 0, 10, 0.0, 1.0, CappedCounter(), 5)
+    # parts of shards aren't done shards
+    assert index.done_shards() == {5, 6}
+
+
+def test_completion_index_needs_posix_fs():
+    with pytest.raises(ValueError):
+        CompletionIndex("memory://output")
@@ -9,8 +9,9 @@ import ffmpeg
 from video2dataset.data_reader import VideoDataReader
 
 
+@pytest.mark.parametrize("extract_once", [False, True])
 @pytest.mark.parametrize("input_file", ["test_yt.csv"])
-def test_data_reader(input_file):
+def test_data_reader(input_file, extract_once):
     encode_formats = {"video": "mp4", "audio": "mp3"}
     current_folder = os.path.dirname(__file__)
     url_list = pd.read_csv(os.path.join(current_folder, f"test_files/{input_file}"))["contentUrl"]
@@ -19,6 +20,7 @@ def test_data_reader(input_file):
         "yt_args": {
             "download_size": 360,
             "download_audio_rate": 12000,
+            "extract_once": extract_once,
         },
         "timeout": 60,
         "sampler": None,
@@ -5,6 +5,7 @@ from video2dataset.data_writer import (
     DummySampleWriter,
     TFRecordSampleWriter,
 )
+from video2dataset.v2d_types import FileStream
 
 import os
 import glob
@@ -14,9 +15,10 @@ import pandas as pd
 import pyarrow as pa
 
 
+@pytest.mark.parametrize("stream_files", [False, True])
 @pytest.mark.parametrize("modalities", [["video", "audio"], ["video"], ["audio"]])
 @pytest.mark.parametrize("writer_type", ["files", "webdataset", "parquet", "dummy", "tfrecord"])
-def test_writer(modalities, writer_type, tmp_path):
+def test_writer(modalities, writer_type, stream_files, tmp_path):
     current_folder = os.path.dirname(__file__)
     test_folder = str(tmp_path)
     output_folder = test_folder + "/" + "test_write"
@@ -48,7 +50,11 @@ def test_writer(modalities, writer_type, tmp_path):
     encode_formats = {}
     for mod in modalities:
         encode_formats[mod] = "mp4" if mod == "video" else "mp3"
-        with open(os.path.join(current_folder, f"test_files/test_{mod}.{encode_formats[mod]}"), "rb") as f:
+        path = os.path.join(current_folder, f"test_files/test_{mod}.{encode_formats[mod]}")
+        if stream_files:
+            streams[mod] = FileStream(path)
+            continue
+        with open(path, "rb") as f:
             streams[mod] = f.read()
 
     n_samples = 1
@@ -108,7 +114,11 @@ def test_writer(modalities, writer_type, tmp_path):
         assert len(l) == 1
         if l[0] != output_folder + "/00000.tar":
             raise Exception(l[0] + " is not 00000.tar")
-        assert len(tarfile.open(output_folder + "/00000.tar").getnames()) == n_files
+        with tarfile.open(output_folder + "/00000.tar") as tar:
+            assert len(tar.getnames()) == n_files
+            for mod, fmt in encode_formats.items():
+                with open(os.path.join(current_folder, f"test_files/test_{mod}.{fmt}"), "rb") as f:
+                    assert tar.extractfile(f"0.{fmt}").read() == f.read()
     elif writer_type == "parquet":
         l = glob.glob(output_folder + "/*.parquet")
         assert len(l) == 1
@@ -0,0 +1,105 @@
+"""test video2dataset distributors"""
+import os
+import time
+import types
+
+from video2dataset.distributor import SlurmShardClaimer, retrier, shard_finished
+
+
+def _claimer(task_id, tmp_path, **kwargs):
+    return SlurmShardClaimer(
+        global_task_id=task_id,
+        num_tasks=2,
+        claims_path=str(tmp_path / "claims"),
+        output_folder=str(tmp_path),
+        oom_shard_count=5,
+        claim_batch_size=2,
+        **kwargs,
+    )
+
+
+def _mark_done(tmp_path, full_shard_id):
+    with open(tmp_path / f"{full_shard_id:05d}_stats.json", "w") as f:
+        f.write("{}")
+
+
+def test_slurm_shard_claimer(tmp_path):
+    shards = [(i, i) for i in range(10)]
+    claimers = [_claimer(i, tmp_path, max_claimed=100) for i in range(2)]
+    claims = [claimer(shards) for claimer in claimers]
+
+    # tasks start at different offsets and claim in batches
+    assert [next(claims[0]), next(claims[0])] == [(0, 0), (1, 1)]
+    assert [next(claims[1]), next(claims[1])] == [(5, 5), (6, 6)]
+
+    # the slow task only gets what the other one didn't claim
+    claimed_by_0 = [(0, 0), (1, 1)] + list(claims[0])
+    claimed_by_1 = [(5, 5), (6, 6)] + list(claims[1])
+    assert claimed_by_1 == [(5, 5), (6, 6)]
+    assert sorted(claimed_by_0 + claimed_by_1) == shards
+
+
+def test_slurm_shard_claimer_backpressure(tmp_path):
+    claims = _claimer(0, tmp_path, max_claimed=2)([(i, i) for i in range(4)])
+    assert [next(claims), next(claims)] == [(0, 0), (1, 1)]
+    _mark_done(tmp_path, 0)
+    _mark_done(tmp_path, 1)
+    # claims the next batch once the first one is done
+    assert list(claims) == [(2, 2), (3, 3)]
+
+
+def test_slurm_shard_claimer_reclaims_expired_leases(tmp_path):
+    shards = [(i, i) for i in range(4)]
+    assert list(_claimer(0, tmp_path, max_claimed=100)(shards)) == shards
+    _mark_done(tmp_path, 0)
+
+    expired = time.time() - 3600
+    for full_shard_id in [0, 1]:
+        os.utime(tmp_path / "claims" / f"{full_shard_id}.lease", (expired, expired))
+
+    # shard 1 was claimed by a task that died, shard 0 is done and the other leases are still alive
+    assert list(_claimer(1, tmp_path, max_claimed=100, lease_timeout=1800)(shards)) == [(1, 1)]
+
+
+def test_slurm_shard_claimer_failed_shards(tmp_path):
+    claimer = _claimer(0, tmp_path, max_claimed=2, lease_timeout=1800)
+    claims = claimer([(i, i) for i in range(4)])
+    assert [next(claims), next(claims)] == [(0, 0), (1, 1)]
+    # the workers of both shards failed, they don't hold room anymore and their leases are released
+    claimer.shard_finished(0, False)
+    claimer.shard_finished(1, False)
+    assert not claimer.claimed
+    assert list(claims) == [(2, 2), (3, 3)]
+    assert not os.path.exists(tmp_path / "claims" / "0.lease")
+
+    # another task takes shard 0 over, the task that failed it only retries shard 1
+    assert list(_claimer(1, tmp_path, max_claimed=100)([(i, i) for i in range(1)])) == [(0, 0)]
+    assert not claimer.claim_retry(0)
+    assert claimer.claim_retry(1)
+    assert 1 in claimer.claimed
+
+
+def test_retrier_claims_failed_shards(tmp_path):
+    claimer = _claimer(0, tmp_path, max_claimed=100)
+    input_sharder = types.SimpleNamespace(shard_sampler=claimer)
+    runs = []
+
+    def run(rows):
+        runs.append(rows)
+        for row in rows:
+            shard_finished(input_sharder, row, False)
+        return rows
+
+    rows = [("shard0.feather", full_shard_id) for full_shard_id, _ in claimer([(0, 0), (1, 1)])]
+    for row in rows:
+        shard_finished(input_sharder, row, False)
+    list(_claimer(1, tmp_path)([(1, 1)]))  # another task took shard 1 over while it was released
+    retrier(run, rows, 2, input_sharder)
+    assert runs == [[rows[0]], [rows[0]]]
+
+
+def test_slurm_shard_claimer_bounded_wait(tmp_path):
+    # the workers of the claimed shards never return, the task claims more shards after lease_timeout
+    claims = _claimer(0, tmp_path, max_claimed=2, lease_timeout=0.1)([(i, i) for i in range(4)])
+    assert [next(claims), next(claims)] == [(0, 0), (1, 1)]
+    assert list(claims) == [(2, 2), (3, 3)]
@@ -0,0 +1,120 @@
+"""test the download cache"""
+import functools
+import http.server
+import os
+import threading
+import time
+
+import pytest
+
+from video2dataset.data_reader import VideoDataReader
+from video2dataset.download_cache import DownloadCache, normalize_url
+
+
+@pytest.mark.parametrize(
+    "url,normalized",
+    [
+        ("https://www.youtube.com/watch?v=jLX0D8qQUBM&t=10", "youtube:jLX0D8qQUBM"),
+        ("https://youtu.be/jLX0D8qQUBM", "youtube:jLX0D8qQUBM"),
+        ("https://youtube.com/shorts/jLX0D8qQUBM", "youtube:jLX0D8qQUBM"),
+        ("HTTP://Host.com/video.mp4#start", "http://host.com/video.mp4"),
+        ("http://host.com/video.mp4?token=1", "http://host.com/video.mp4?token=1"),
+    ],
+)
+def test_normalize_url(url, normalized):
+    assert normalize_url(url) == normalized
+
+
+def write_file(path, size):
+    with open(path, "wb") as f:
+        f.write(os.urandom(size))
+    return str(path)
+
+
+def test_cache_get_put(tmp_path):
+    cache = DownloadCache(str(tmp_path / "cache"))
+    args = {"encode_formats": {"video": "mp4"}}
+    video = write_file(tmp_path / "video.mp4", 100)
+    assert cache.get("https://youtu.be/abc", args, str(tmp_path)) is None
+
+    cache.put("https://youtu.be/abc", args, {"video": video}, {"title": "abc"})
+    modality_paths, meta_dict = cache.get("https://www.youtube.com/watch?v=abc", args, str(tmp_path))
+    assert meta_dict == {"title": "abc"}
+    assert modality_paths["video"].endswith(".mp4") and modality_paths["video"] != video
+    with open(modality_paths["video"], "rb") as f, open(video, "rb") as g:
+        assert f.read() == g.read()
+    # other arguments are another download
+    assert cache.get("https://youtu.be/abc", {"encode_formats": {"video": "webm"}}, str(tmp_path)) is None
+
+
+def test_cache_put_existing(tmp_path):
+    cache = DownloadCache(str(tmp_path / "cache"))
+    cache.put("http://host/a.mp4", {}, {"video": write_file(tmp_path / "a.mp4", 100)}, {"n": 1})
+    modality_paths, _ = cache.get("http://host/a.mp4", {}, str(tmp_path))
+    with open(modality_paths["video"], "rb") as f:
+        read = f.read()
+
+    # the entry is kept as is, the files already read (maybe hard links) don't change under the reader
+    cache.put("http://host/a.mp4", {}, {"video": write_file(tmp_path / "b.mp4", 100)}, {"n": 2})
+    with open(modality_paths["video"], "rb") as f:
+        assert f.read() == read
+    assert cache.get("http://host/a.mp4", {}, str(tmp_path))[1] == {"n": 1}
+    # the entry written meanwhile by another worker wins and the temporary one is dropped
+    entry = cache.entry_path("http://host/c.mp4", {})
+    cache.put("http://host/c.mp4", {}, {"video": write_file(tmp_path / "c.mp4", 100)}, {"n": 1})
+    os.remove(f"{entry}/meta.json")
+    cache.put("http://host/c.mp4", {}, {"video": write_file(tmp_path / "c.mp4", 100)}, {"n": 2})
+    assert sorted(os.listdir(os.path.dirname(entry))) == [os.path.basename(entry)]
+
+
+def test_cache_eviction(tmp_path):
+    cache = DownloadCache(str(tmp_path / "cache"), max_size=400)  # two entries (video, meta.json and last_used)
+    for i in range(2):
+        cache.put(f"http://host/{i}.mp4", {}, {"video": write_file(tmp_path / f"{i}.mp4", 100)}, None)
+        time.sleep(0.01)
+    assert cache.get("http://host/0.mp4", {}, str(tmp_path)) is not None  # 0 is now used more recently than 1
+    cache.put("http://host/2.mp4", {}, {"video": write_file(tmp_path / "2.mp4", 100)}, None)
+    assert cache.get("http://host/1.mp4", {}, str(tmp_path)) is None
+    assert cache.get("http://host/0.mp4", {}, str(tmp_path)) is not None
+    assert cache.get("http://host/2.mp4", {}, str(tmp_path)) is not None
+
+
+def test_data_reader_cache(tmp_path):
+    requests = []
+
+    class RequestHandler(http.server.SimpleHTTPRequestHandler):
+        def do_GET(self):  # pylint: disable=invalid-name
+            requests.append(self.path)
+            super().do_GET()
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    test_files = os.path.join(os.path.dirname(__file__), "test_files")
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(RequestHandler, directory=test_files))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/test_video.mp4"
+
+    reading_config = {"yt_args": {}, "timeout": 10, "cache_args": {"cache_dir": str(tmp_path / "cache")}}
+    # the second reader stands for another run
+    for i in range(2):
+        reader = VideoDataReader({"video": "mp4"}, str(tmp_path), reading_config)
+        _, streams, _, error_message, cache_hit = reader.read((i, url))
+        assert error_message is None
+        assert len(streams["video"]) == os.path.getsize(os.path.join(test_files, "test_video.mp4"))
+        assert cache_hit == (i == 1)
+    server.shutdown()
+    assert requests == ["/test_video.mp4"]
+
+
+def test_data_reader_cache_partial(tmp_path):
+    reading_config = {"yt_args": {}, "timeout": 10, "cache_args": {"cache_dir": str(tmp_path / "cache")}}
+    reader = VideoDataReader({"video": "mp4", "audio": "m4a"}, str(tmp_path), reading_config)
+    url = "https://youtu.be/abc"
+    # yt-dlp returns the modalities it managed to download without an error
+    reader.write_cache(url, {"video": write_file(tmp_path / "video.mp4", 100)}, {}, None)
+    assert reader.read_cache(url) is None
+    reader.write_cache(
+        url, {"video": str(tmp_path / "video.mp4"), "audio": write_file(tmp_path / "audio.m4a", 100)}, {}, None
+    )
+    assert set(reader.read_cache(url)[0]) == {"video", "audio"}
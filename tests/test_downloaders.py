@@ -1,10 +1,17 @@
 """test video2dataset downloaders"""
+import http.server
 import os
+import pickle
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlparse
 import pytest
 import ffmpeg
 
 
-from video2dataset.data_reader import YtDlpDownloader, WebFileDownloader
+from video2dataset.async_data_reader import AsyncDownloadPool
+from video2dataset.data_reader import VideoDataReader, YoutubeDLPool, YtDlpDownloader, WebFileDownloader
 
 
 YT_URL = "https://www.youtube.com/watch?v=jLX0D8qQUBM"
@@ -51,3 +58,136 @@ def test_webfile_downloader():
     with open(modality_paths["video"], "rb") as f:
         assert len(f.read()) > 0
     os.remove(modality_paths["video"])
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves tests/test_files with support for single byte range requests"""
+
+    methods: Counter = Counter()
+
+    def _send_file(self, send_body):
+        self.methods[self.command] += 1
+        path = os.path.join(os.path.dirname(__file__), "test_files", os.path.basename(urlparse(self.path).path))
+        with open(path, "rb") as f:
+            data = f.read()
+        start, end = 0, len(data) - 1
+        if "Range" in self.headers:
+            start, end = [int(x) for x in self.headers["Range"].replace("bytes=", "").split("-")]
+            end = min(end, len(data) - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(data[start : end + 1])
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        self._send_file(False)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self._send_file(True)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+@pytest.mark.parametrize("range_chunk_size", [None, 1 << 20])
+def test_async_download_pool(range_chunk_size, tmp_path):
+    pytest.importorskip("aiohttp")
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/test_video.mp4"
+
+    encode_formats = {"video": "mp4"}
+    reading_config = {"timeout": 10, "yt_args": {}, "async_args": {"range_chunk_size": range_chunk_size}}
+    data_reader = VideoDataReader(encode_formats, str(tmp_path), reading_config)
+    RangeRequestHandler.methods.clear()
+    with AsyncDownloadPool(2, str(tmp_path), encode_formats, reading_config) as pool:
+        results = list(pool.imap_unordered(data_reader, [(i, url) for i in range(4)]))
+    server.shutdown()
+    # the size of the file comes from the first range, 4 ranges of 1MiB per file
+    assert RangeRequestHandler.methods == {"GET": 4 if range_chunk_size is None else 16}
+
+    with open(os.path.join(os.path.dirname(__file__), "test_files/test_video.mp4"), "rb") as f:
+        video_bytes = f.read()
+    assert sorted(key for key, _, _, _, _ in results) == [0, 1, 2, 3]
+    for _, streams, _, error_message, _ in results:
+        assert error_message is None
+        assert streams["video"] == video_bytes
+    assert len(os.listdir(tmp_path)) == 0
+
+
+def test_async_download_pool_failing_rows(tmp_path):
+    pytest.importorskip("aiohttp")
+
+    def rows():
+        yield (0, os.path.join(os.path.dirname(__file__), "test_files/test_video.mp4"))
+        raise OSError("shard vanished")
+
+    encode_formats = {"video": "mp4"}
+    reading_config = {"timeout": 10, "yt_args": {}, "async_args": {}}
+    data_reader = VideoDataReader(encode_formats, str(tmp_path), reading_config)
+    with AsyncDownloadPool(1, str(tmp_path), encode_formats, reading_config) as pool:
+        with pytest.raises(OSError, match="shard vanished"):
+            list(pool.imap_unordered(data_reader, rows()))
+
+
+def test_async_download_pool_slow_transfer(tmp_path):
+    pytest.importorskip("aiohttp")
+    data = os.urandom(1 << 16)
+
+    class SlowRequestHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):  # pylint: disable=invalid-name
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            # the whole transfer takes longer than the timeout but each read is quick
+            for i in range(0, len(data), len(data) // 8):
+                self.wfile.write(data[i : i + len(data) // 8])
+                self.wfile.flush()
+                time.sleep(0.25)
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), SlowRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/test_video.mp4"
+
+    encode_formats = {"video": "mp4"}
+    reading_config = {"timeout": 1, "yt_args": {}, "async_args": {}}
+    data_reader = VideoDataReader(encode_formats, str(tmp_path), reading_config)
+    with AsyncDownloadPool(1, str(tmp_path), encode_formats, reading_config) as pool:
+        results = list(pool.imap_unordered(data_reader, [(0, url)]))
+    server.shutdown()
+
+    _, streams, _, error_message, _ = results[0]
+    assert error_message is None
+    assert streams["video"] == data
+
+
+def test_youtube_dl_pool():
+    pool = YoutubeDLPool(max_uses=2)
+    with pool.get({"quiet": True, "outtmpl": "/tmp/a.mp4"}) as ydl_a:
+        pass
+    with pool.get({"quiet": True, "outtmpl": "/tmp/b.mp4"}) as ydl_b:
+        assert ydl_b.params["outtmpl"]["default"] == "/tmp/b.mp4"
+    assert ydl_a is ydl_b  # outtmpl doesn't split the pool
+    with pool.get({"quiet": True}) as ydl_c:
+        pass
+    assert ydl_c is not ydl_a  # recycled after max_uses
+
+    with pool.get({"quiet": True, "format": "bv"}) as ydl_d:
+        assert ydl_d is not ydl_c
+    with pytest.raises(ValueError):
+        with pool.get({"quiet": True}) as ydl_e:
+            assert ydl_e is ydl_c
+            raise ValueError()
+    with pool.get({"quiet": True}) as ydl_f:
+        assert ydl_f is not ydl_e  # replaced after raising
+
+    assert pickle.loads(pickle.dumps(pool)).max_uses == 2
+    pool.close()
@@ -0,0 +1,153 @@
+"""test video2dataset input sharding"""
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from video2dataset.input_sharder import InputSharder, read_shard
+
+
+def _read_shards(sharder):
+    shards = []
+    for arrow_file, shard_id in sharder:
+        with pa.memory_map(arrow_file) as f:
+            shards.append((shard_id, pa.ipc.open_file(f).read_all().to_pydict()))
+        os.remove(arrow_file)
+    return shards
+
+
+@pytest.mark.parametrize("input_format", ["csv", "tsv", "tsv.gz", "parquet", "json"])
+def test_stream_input(input_format, tmp_path):
+    input_folder = tmp_path / "input"
+    input_folder.mkdir()
+    for i in range(2):
+        df = pd.DataFrame(
+            {
+                "link": [f"https://example.com/{i}/{j}.mp4" for j in range(23)],
+                "text": [f"caption {j}" for j in range(23)],
+                "videoid": list(range(23)),
+                "unused": [0.5] * 23,
+            }
+        )
+        path = str(input_folder / f"{i}.{input_format}")
+        if input_format == "parquet":
+            df.to_parquet(path)
+        elif input_format == "json":
+            df.to_json(path, orient="records", lines=True)
+        else:
+            df.to_csv(path, sep="," if input_format == "csv" else "\t", index=False)
+
+    def sharder(stream_input, tmp_folder):
+        (tmp_path / tmp_folder).mkdir()
+        return InputSharder(
+            str(input_folder),
+            input_format,
+            "link",
+            "text",
+            None,
+            ["videoid"],
+            5,
+            {1, 6},
+            str(tmp_path / tmp_folder),
+            stream_input=stream_input,
+        )
+
+    shards = _read_shards(sharder(True, "streamed"))
+    # shard ids continue across files and done shards are skipped
+    assert [shard_id for shard_id, _ in shards] == [0, 2, 3, 4, 5, 7, 8, 9]
+    assert shards[0][1] == {
+        "videoid": list(range(5)),
+        "caption": [f"caption {j}" for j in range(5)],
+        "url": [f"https://example.com/0/{j}.mp4" for j in range(5)],
+    }
+    assert shards[3][1]["url"] == [f"https://example.com/0/{j}.mp4" for j in range(20, 23)]
+    if input_format != "json":  # loaded as a json array when not streaming
+        assert shards == _read_shards(sharder(False, "loaded"))
+
+
+def test_parquet_shard_descriptors(tmp_path):
+    input_file = str(tmp_path / "input.parquet")
+    df = pd.DataFrame({"link": [f"https://example.com/{j}.mp4" for j in range(23)], "videoid": list(range(23))})
+    df.to_parquet(input_file, row_group_size=4)
+    (tmp_path / "tmp").mkdir()
+
+    sharder = InputSharder(
+        input_file,
+        "parquet",
+        "link",
+        None,
+        None,
+        ["videoid"],
+        5,
+        {1},
+        str(tmp_path / "tmp"),
+        parquet_shard_descriptors=True,
+    )
+    shards = list(sharder)
+    assert [(descriptor.offset, descriptor.num_rows, shard_id) for descriptor, shard_id in shards] == [
+        (0, 5, 0),
+        (10, 5, 2),
+        (15, 5, 3),
+        (20, 3, 4),
+    ]
+    # nothing is written to the tmp folder
+    assert not os.listdir(tmp_path / "tmp")
+
+    assert read_shard(shards[1][0]).to_pydict() == {
+        "videoid": list(range(10, 15)),
+        "url": [f"https://example.com/{j}.mp4" for j in range(10, 15)],
+    }
+    assert read_shard(shards[1][0], 3, 5).to_pydict()["videoid"] == [13, 14]
+    assert read_shard(shards[3][0]).to_pydict()["videoid"] == [20, 21, 22]
+
+
+@pytest.mark.parametrize("stream_input", [False, True])
+def test_group_by_url(stream_input, tmp_path):
+    input_file = str(tmp_path / "input.csv")
+    # 7 videos with 4 or 5 rows each (one per clip), spread over the input, and a video with 12 rows
+    urls = [f"https://example.com/{j % 7}.mp4" for j in range(30)] + ["https://example.com/long.mp4"] * 12
+    pd.DataFrame({"url": urls, "videoid": list(range(len(urls)))}).to_csv(input_file, index=False)
+    (tmp_path / "tmp").mkdir()
+
+    sharder = InputSharder(
+        input_file,
+        "csv",
+        "url",
+        None,
+        None,
+        ["videoid"],
+        5,
+        set(),
+        str(tmp_path / "tmp"),
+        stream_input=stream_input,
+        group_by_url=True,
+        url_partitions=3,
+    )
+    shards = _read_shards(sharder)
+    assert sorted(videoid for _, shard in shards for videoid in shard["videoid"]) == list(range(len(urls)))
+    assert all(len(shard["url"]) <= 5 for _, shard in shards)
+    assert [shard_id for shard_id, _ in shards] == list(range(len(shards)))
+    # the rows of a video are in a single shard, unless there are more of them than fit in a shard
+    for j in range(7):
+        assert sum(f"https://example.com/{j}.mp4" in shard["url"] for _, shard in shards) == 1
+    assert sorted(shard["url"].count("https://example.com/long.mp4") for _, shard in shards)[-3:] == [2, 5, 5]
+
+
+def test_group_by_url_parquet_shard_descriptors(tmp_path):
+    input_file = str(tmp_path / "input.parquet")
+    pd.DataFrame({"url": ["https://example.com/0.mp4"]}).to_parquet(input_file)
+    with pytest.raises(ValueError):
+        InputSharder(
+            input_file,
+            "parquet",
+            "url",
+            None,
+            None,
+            None,
+            5,
+            set(),
+            str(tmp_path),
+            parquet_shard_descriptors=True,
+            group_by_url=True,
+        )
@@ -0,0 +1,43 @@
+"""test the stats collected for the logger"""
+import json
+
+import pytest
+
+from video2dataset.logger import CappedCounter, LatencyHistogram, StageStats, merge_stats, write_stats
+
+
+def test_latency_histogram():
+    histogram = LatencyHistogram()
+    for i in range(1, 1001):
+        histogram.add(i / 1000)
+    for p in [50, 95, 99]:
+        assert histogram.percentile(p) == pytest.approx(p / 100, rel=LatencyHistogram.BUCKET_PRECISION)
+    assert histogram.percentile(100) == 1.0
+
+    merged = LatencyHistogram.load(json.loads(json.dumps(histogram.dump())))
+    merged.update(histogram)
+    assert merged.count == 2000
+    assert merged.percentile(50) == histogram.percentile(50)
+
+
+def test_stage_stats(tmp_path):
+    def subsampler(streams, meta):
+        streams["video"] = [s[:2] for s in streams["video"]]
+        return streams, meta, None
+
+    stage_stats = StageStats()
+    for _ in stage_stats.iterate("read", range(3)):
+        with stage_stats.time("write"):
+            pass
+    streams, meta, _ = stage_stats.run("subsampler", subsampler, {"video": [b"abcd", b"ef"]}, {})
+    assert streams == {"video": [b"ab", b"ef"]} and meta == {}
+
+    for shard_name in ["00000_00000", "00000_00003"]:
+        write_stats(str(tmp_path), shard_name, 3, 3, 0, 0, 6, 0.0, 1.0, CappedCounter(), 5, stage_stats)
+    merge_stats([f"{tmp_path}/00000_00000_stats.json", f"{tmp_path}/00000_00003_stats.json"], str(tmp_path), 0, 5)
+    with open(f"{tmp_path}/00000_stats.json", encoding="utf-8") as f:
+        summary = StageStats.load(json.load(f)["stage_stats"]).summary()
+
+    assert {stage: stats["count"] for stage, stats in summary.items()} == {"read": 6, "write": 6, "subsampler": 2}
+    assert summary["subsampler"]["bytes_in"] == 12
+    assert summary["subsampler"]["bytes_out"] == 8
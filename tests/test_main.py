@@ -1,14 +1,27 @@
 """end2end test"""
+import http.server
+import json
 import os
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
 
 import pandas as pd
+import pyarrow as pa
 import pytest
 import tarfile
 import tempfile
 
 from omegaconf import OmegaConf
 from video2dataset.configs import CONFIGS
+from video2dataset.data_writer import WebDatasetSampleWriter
+from video2dataset.logger import StageStats
 from video2dataset.main import video2dataset
+from video2dataset.subsamplers import clipping_subsampler
+from video2dataset.workers import DownloadWorker
+from video2dataset.workers import download_worker
+from video2dataset.workers.download_worker import merge_modal_metas
 
 
 @pytest.mark.parametrize("input_file", ["test_webvid.csv", "test_yt.csv"])
@@ -62,3 +75,261 @@ def test_e2e(input_file):
                     == samples_per_shard
                 )
             assert len([x for x in tarfile.open(tmpdir2 + f"/{shard}.tar").getnames() if x.endswith(f".mp4")]) == 0
+
+
+@pytest.mark.parametrize("output_format", ["webdataset", "files", "parquet"])
+def test_work_stealing_distributor(output_format, tmp_path):
+    current_folder = os.path.dirname(__file__)
+    video_path = os.path.join(current_folder, "test_files/test_video.mp4")
+    url_list = str(tmp_path / "input.csv")
+    pd.DataFrame({"url": [video_path] * 7, "caption": [str(i) for i in range(7)]}).to_csv(url_list, index=False)
+    output_folder = str(tmp_path / "output")
+
+    config = OmegaConf.to_container(CONFIGS["default"])
+    config["storage"]["number_sample_per_shard"] = 3
+    config["distribution"]["processes_count"] = 2
+    config["distribution"]["thread_count"] = 2
+    config["distribution"]["distributor"] = "work_stealing"
+    config["distribution"]["distributor_args"] = {"chunk_size": 2}
+
+    video2dataset(
+        url_list,
+        output_folder=output_folder,
+        input_format="csv",
+        output_format=output_format,
+        caption_col="caption",
+        config=config,
+    )
+
+    # shard boundaries are the same as when downloading whole shards
+    expected_keys = [["000000", "000001", "000002"], ["000010", "000011", "000012"], ["000020"]]
+    for shard, keys in zip(["00000", "00001", "00002"], expected_keys):
+        df = pd.read_parquet(f"{output_folder}/{shard}.parquet")
+        assert sorted(df["key"]) == keys
+        assert sorted(df["caption"]) == [int(key[-1]) + 3 * int(shard) for key in keys]
+        with open(f"{output_folder}/{shard}_stats.json") as f:
+            stats = json.load(f)
+        assert stats["count"] == stats["successes"] == len(keys)
+        if output_format == "webdataset":
+            with tarfile.open(f"{output_folder}/{shard}.tar") as tar:
+                assert sorted(x for x in tar.getnames() if x.endswith(".mp4")) == [f"{key}.mp4" for key in keys]
+        elif output_format == "files":
+            assert sorted(x for x in os.listdir(f"{output_folder}/{shard}") if x.endswith(".mp4")) == [
+                f"{key}.mp4" for key in keys
+            ]
+    assert not os.path.exists(f"{output_folder}/_tmp")
+
+
+def test_group_by_url(tmp_path):
+    requests: Counter = Counter()
+
+    class RequestHandler(http.server.SimpleHTTPRequestHandler):
+        def translate_path(self, path):
+            requests[path] += 1
+            return os.path.join(os.path.dirname(__file__), "test_files/test_video.mp4")
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host = f"http://127.0.0.1:{server.server_address[1]}"
+    # a caption aligned dataset: one row per clip, the rows of a video are spread over the input
+    urls = [f"{host}/{j % 3}.mp4" for j in range(9)]
+    url_list = str(tmp_path / "input.parquet")
+    pd.DataFrame(
+        {
+            "url": urls,
+            "caption": [f"clip {j // 3} of video {j % 3}" for j in range(9)],
+            "clips": [[[10.0 * (j // 3), 10.0 * (j // 3) + 3.0]] for j in range(9)],
+        }
+    ).to_parquet(url_list)
+    output_folder = str(tmp_path / "output")
+
+    config = OmegaConf.to_container(CONFIGS["default"])
+    config["storage"]["number_sample_per_shard"] = 4
+    config["distribution"]["processes_count"] = 1
+    config["reading"]["group_by_url"] = True
+
+    video2dataset(
+        url_list,
+        output_folder=output_folder,
+        input_format="parquet",
+        output_format="webdataset",
+        caption_col="caption",
+        clip_col="clips",
+        config=config,
+    )
+    server.shutdown()
+
+    # one download per video
+    assert requests == {f"/{j}.mp4": 1 for j in range(3)}
+    for shard in ["00000", "00001", "00002"]:
+        df = pd.read_parquet(f"{output_folder}/{shard}.parquet")
+        assert len(set(df["url"])) == 1
+        with open(f"{output_folder}/{shard}_stats.json") as f:
+            assert json.load(f)["successes"] == 3
+        with tarfile.open(f"{output_folder}/{shard}.tar") as tar:
+            assert len([x for x in tar.getnames() if x.endswith(".mp4")]) == 3
+
+
+def test_group_by_url_failed_download(monkeypatch, tmp_path):
+    # a semaphore released more often than acquired raises
+    monkeypatch.setattr(download_worker, "Semaphore", BoundedSemaphore)
+    current_folder = os.path.dirname(__file__)
+    urls = [str(tmp_path / "missing.mp4")] * 3 + [os.path.join(current_folder, "test_files/test_video.mp4")]
+    shard_file = str(tmp_path / "shard.feather")
+    with pa.OSFile(shard_file, "wb") as sink:
+        table = pa.table({"url": urls})
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    config = OmegaConf.to_container(CONFIGS["default"])
+    config["distribution"]["thread_count"] = 1
+    worker = DownloadWorker(
+        WebDatasetSampleWriter, False, str(tmp_path), ["url"], str(tmp_path / "output"), {"video": "mp4"}, config
+    )
+    os.makedirs(tmp_path / "output")
+    worker.download_samples(shard_file, 0, str(tmp_path / "output"), "00000")
+
+    with open(tmp_path / "output/00000_stats.json") as f:
+        stats = json.load(f)
+    assert stats["successes"] == 1
+    assert stats["failed_to_download"] == 3
+
+
+def test_clips_failing_after_the_first(monkeypatch, tmp_path):
+    get_clip_metadata = clipping_subsampler._get_clip_metadata
+
+    def failing_get_clip_metadata(clip_id, **kwargs):
+        if clip_id > 0:
+            raise OSError("clip file vanished")
+        return get_clip_metadata(clip_id=clip_id, **kwargs)
+
+    monkeypatch.setattr(clipping_subsampler, "_get_clip_metadata", failing_get_clip_metadata)
+    current_folder = os.path.dirname(__file__)
+    shard_file = str(tmp_path / "shard.feather")
+    table = pa.table(
+        {"url": [os.path.join(current_folder, "test_files/test_video.mp4")], "clips": [[[0.0, 3.0], [10.0, 13.0]]]}
+    )
+    with pa.OSFile(shard_file, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    config = OmegaConf.to_container(CONFIGS["default"])
+    worker = DownloadWorker(
+        WebDatasetSampleWriter,
+        False,
+        str(tmp_path),
+        ["url", "clips"],
+        str(tmp_path / "output"),
+        {"video": "mp4"},
+        config,
+    )
+    assert worker.write_clips_incrementally
+    os.makedirs(tmp_path / "output")
+    worker.download_samples(shard_file, 0, str(tmp_path / "output"), "00000")
+
+    with open(tmp_path / "output/00000_stats.json") as f:
+        stats = json.load(f)
+    assert stats["successes"] == 0
+    assert stats["failed_to_subsample"] == 1
+    assert stats["status_dict"] == {"clip file vanished": 1}
+    # only the meta row of the failed sample, none of its clips
+    with tarfile.open(tmp_path / "output/00000.tar") as tar:
+        assert tar.getnames() == ["00000000.json"]
+
+
+@pytest.mark.parametrize("subsampling_thread_count", [None, 2])
+def test_subsampling_threads(subsampling_thread_count, tmp_path):
+    current_folder = os.path.dirname(__file__)
+    video_path = os.path.join(current_folder, "test_files/test_video.mp4")
+    url_list = str(tmp_path / "input.parquet")
+    pd.DataFrame({"url": [video_path] * 4, "clips": [[[0.0, 3.0], [10.0, 13.0]]] * 4}).to_parquet(url_list)
+    output_folder = str(tmp_path / "output")
+
+    config = OmegaConf.to_container(CONFIGS["default"])
+    config["subsampling"] = {"ResolutionSubsampler": {"args": {"video_size": 64, "resize_mode": "scale"}}}
+    config["distribution"]["processes_count"] = 1
+    config["distribution"]["thread_count"] = 2
+    config["distribution"]["subsampling_thread_count"] = subsampling_thread_count
+
+    video2dataset(
+        url_list,
+        output_folder=output_folder,
+        input_format="parquet",
+        output_format="webdataset",
+        clip_col="clips",
+        config=config,
+    )
+
+    with open(f"{output_folder}/00000_stats.json") as f:
+        stats = json.load(f)
+    assert stats["successes"] == 4
+    assert stats["stage_stats"]["ResolutionSubsampler"]["count"] == 4
+    with tarfile.open(f"{output_folder}/00000.tar") as tar:
+        assert sorted(x for x in tar.getnames() if x.endswith(".mp4")) == [
+            f"0000000{i}_0000{j}.mp4" for i in range(4) for j in range(2)
+        ]
+
+
+def test_run_modal_subsamplers_concurrently(tmp_path):
+    current_folder = os.path.dirname(__file__)
+    config = OmegaConf.to_container(CONFIGS["default"])
+    config["subsampling"] = {
+        "ResolutionSubsampler": {"args": {"video_size": 64, "resize_mode": "scale"}},
+        "FrameSubsampler": {"args": {"frame_rate": 1, "downsample_method": "first_frame"}},
+        "AudioRateSubsampler": {"args": {"sample_rate": 8000, "encode_format": "mp3"}},
+    }
+    worker = DownloadWorker(
+        WebDatasetSampleWriter,
+        False,
+        str(tmp_path),
+        ["url"],
+        str(tmp_path),
+        {"video": "mp4", "audio": "mp3"},
+        config,
+    )
+    with open(os.path.join(current_folder, "test_files/test_video.mp4"), "rb") as f:
+        video_bytes = f.read()
+    with open(os.path.join(current_folder, "test_files/test_audio.mp3"), "rb") as f:
+        audio_bytes = f.read()
+    metas = [{"key": "000"}]
+
+    results = []
+    for pool in [None, ThreadPoolExecutor(1)]:
+        streams = {"video": [video_bytes], "audio": [audio_bytes]}
+        stage_stats = StageStats()
+        subsampled_streams, subsampled_metas, error_message = worker.run_modal_subsamplers(
+            streams, metas, stage_stats, pool
+        )
+        assert error_message is None
+        assert subsampled_metas == metas
+        assert set(stage_stats.summary()) == {"ResolutionSubsampler", "FrameSubsampler", "AudioRateSubsampler"}
+        results.append({modality: len(stream) for modality, stream in subsampled_streams.items()})
+        # the input streams are left as they are
+        assert streams == {"video": [video_bytes], "audio": [audio_bytes]}
+    # the jpg added by the FrameSubsampler of the video is kept
+    assert results[0] == results[1] == {"video": 1, "audio": 1, "jpg": 1}
+
+    # the samples run in the same pool, a sample holding its only thread runs the other chains itself
+    with ThreadPoolExecutor(1) as pool:
+        future = pool.submit(worker.run_modal_subsamplers, streams, metas, StageStats(), pool)
+        assert future.result(timeout=60)[2] is None
+
+
+def test_merge_modal_metas():
+    metas = [{"key": "000", "clips": [[0.0, 1.0]]}, {"key": "001", "clips": [[1.0, 2.0]]}]
+    video_metas = [dict(meta) for meta in metas]
+    audio_metas = [{**meta, "whisper_transcript": meta["key"]} for meta in metas]
+    merged_metas, error_message = merge_modal_metas(metas, {"video": video_metas, "audio": audio_metas})
+    assert error_message is None
+    assert merged_metas == audio_metas
+
+    frame_metas = [{**metas[0], "key": f"000_{i}"} for i in range(3)]
+    merged_metas, error_message = merge_modal_metas(metas, {"video": frame_metas, "audio": video_metas})
+    assert error_message is None
+    assert merged_metas == frame_metas
+    # no telling which frame the transcripts belong to
+    _, error_message = merge_modal_metas(metas, {"video": frame_metas, "audio": audio_metas})
+    assert error_message is not None
@@ -0,0 +1,122 @@
+"""test the per domain rate limiter"""
+import pickle
+import threading
+
+from video2dataset.rate_limiter import AdaptiveRateLimiter, merge_domain_stats
+
+A = "http://a.com/video.mp4"
+B = "http://b.com/video.mp4"
+
+
+def test_aimd():
+    limiter = AdaptiveRateLimiter(initial_limit=2, latency_factor=4.0, cooldown=0.0)
+    rows = limiter.schedule([(i, A) for i in range(20)])
+    for _ in range(2):
+        next(rows)
+    for _ in range(2):
+        rows.done(A, 1.0, None)
+    assert limiter.windows["a.com"].limit > 2  # additive increase
+
+    for _ in range(2):
+        next(rows)
+    rows.done(A, 1.0, "429 Client Error: Too Many Requests for url: http://a.com/video.mp4")
+    limit = limiter.windows["a.com"].limit
+    assert limit < 2  # multiplicative decrease
+    # the other download in flight got throttled too, that's the same congestion
+    rows.done(A, 1.0, "429 Client Error: Too Many Requests for url: http://a.com/video.mp4")
+    assert limiter.windows["a.com"].limit == limit
+
+    next(rows)
+    rows.done(A, 10.0, None)  # much slower than the fastest download
+    assert limiter.windows["a.com"].limit == 1  # min_limit
+    assert rows.dump() == {"a.com": {"downloads": 5, "throttled": 2, "limit": 1}}
+    # counters are per shard
+    assert limiter.schedule([]).dump() == {}
+
+    # domains start from scratch in other processes
+    assert pickle.loads(pickle.dumps(limiter)).windows == {}
+
+
+def test_big_downloads_are_not_congestion():
+    limiter = AdaptiveRateLimiter(initial_limit=1, latency_factor=4.0)
+    rows = limiter.schedule([(i, A) for i in range(4)])
+    next(rows)
+    rows.done(A, 1.0, None, 1 << 20)
+    next(rows)
+    rows.done(A, 10.0, None, 100 << 20)  # 100x the bytes in 10x the time
+    assert limiter.windows["a.com"].limit == 2.5
+    for _ in range(2):
+        next(rows)
+        rows.done(A, 10.0, None, 1 << 20)  # same size, 10x slower
+    assert limiter.windows["a.com"].limit == 1.25
+
+
+def test_schedule_other_domains_go_ahead():
+    limiter = AdaptiveRateLimiter(initial_limit=1)
+    rows = limiter.schedule([(0, A), (1, A), (2, A), (3, B)])
+    assert next(rows) == (0, A)
+    assert next(rows) == (3, B)  # a.com is full
+
+    result = []
+    thread = threading.Thread(target=lambda: result.append(next(rows)))
+    thread.start()
+    thread.join(0.2)
+    assert not result  # both domains are full
+    rows.done(A, 1.0, None)
+    thread.join()
+    assert result == [(1, A)]
+
+
+def test_throttled_domain_cools_down():
+    limiter = AdaptiveRateLimiter(initial_limit=4, cooldown=60.0)
+    rows = limiter.schedule([(0, A), (1, A), (2, B)])
+    assert next(rows) == (0, A)
+    rows.done(A, 1.0, "ERROR: [youtube] jLX0D8qQUBM: Sign in to confirm you're not a bot")
+    assert next(rows) == (2, B)
+
+
+def test_overlapping_schedules():
+    # f.e. the chunks of several shards the work stealing distributor downloads at once in a process
+    limiter = AdaptiveRateLimiter(initial_limit=2, latency_factor=None)
+    first = limiter.schedule([(i, A) for i in range(4)])
+    assert [next(first), next(first)] == [(0, A), (1, A)]
+
+    second = limiter.schedule([(i, A) for i in range(4)] + [(4, B)])
+    # a.com is full with the downloads of the first shard, starting the second one doesn't free them
+    assert next(second) == (4, B)
+    assert limiter.windows["a.com"].in_flight == 2
+
+    result = []
+    thread = threading.Thread(target=lambda: result.append(next(second)))
+    thread.start()
+    thread.join(0.2)
+    assert not result
+    # the first shard fails, closing it frees the slots its downloads held
+    first.close()
+    thread.join()
+    assert result == [(0, A)]
+    first.done(A, 1.0, None)  # a download of the failed shard finishing late doesn't free a slot again
+    assert limiter.windows["a.com"].in_flight == 1
+
+    second.done(A, 1.0, None)
+    second.done(B, 1.0, None)
+    assert limiter.windows["a.com"].in_flight == limiter.windows["b.com"].in_flight == 0
+    assert second.dump() == {
+        "a.com": {"downloads": 1, "throttled": 0, "limit": 2.5},
+        "b.com": {"downloads": 1, "throttled": 0, "limit": 2.5},
+    }
+    assert first.dump() == {}
+
+
+def test_merge_domain_stats():
+    parts = [
+        {"a.com": {"downloads": 3, "throttled": 1, "limit": 2.0}},
+        {
+            "a.com": {"downloads": 2, "throttled": 0, "limit": 4.5},
+            "b.com": {"downloads": 1, "throttled": 0, "limit": 4},
+        },
+    ]
+    assert merge_domain_stats(parts) == {
+        "a.com": {"downloads": 5, "throttled": 1, "limit": 2.0},
+        "b.com": {"downloads": 1, "throttled": 0, "limit": 4},
+    }
@@ -0,0 +1,137 @@
+"""test retrying the samples that failed to download"""
+import http.server
+import json
+import os
+import shutil
+import threading
+from collections import Counter
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+import yt_dlp
+from omegaconf import OmegaConf
+
+from video2dataset.configs import CONFIGS
+from video2dataset.main import video2dataset
+from video2dataset.data_writer import WebDatasetSampleWriter
+from video2dataset.retry import failed_samples, is_transient
+from video2dataset.workers import DownloadWorker
+
+
+@pytest.mark.parametrize(
+    "error_message,transient",
+    [
+        ("503 Server Error: Service Unavailable for url: http://host/1.mp4", True),
+        ("429, message='Too Many Requests', url=URL('http://host/1.mp4')", True),
+        ("ERROR: [youtube] jLX0D8qQUBM: Sign in to confirm you're not a bot", True),
+        ("('Connection aborted.', ConnectionResetError(104, 'Connection reset by peer'))", True),
+        ("HTTPConnectionPool(host='host', port=80): Read timed out. (read timeout=10)", True),
+        ("404 Client Error: Not Found for url: http://host/503.mp4", False),
+        ("ERROR: [youtube] jLX0D8qQUBM: Video unavailable", False),
+        (None, False),
+    ],
+)
+def test_is_transient(error_message, transient):
+    assert is_transient(error_message) == transient
+
+
+class FlakyRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the test video, /fail_{n}_{i}.mp4 answers 503 the first n times and /missing_{i}.mp4 404"""
+
+    requests: Counter = Counter()
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self.requests[self.path] += 1
+        name = os.path.basename(self.path)
+        if name.startswith("missing"):
+            self.send_error(404)
+            return
+        if name.startswith("fail") and self.requests[self.path] <= int(name.split("_")[1]):
+            self.send_error(503)
+            return
+        with open(os.path.join(os.path.dirname(__file__), "test_files/test_video.mp4"), "rb") as f:
+            data = f.read()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+@pytest.mark.parametrize("async_args", [None, {}])
+def test_sample_retry(async_args, tmp_path):
+    if async_args is not None:
+        pytest.importorskip("aiohttp")
+    FlakyRequestHandler.requests.clear()
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FlakyRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host = f"http://127.0.0.1:{server.server_address[1]}"
+    urls = [f"{host}/fail_0_0.mp4", f"{host}/fail_1_1.mp4", f"{host}/fail_2_2.mp4"]
+    urls += [f"{host}/fail_9_3.mp4", f"{host}/missing_4.mp4"]
+    url_list = str(tmp_path / "input.csv")
+    pd.DataFrame({"url": urls}).to_csv(url_list, index=False)
+    output_folder = str(tmp_path / "output")
+
+    config = OmegaConf.to_container(CONFIGS["default"])
+    config["reading"]["retry_args"] = {"max_retries": 2, "backoff": 0.01}
+    config["reading"]["async_args"] = async_args
+    config["reading"]["rate_limit_args"] = {"initial_limit": 1}
+    config["distribution"]["processes_count"] = 1
+    config["distribution"]["thread_count"] = 2
+
+    video2dataset(url_list, output_folder=output_folder, input_format="csv", output_format="webdataset", config=config)
+    server.shutdown()
+
+    df = pd.read_parquet(f"{output_folder}/00000.parquet")
+    assert sorted(df[df["status"] == "success"]["url"]) == urls[:3]
+    assert sorted(df[df["status"] == "failed_to_download"]["url"]) == urls[3:]
+    with open(f"{output_folder}/00000_stats.json") as f:
+        stats = json.load(f)
+    assert stats["successes"] == 3
+    # every attempt went through the rate limiter
+    assert stats["domain_stats"][host[len("http://") :]]["downloads"] == sum(FlakyRequestHandler.requests.values())
+
+    # only the sample that kept failing with a transient error is worth another pass
+    assert failed_samples(output_folder).to_pydict() == {"url": [urls[3]]}
+    assert sorted(failed_samples(output_folder, retry_permanent=True).to_pydict()["url"]) == urls[3:]
+
+
+def test_yt_dlp_retry(monkeypatch, tmp_path):
+    downloads = []
+
+    def download(self, url_list):
+        downloads.append(url_list)
+        if len(downloads) == 1:
+            raise yt_dlp.utils.DownloadError("ERROR: [youtube] abc: HTTP Error 429: Too Many Requests")
+        video = os.path.join(os.path.dirname(__file__), "test_files/test_video.mp4")
+        shutil.copyfile(video, self.params["outtmpl"]["default"])
+        return 0
+
+    monkeypatch.setattr(yt_dlp.YoutubeDL, "download", download)
+    shard_file = str(tmp_path / "shard.feather")
+    table = pa.table({"url": ["https://www.youtube.com/watch?v=abc"]})
+    with pa.OSFile(shard_file, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    config = OmegaConf.to_container(CONFIGS["default"])
+    config["reading"]["yt_args"]["yt_metadata_args"] = None
+    config["reading"]["retry_args"] = {"max_retries": 2, "backoff": 0.01}
+    config["reading"]["rate_limit_args"] = {"cooldown": 0.01}
+    output_folder = str(tmp_path / "output")
+    os.makedirs(output_folder)
+    worker = DownloadWorker(
+        WebDatasetSampleWriter, False, str(tmp_path), ["url"], output_folder, {"video": "mp4"}, config
+    )
+    worker.download_samples(shard_file, 0, output_folder, "00000")
+
+    # the 429 was requeued and slowed the domain down instead of being dropped
+    assert len(downloads) == 2
+    with open(f"{output_folder}/00000_stats.json") as f:
+        stats = json.load(f)
+    assert stats["successes"] == 1
+    assert stats["domain_stats"]["www.youtube.com"]["downloads"] == 2
+    assert stats["domain_stats"]["www.youtube.com"]["throttled"] == 1
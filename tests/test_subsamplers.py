@@ -1,4 +1,5 @@
 """test video2dataset subsamplers"""
+import json
 import os
 import subprocess
 import pytest
@@ -15,11 +16,14 @@ from video2dataset.subsamplers import (
     FFProbeSubsampler,
     ResolutionSubsampler,
     FrameSubsampler,
+    FusedSubsampler,
+    NoOpSubsampler,
     AudioRateSubsampler,
     CutDetectionSubsampler,
     OpticalFlowSubsampler,
     WhisperSubsampler,
 )
+from video2dataset.subsamplers import container_index, cut_detection_subsampler, ffmpeg_runner
 
 
 SINGLE = [[50.0, 60.0]]
@@ -96,6 +100,40 @@ def test_clipping_subsampler(clips):
             assert abs(frag_len - (e_s - s_s)) < 5.0
 
 
+def test_clipping_subsampler_clip_files():
+    current_folder = os.path.dirname(__file__)
+    with open(os.path.join(current_folder, "test_files/test_video.mp4"), "rb") as vid_f:
+        video_bytes = vid_f.read()
+    with open(os.path.join(current_folder, "test_files/test_audio.mp3"), "rb") as aud_f:
+        audio_bytes = aud_f.read()
+
+    subsampler = ClippingSubsampler(oom_clip_count=3, encode_formats={"video": "mp4", "audio": "mp3"}, min_length=5.0)
+    yt_meta_dict = {"title": "test"}
+
+    streams: Streams = {"video": [video_bytes], "audio": [audio_bytes]}
+    stream_fragments, meta_fragments, error_message = subsampler(
+        streams, {"key": "000", "clips": MULTI, "yt_meta_dict": yt_meta_dict}
+    )
+    assert error_message is None
+
+    with subsampler.clip_files(streams, {"key": "000", "clips": MULTI, "yt_meta_dict": yt_meta_dict}) as clip_files:
+        clips = [(subsampler.read_clip(clip_paths), clip_meta) for clip_paths, clip_meta in clip_files]
+        tmpdirs = {os.path.dirname(path) for clip_paths, _ in clip_files for path in clip_paths.values()}
+    # the clip files are removed at the exit
+    assert not any(os.path.exists(tmpdir) for tmpdir in tmpdirs)
+    assert len(clips) == len(meta_fragments) == 4
+    for i, (clip_streams, clip_meta) in enumerate(clips):
+        assert clip_streams == {"video": stream_fragments["video"][i], "audio": stream_fragments["audio"][i]}
+        assert clip_meta == meta_fragments[i]
+    # the metadata of the video isn't copied for each clip
+    assert clips[0][1]["yt_meta_dict"] is yt_meta_dict
+    assert all(clip_meta["yt_meta_dict"] == {} for _, clip_meta in clips[1:])
+
+    with pytest.raises(ValueError):
+        with subsampler.clip_files(streams, {"key": "000", "clips": [[0.0, 1.0]]}):
+            pass
+
+
 @pytest.mark.parametrize("size,resize_mode", [(144, ["scale"]), (1620, ["scale", "crop", "pad"])])
 def test_resolution_subsampler_video_size(size, resize_mode):
     current_folder = os.path.dirname(__file__)
@@ -155,6 +193,25 @@ def test_resolution_subsampler_height_and_width(height, width, resize_mode):
             assert w_vid == width
 
 
+@pytest.mark.parametrize("encode_format,layout", [("mp4", "moov_first"), ("webm", None)])
+def test_run_ffmpeg_output_layout(encode_format, layout):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        video = os.path.join(tmpdir, "video.mp4")
+        ffmpeg.input("testsrc2=size=160x120:rate=30:duration=2", f="lavfi").output(video, vcodec="libx264").run(
+            capture_stdout=True, capture_stderr=True
+        )
+        with open(video, "rb") as vid_f:
+            video_bytes = vid_f.read()
+
+    # final mp4 files have their index at the front instead of being fragmented like piped ones
+    out = ffmpeg_runner.run_ffmpeg(video_bytes, "mp4", encode_format, lambda stream: stream.filter("scale", 80, 60))
+    assert ffmpeg_runner.mp4_layout(out) == layout
+    probe = json.loads(
+        ffmpeg_runner.run_ffprobe(out, encode_format, ["-v", "quiet", "-print_format", "json", "-show_streams"])
+    )
+    assert probe["streams"][0]["width"] == 80
+
+
 @pytest.mark.parametrize("target_frame_rate", [6, 15, 30])
 def test_frame_rate_subsampler(target_frame_rate):
     current_folder = os.path.dirname(__file__)
@@ -180,6 +237,44 @@ def test_frame_rate_subsampler(target_frame_rate):
         assert frame_rate == target_frame_rate
 
 
+@pytest.mark.parametrize("clips", [None, MULTI])
+def test_fused_subsampler(clips):
+    current_folder = os.path.dirname(__file__)
+    # video length - 2:02, 1080x1920, 30 fps
+    video = os.path.join(current_folder, "test_files/test_video.mp4")
+    with open(video, "rb") as vid_f:
+        video_bytes = vid_f.read()
+
+    encode_formats = {"video": "mp4"}
+    broadcast_subsampler = NoOpSubsampler() if clips is None else ClippingSubsampler(3, encode_formats, min_length=5.0)
+    subsampler = FusedSubsampler(
+        broadcast_subsampler,
+        [ResolutionSubsampler(video_size=144, resize_mode=["scale"]), FrameSubsampler(6)],
+        encode_formats,
+    )
+
+    metadata = {"key": "000"}
+    if clips is not None:
+        metadata["clips"] = clips
+    streams = {"video": [video_bytes]}
+    subsampled_streams, metas, error_message = subsampler(streams, metadata)
+    assert error_message is None
+    subsampled_videos = subsampled_streams["video"]
+    assert len(subsampled_videos) == len(metas) == (1 if clips is None else 4)
+
+    for vid, meta in zip(subsampled_videos, metas):
+        with tempfile.NamedTemporaryFile() as tmp:
+            tmp.write(vid)
+
+            probe = ffmpeg.probe(tmp.name)
+            video_stream = [stream for stream in probe["streams"] if stream["codec_type"] == "video"][0]
+            assert video_stream["height"] == 144
+            assert int(video_stream["r_frame_rate"].split("/")[0]) == 6
+            if clips is not None:
+                s, e = meta["clips"][0]
+                assert abs(float(video_stream["duration"]) - (_get_seconds(e) - _get_seconds(s))) < 1.0
+
+
 @pytest.mark.parametrize("sample_rate,n_audio_channels", [(44100, 1), (24000, 2)])
 def test_audio_rate_subsampler(sample_rate, n_audio_channels):
     current_folder = os.path.dirname(__file__)
@@ -216,7 +311,9 @@ def test_cut_detection_subsampler(cut_detection_mode, framerates):
     with open(video, "rb") as vid_f:
         video_bytes = vid_f.read()
 
-    subsampler = CutDetectionSubsampler(cut_detection_mode, framerates, threshold=5)
+    subsampler = CutDetectionSubsampler(
+        cut_detection_mode=cut_detection_mode, algorithm="content", framerates=framerates, threshold=5
+    )
 
     streams = {"video": [video_bytes]}
     streams, cuts, err_msg = subsampler(streams)
@@ -232,7 +329,44 @@ def test_cut_detection_subsampler(cut_detection_mode, framerates):
         assert cuts["cuts_original_fps"][-1] == [3015, 3678]
 
         if len(framerates) > 0:
-            assert cuts["cuts_1"][-1] == [3420, 3678]
+            assert cuts["cuts_1"][-1] == [3030, 3678]
+
+    if len(framerates) > 0:
+        # with framerates the video is decoded once into a buffer, the cuts must not change
+        _, unbuffered_cuts, _ = CutDetectionSubsampler(
+            cut_detection_mode=cut_detection_mode, algorithm="content", threshold=5
+        )({"video": [video_bytes]})
+        assert cuts["cuts_original_fps"] == unbuffered_cuts["cuts_original_fps"]
+
+
+def test_cut_detection_subsampler_buffer_full(monkeypatch):
+    current_folder = os.path.dirname(__file__)
+    with open(os.path.join(current_folder, "test_files/test_video.mp4"), "rb") as vid_f:
+        video_bytes = vid_f.read()
+    subsampler = CutDetectionSubsampler(cut_detection_mode="all", algorithm="content", framerates=[1], threshold=5)
+    _, buffered_cuts, _ = subsampler({"video": [video_bytes]})
+
+    # the frames don't fit in the buffer, the video is decoded again for each pass
+    monkeypatch.setattr(cut_detection_subsampler, "MAX_DECODED_FRAMES_SIZE", 1 << 20)
+    _, cuts, err_msg = subsampler({"video": [video_bytes]})
+    assert err_msg is None
+    assert cuts == buffered_cuts
+
+
+@pytest.mark.parametrize("algorithm,reference", [("vectorized_content", "content"), ("vectorized", "adaptive")])
+def test_vectorized_cut_detection(algorithm, reference):
+    current_folder = os.path.dirname(__file__)
+    video = os.path.join(current_folder, "test_files/test_video.mp4")
+    with open(video, "rb") as vid_f:
+        video_bytes = vid_f.read()
+
+    cuts = {}
+    for alg in [algorithm, reference]:
+        subsampler = CutDetectionSubsampler(algorithm=alg, cut_detection_mode="all", framerates=[1, 5], threshold=5)
+        _, cuts[alg], err_msg = subsampler({"video": [video_bytes]})
+        assert err_msg is None
+
+    assert cuts[algorithm] == cuts[reference]
 
 
 @pytest.mark.parametrize(
@@ -275,14 +409,17 @@ def test_optical_flow_subsampler(detector, fps, params):
 
 
 @pytest.mark.parametrize("extract_keyframes", [False, True])
-def test_ffprobe_subsampler(extract_keyframes):
+@pytest.mark.parametrize("backend", ["ffprobe", "pyav"])
+def test_ffprobe_subsampler(extract_keyframes, backend):
+    if backend == "pyav":
+        pytest.importorskip("av")
     current_folder = os.path.dirname(__file__)
     # video length - 2:02, 1080x1920, 30 fps
     video = os.path.join(current_folder, "test_files/test_video.mp4")
     with open(video, "rb") as vid_f:
         video_bytes = vid_f.read()
 
-    subsampler = FFProbeSubsampler(extract_keyframes)
+    subsampler = FFProbeSubsampler(extract_keyframes, backend)
 
     streams = {"video": [video_bytes]}
     metadata = {}
@@ -310,6 +447,57 @@ def test_ffprobe_subsampler(extract_keyframes):
     else:
         assert "keyframe_timestamps" not in metadata
 
+    if backend == "pyav":  # same schema as ffprobe
+        _, ffprobe_metadata, _ = FFProbeSubsampler(extract_keyframes)(streams, {})
+        ffprobe_stream_info = ffprobe_metadata["video_metadata"]["streams"][video_stream_info["index"]]
+        for key in ["codec_name", "width", "height", "r_frame_rate", "avg_frame_rate", "duration", "nb_frames"]:
+            assert video_stream_info[key] == ffprobe_stream_info[key]
+        assert video_metadata["format"]["duration"] == ffprobe_metadata["video_metadata"]["format"]["duration"]
+        assert video_metadata.get("keyframe_timestamps") == ffprobe_metadata["video_metadata"].get(
+            "keyframe_timestamps"
+        )
+
+
+def test_ffprobe_subsampler_old_pyav(monkeypatch):
+    av = pytest.importorskip("av")
+    monkeypatch.delattr(av.stream, "Disposition")
+    subsampler = FFProbeSubsampler(backend="pyav")
+    assert subsampler.backend == "ffprobe"
+
+
+@pytest.mark.parametrize(
+    "encode_format,output_kwargs",
+    [
+        ("mp4", {"vcodec": "libx264"}),
+        ("mp4", {"vcodec": "libx264", "movflags": "frag_keyframe+empty_moov"}),
+        ("webm", {"vcodec": "libvpx-vp9", "deadline": "realtime"}),
+    ],
+)
+def test_keyframe_timestamps_from_index(encode_format, output_kwargs):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        video = os.path.join(tmpdir, f"video.{encode_format}")
+        ffmpeg.input("testsrc2=size=160x120:rate=30:duration=10", f="lavfi").output(video, g=45, **output_kwargs).run(
+            capture_stdout=True, capture_stderr=True
+        )
+        with open(video, "rb") as vid_f:
+            video_bytes = vid_f.read()
+        packets = subprocess.run(
+            ["ffprobe", "-v", "quiet", "-print_format", "csv", "-select_streams", "v:0"]
+            + ["-show_entries", "packet=pts_time,flags", video],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.splitlines()
+
+    keyframe_timestamps = [float(packet.split(",")[1]) for packet in packets if "K" in packet.split(",")[2]]
+    assert container_index.keyframe_timestamps(video_bytes) == keyframe_timestamps
+    # truncated files don't have all the samples of their index
+    assert container_index.keyframe_timestamps(video_bytes[: len(video_bytes) // 2]) is None
+
+    _, metadata, error_message = FFProbeSubsampler(extract_keyframes=True)({"video": [video_bytes]}, {})
+    assert error_message is None
+    assert metadata["video_metadata"]["keyframe_timestamps"][:-1] == keyframe_timestamps
+
 
 def test_whisper_subsampler():
     current_folder = os.path.dirname(__file__)
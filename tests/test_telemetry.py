@@ -0,0 +1,26 @@
+"""test the stats pushed from the workers to the logger"""
+from video2dataset.logger import CappedCounter, write_stats
+from video2dataset.telemetry import TELEMETRY_ENV, TelemetryReceiver, report_sample, report_shard
+
+
+def test_telemetry(tmp_path, monkeypatch):
+    report_sample("success", 10)  # nobody listens, nothing is sent
+
+    receiver = TelemetryReceiver(TelemetryReceiver.new_address())
+    monkeypatch.setenv(TELEMETRY_ENV, receiver.address)
+    try:
+        assert not receiver.receive(timeout=0.01)
+        report_sample("success", 10)
+        report_sample("failed_to_download", 0)
+        report_shard("some/00000_stats.json")
+        for shard_id in [1, "00002_00001"]:  # parts of shards aren't reported
+            write_stats(str(tmp_path), shard_id, 1, 1, 0, 0, 10, 0.0, 1.0, CappedCounter(), 5)
+
+        assert receiver.receive(timeout=1) == [
+            {"type": "sample", "status": "success", "bytes_downloaded": 10},
+            {"type": "sample", "status": "failed_to_download", "bytes_downloaded": 0},
+            {"type": "shard", "stats_file": "some/00000_stats.json"},
+            {"type": "shard", "stats_file": f"{tmp_path}/00001_stats.json"},
+        ]
+    finally:
+        receiver.close()
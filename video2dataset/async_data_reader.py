@@ -0,0 +1,219 @@
+"""asyncio based downloading of direct file links with pooled keep-alive connections"""
+import asyncio
+import os
+import queue
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from video2dataset.data_reader import CHUNK_SIZE, WebFileDownloader, get_file_info
+
+
+class AsyncWebFileDownloader(WebFileDownloader):
+    """Downloader class for mp4 links that runs on an event loop and shares the connections of an aiohttp session
+
+    range_chunk_size: if set, files bigger than this that support range requests are downloaded
+        as ranges of this many bytes in parallel
+    range_concurrency: maximum number of parallel range requests per file
+    """
+
+    def __init__(self, timeout, tmp_dir, encode_formats, range_chunk_size=None, range_concurrency=4):
+        super().__init__(timeout, tmp_dir, encode_formats)
+        self.range_chunk_size = range_chunk_size
+        self.range_concurrency = range_concurrency
+
+    async def _download(self, session, url, path):
+        async with session.get(url) as resp:
+            resp.raise_for_status()
+            with open(path, "wb") as f:
+                async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                    f.write(chunk)
+
+    @staticmethod
+    async def _write_at(resp, fd, offset):
+        async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+
+    async def _download_range(self, session, url, fd, start, end):
+        async with session.get(url, headers={"Range": f"bytes={start}-{end}"}) as resp:
+            if resp.status != 206:
+                raise ValueError(f"range request to {url} returned status {resp.status}")
+            await self._write_at(resp, fd, start)
+
+    async def _download_ranges(self, session, url, path):
+        """
+        Downloads the file as parallel range requests of range_chunk_size bytes written in place. The size of
+        the file comes from the Content-Range of the first range, servers without range support send the whole
+        file in answer to it.
+        """
+        semaphore = asyncio.Semaphore(self.range_concurrency)
+
+        async def download_range(start):
+            async with semaphore:
+                end = min(start + self.range_chunk_size, size) - 1
+                await self._download_range(session, url, fd, start, end)
+
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        try:
+            async with session.get(url, headers={"Range": f"bytes=0-{self.range_chunk_size - 1}"}) as resp:
+                resp.raise_for_status()
+                # "bytes 0-{end}/{size}", the size is "*" when the server doesn't know it
+                total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+                if resp.status == 206 and not total.isdigit():
+                    raise ValueError(f"range request to {url} returned no file size")
+                size = int(total) if resp.status == 206 else 0
+                await self._write_at(resp, fd, 0)
+            await asyncio.gather(
+                *(download_range(start) for start in range(self.range_chunk_size, size, self.range_chunk_size))
+            )
+        finally:
+            os.close(fd)
+
+    async def __call__(self, session, url):  # pylint: disable=invalid-overridden-method
+        ext, modality = get_file_info(url)
+        modality_path = f"{self.tmp_dir}/{str(uuid.uuid4())}.{ext}"
+        try:
+            if self.range_chunk_size:
+                await self._download_ranges(session, url, modality_path)
+            else:
+                await self._download(session, url, modality_path)
+        except BaseException:
+            if os.path.exists(modality_path):
+                os.remove(modality_path)
+            raise
+
+        # audio extraction runs ffmpeg, keep it off the event loop
+        modality_paths = await asyncio.get_running_loop().run_in_executor(
+            None, self.split_modalities, modality, modality_path
+        )
+        return modality_paths, None
+
+
+class AsyncDownloadPool:
+    """
+    Replacement for ThreadPool(thread_count).imap_unordered(data_reader.read, rows) that downloads direct
+    http(s) file links on an asyncio event loop running in a background thread. All downloads share
+    one aiohttp session so connections to a host are kept alive and reused instead of paying for a
+    new TCP + TLS handshake per file. Other links (yt-dlp, local files) still go through the data
+    reader on a pool of thread_count threads.
+
+    async_args:
+        limit: maximum number of open connections (default 256)
+        limit_per_host: maximum number of open connections to the same host (default 16)
+        range_chunk_size: if set, big files are downloaded as parallel range requests of this many bytes
+        range_concurrency: maximum number of parallel range requests per file (default 4)
+    """
+
+    def __init__(self, thread_count, tmp_dir, encode_formats, reading_config):
+        try:
+            import aiohttp  # pylint: disable=import-outside-toplevel
+        except ImportError as e:
+            raise ModuleNotFoundError(
+                "the async downloader requires aiohttp to be installed. Run `pip install aiohttp`."
+            ) from e
+        self._aiohttp = aiohttp
+
+        async_args = reading_config["async_args"]
+        self.limit = async_args.get("limit", 256)
+        self.limit_per_host = async_args.get("limit_per_host", 16)
+        self.timeout = reading_config["timeout"]
+        self.webfile_downloader = AsyncWebFileDownloader(
+            self.timeout,
+            tmp_dir,
+            encode_formats,
+            async_args.get("range_chunk_size", None),
+            async_args.get("range_concurrency", 4),
+        )
+
+        self.executor = ThreadPoolExecutor(thread_count)
+        self.terminated = False
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
+        self.session = asyncio.run_coroutine_threadsafe(self._create_session(), self.loop).result()
+
+    async def _create_session(self):
+        connector = self._aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host)
+        return self._aiohttp.ClientSession(
+            connector=connector,
+            # like the timeout of requests, it bounds connecting and each read but not the whole transfer
+            timeout=self._aiohttp.ClientTimeout(sock_connect=self.timeout, sock_read=self.timeout),
+        )
+
+    async def _read(self, data_reader, row):
+        """Reads a row like data_reader.read, direct links are downloaded on the event loop"""
+        key, url = row
+        if not (url.startswith(("http://", "https://")) and get_file_info(url)):
+            return await self.loop.run_in_executor(self.executor, data_reader.read, row)
+
+        cached = await self.loop.run_in_executor(self.executor, data_reader.read_cache, url)
+        if cached is not None:
+            streams = await self.loop.run_in_executor(self.executor, data_reader.load_streams, cached[0])
+            return key, streams, cached[1], None, True
+
+        try:
+            modality_paths, error_message = await self.webfile_downloader(self.session, url)
+        except Exception as e:  # pylint: disable=(broad-except)
+            modality_paths, error_message = {}, str(e) or repr(e)
+
+        def write_cache_and_load():
+            data_reader.write_cache(url, modality_paths, None, error_message)
+            return data_reader.load_streams(modality_paths)
+
+        streams = await self.loop.run_in_executor(self.executor, write_cache_and_load)
+        return key, streams, None, error_message, False
+
+    def imap_unordered(self, data_reader, rows):
+        """Yields (key, streams, meta_dict, error_message, cache_hit) like data_reader.read as soon as each row is read"""
+        results: queue.Queue = queue.Queue()
+        n_submitted: List[int] = []
+
+        def submit():
+            # rows can block (f.e. on a semaphore limiting samples in flight) so they're pulled in their own thread
+            n_rows = 0
+            try:
+                for row in rows:
+                    future = asyncio.run_coroutine_threadsafe(self._read(data_reader, row), self.loop)
+                    future.add_done_callback(results.put)
+                    n_rows += 1
+            except Exception as err:  # pylint: disable=broad-except
+                results.put(err)  # raised by the consumer
+                return
+            n_submitted.append(n_rows)
+            results.put(None)
+
+        submitter = threading.Thread(target=submit, daemon=True)
+        submitter.start()
+
+        n_done = 0
+        while not n_submitted or n_done < n_submitted[0]:
+            future = results.get()
+            if future is None:
+                continue
+            if isinstance(future, Exception):
+                submitter.join()
+                raise future
+            n_done += 1
+            yield future.result()
+        submitter.join()
+
+    def terminate(self):
+        if self.terminated:
+            return
+        self.terminated = True
+        asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.executor.shutdown(wait=False)
+
+    def join(self):
+        self.loop_thread.join()
+        if not self.loop.is_closed():
+            self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.terminate()
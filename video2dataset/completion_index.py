@@ -0,0 +1,111 @@
+"""completion index records which shards are done so resuming and logging don't need to list the output folder"""
+
+import os
+import struct
+import uuid
+
+import fsspec
+import numpy as np
+from fsspec.implementations.local import LocalFileSystem
+
+
+RECORD = struct.Struct("<I")
+OFFSET = struct.Struct("<Q")
+
+
+class CompletionIndex:
+    """
+    Append only index of the shards that are done, kept in {output_folder}/_index
+
+    - journal: the id of each shard that is done, appended as a 4 bytes record with a single O_APPEND write
+        which is atomic on local file systems and on shared ones like Lustre
+    - bitmap: snapshot of the journal written by compact(), the journal length it covers followed by one bit
+        per shard id, so reading the index costs number of shards / 8 bytes plus the journal written since
+
+    The index is only updated once create() was called for the output folder (see record_done_shard).
+    """
+
+    def __init__(self, output_folder):
+        fs, output_path = fsspec.core.url_to_fs(output_folder)
+        if not isinstance(fs, LocalFileSystem):
+            raise ValueError("The completion index needs the output folder on a local or shared POSIX file system")
+        self.index_path = os.path.join(output_path, "_index")
+        self.journal_path = os.path.join(self.index_path, "journal")
+        self.bitmap_path = os.path.join(self.index_path, "bitmap")
+
+    def exists(self):
+        return os.path.isdir(self.index_path)
+
+    def create(self, done_shards=()):
+        """Create the index, done_shards (f.e. found from the stats files of an older run) are snapshotted"""
+        os.makedirs(self.index_path, exist_ok=True)
+        if done_shards:
+            self._write_bitmap(self.journal_size(), set(done_shards))
+
+    def add(self, shard_id):
+        fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, RECORD.pack(shard_id))
+        finally:
+            os.close(fd)
+
+    def journal_size(self):
+        """Length in bytes of the complete records in the journal"""
+        try:
+            size = os.path.getsize(self.journal_path)
+        except FileNotFoundError:
+            return 0
+        return size - size % RECORD.size
+
+    def read_journal(self, offset=0):
+        """Returns the shard ids recorded after offset in the journal and the offset to continue from"""
+        end = self.journal_size()
+        if end <= offset:
+            return [], offset
+        with open(self.journal_path, "rb") as f:
+            f.seek(offset)
+            data = f.read(end - offset)
+        return [shard_id for (shard_id,) in RECORD.iter_unpack(data)], end
+
+    def _read_bitmap(self):
+        try:
+            with open(self.bitmap_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return 0, set()
+        (offset,) = OFFSET.unpack(data[: OFFSET.size])
+        bits = np.unpackbits(np.frombuffer(data[OFFSET.size :], dtype=np.uint8), bitorder="little")
+        return offset, set(np.flatnonzero(bits).tolist())
+
+    def _write_bitmap(self, offset, done_shards):
+        bits = np.zeros(max(done_shards, default=-1) + 1, dtype=bool)
+        bits[list(done_shards)] = True
+        # written next to the bitmap and renamed over it so readers never see a partial snapshot
+        tmp_path = f"{self.bitmap_path}.{uuid.uuid4()}"
+        with open(tmp_path, "wb") as f:
+            f.write(OFFSET.pack(offset))
+            f.write(np.packbits(bits, bitorder="little").tobytes())
+        os.replace(tmp_path, self.bitmap_path)
+
+    def done_shards(self):
+        """Ids of all the shards that are done"""
+        offset, done_shards = self._read_bitmap()
+        shard_ids, _ = self.read_journal(offset)
+        return done_shards | set(shard_ids)
+
+    def compact(self):
+        """Snapshot the journal in the bitmap so later reads only need the journal written after this"""
+        offset, done_shards = self._read_bitmap()
+        shard_ids, offset = self.read_journal(offset)
+        if shard_ids:
+            self._write_bitmap(offset, done_shards | set(shard_ids))
+
+
+def record_done_shard(output_folder, shard_id):
+    """Add the shard to the completion index of the output folder if it has one"""
+    fs, _ = fsspec.core.url_to_fs(output_folder)
+    if not isinstance(fs, LocalFileSystem):
+        return
+    index = CompletionIndex(output_folder)
+    if index.exists():
+        index.add(shard_id)
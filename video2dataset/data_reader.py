@@ -1,17 +1,42 @@
 """classes and functions for downloading videos"""
+import copy
+import json
 import os
+import shutil
+import threading
 import uuid
+from collections import defaultdict
+from contextlib import contextmanager
 import requests
 import yt_dlp
 import io
 import webvtt
 import ffmpeg
 
+try:
+    import av
+except ImportError:  # streams are counted with ffprobe instead
+    av = None
+
+from video2dataset.download_cache import DownloadCache
+from video2dataset.v2d_types import FileStream
+
+
+CHUNK_SIZE = 1 << 20  # bytes held in memory at once while streaming a download to disk
+
+
+def count_streams(path):
+    """number of streams of a media file, read in process when PyAV is installed instead of forking ffprobe"""
+    if av is None:
+        return len(ffmpeg.probe(path)["streams"])
+    with av.open(path) as container:
+        return len(container.streams)
+
 
 def video2audio(video, audio_format, tmp_dir):
     """extract audio from video"""
     path = f"{tmp_dir}/{str(uuid.uuid4())}.{audio_format}"
-    num_streams = len(ffmpeg.probe(video)["streams"])
+    num_streams = count_streams(video)
     ffmpeg_args = {"f": audio_format}
 
     if int(num_streams) > 1:  # video has audio stream
@@ -52,7 +77,61 @@ def sub_to_dict(sub, dedupe=True, single=False) -> list:
     return dicts
 
 
-def get_yt_meta(url, yt_metadata_args: dict) -> dict:
+class YoutubeDLPool:
+    """Thread safe pool of yt_dlp.YoutubeDL instances that get reused for calls with the same options instead of
+    being created (loading extractors, cookies, network config) for every url
+
+    max_uses: number of calls after which an instance gets closed and replaced, instances are also replaced if
+        they raise. max_uses=1 creates a new instance for every call
+    """
+
+    def __init__(self, max_uses=100):
+        self.max_uses = max_uses
+        self._lock = threading.Lock()
+        self._idle = defaultdict(list)  # options key -> [(ydl, uses)]
+
+    def __getstate__(self):
+        # instances hold network handles, a pool sent to another process starts empty
+        return {"max_uses": self.max_uses}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @contextmanager
+    def get(self, ydl_opts):
+        """Checks out an instance created with ydl_opts, outtmpl is set per call so it doesn't split the pool"""
+        ydl_opts = dict(ydl_opts)
+        outtmpl = ydl_opts.pop("outtmpl", None)
+        key = json.dumps(ydl_opts, sort_keys=True, default=str)
+
+        with self._lock:
+            ydl, uses = self._idle[key].pop() if self._idle[key] else (None, 0)
+        if ydl is None:
+            ydl = yt_dlp.YoutubeDL(ydl_opts)
+        if outtmpl is not None:
+            ydl.params["outtmpl"]["default"] = outtmpl
+
+        try:
+            yield ydl
+        except BaseException:
+            ydl.close()
+            raise
+
+        if uses + 1 >= self.max_uses:
+            ydl.close()
+            return
+        with self._lock:
+            self._idle[key].append((ydl, uses + 1))
+
+    def close(self):
+        with self._lock:
+            for ydls in self._idle.values():
+                for ydl, _ in ydls:
+                    ydl.close()
+            self._idle.clear()
+
+
+def get_yt_meta(url, yt_metadata_args: dict, ydl_pool=None) -> dict:
     """Return yt meta dict with meta data and/or subtitles
     yt_metadata_args is a dict of follwing format:
     yt_metadata_args = {
@@ -66,43 +145,50 @@ def get_yt_meta(url, yt_metadata_args: dict) -> dict:
     writeautomaticsub: Write the automatically generated subtitles to a file
     subtitleslangs:    List of languages of the subtitles to download.
     get_info:          Whether to add info (title, description, tags etc) to the output.
-    """
 
-    write_subs = yt_metadata_args.get("writesubtitles", None)
+    ydl_pool: YoutubeDLPool to take the YoutubeDL instance from, a new one is created if None
+    """
 
     yt_metadata_args["skip_download"] = True
     yt_metadata_args["ignoreerrors"] = True
     yt_metadata_args["quiet"] = True
 
-    info_dict, full_sub_dict = None, None
-
-    with yt_dlp.YoutubeDL(yt_metadata_args) as yt:
+    ydl_pool = ydl_pool if ydl_pool is not None else YoutubeDLPool(max_uses=1)
+    with ydl_pool.get(yt_metadata_args) as yt:
         info_dict = yt.extract_info(url, download=False)
-        if write_subs:
-            full_sub_dict = {}
-            for lang in yt_metadata_args["subtitleslangs"]:
-                if lang not in info_dict["requested_subtitles"]:
-                    continue
-                sub_url = info_dict["requested_subtitles"][lang]["url"]
-                res = requests.get(sub_url, timeout=10)
-                sub = io.TextIOWrapper(io.BytesIO(res.content)).read()
-                full_sub_dict[lang] = sub_to_dict(sub)
 
-                if write_subs == "first":
-                    break
+    return yt_meta_from_info(info_dict, yt_metadata_args)
+
+
+def yt_meta_from_info(info_dict, yt_metadata_args: dict) -> dict:
+    """Builds the yt meta dict (see get_yt_meta) from an info dict extracted with yt_metadata_args,
+    info_dict gets modified so pass a copy if it's still needed"""
+
+    write_subs = yt_metadata_args.get("writesubtitles", None)
+
+    full_sub_dict = None
+    if write_subs:
+        full_sub_dict = {}
+        for lang in yt_metadata_args["subtitleslangs"]:
+            if lang not in info_dict["requested_subtitles"]:
+                continue
+            sub_url = info_dict["requested_subtitles"][lang]["url"]
+            res = requests.get(sub_url, timeout=10)
+            sub = io.TextIOWrapper(io.BytesIO(res.content)).read()
+            full_sub_dict[lang] = sub_to_dict(sub)
+
+            if write_subs == "first":
+                break
 
-        if yt_metadata_args["get_info"]:
-            info_dict.pop("subtitles")
-            info_dict.pop("requested_formats")
-            info_dict.pop("formats")
-            info_dict.pop("thumbnails")
-            info_dict.pop("automatic_captions")
-        else:
-            info_dict = None
+    if yt_metadata_args["get_info"]:
+        for key in ["subtitles", "requested_formats", "formats", "thumbnails", "automatic_captions"]:
+            info_dict.pop(key, None)
+    else:
+        info_dict = None
 
-        yt_meta_dict = {"info": info_dict, "subtitles": full_sub_dict}
+    yt_meta_dict = {"info": info_dict, "subtitles": full_sub_dict}
 
-        return yt_meta_dict
+    return yt_meta_dict
 
 
 def get_file_info(url):
@@ -128,21 +214,27 @@ class WebFileDownloader:
         self.encode_formats = encode_formats
 
     def __call__(self, url):
-        modality_paths = {}
-
         ext, modality = get_file_info(url)
+        modality_path = f"{self.tmp_dir}/{str(uuid.uuid4())}.{ext}"
         if not os.path.isfile(url):
-            resp = requests.get(url, stream=True, timeout=self.timeout)
-            byts = resp.content
+            with requests.get(url, stream=True, timeout=self.timeout) as resp:
+                resp.raise_for_status()  # error pages aren't videos
+                try:
+                    with open(modality_path, "wb") as f:
+                        for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                            f.write(chunk)
+                except BaseException:
+                    if os.path.exists(modality_path):
+                        os.remove(modality_path)
+                    raise
         else:  # local files (don't want to delete)
-            with open(url, "rb") as f:
-                byts = f.read()
+            shutil.copyfile(url, modality_path)
 
-        modality_path = f"{self.tmp_dir}/{str(uuid.uuid4())}.{ext}"
-        with open(modality_path, "wb") as f:
-            f.write(byts)
+        return self.split_modalities(modality, modality_path), None
 
-        modality_paths[modality] = modality_path
+    def split_modalities(self, modality, modality_path):
+        """Extracts the requested modalities from a downloaded file (f.e. audio from a video)"""
+        modality_paths = {modality: modality_path}
 
         if modality == "video" and self.encode_formats.get("audio", None):
             audio_format = self.encode_formats["audio"]
@@ -150,12 +242,12 @@ class WebFileDownloader:
             if audio_path is not None:
                 modality_paths["audio"] = audio_path
 
-        for modality, modality_path in modality_paths.items():
-            if modality not in self.encode_formats:
-                os.remove(modality_path)
-                modality_path.pop(modality)
+        for mod, mod_path in list(modality_paths.items()):
+            if mod not in self.encode_formats:
+                os.remove(mod_path)
+                modality_paths.pop(mod)
 
-        return modality_paths, None
+        return modality_paths
 
 
 class YtDlpDownloader:
@@ -167,33 +259,89 @@ class YtDlpDownloader:
         video_codec: preferred codec for video (e.g. avc1). If unspecified or not available download the default codec
         fps: lower bound for fps. If unspecified or not available download worst quality video satisfies other criteria
         yt_metadata_args: see get_yt_metadata function docstring
+        extract_once: extract the video info only once and download every modality and the metadata from it
+            instead of extracting it again for each of them (default False)
+        ydl_max_uses: number of urls a pooled YoutubeDL instance is used for before it's replaced (default 100),
+            only used by the VideoDataReader which owns the pool
+
+    ydl_pool: YoutubeDLPool to take YoutubeDL instances from, if None a new instance is created for every call
     """
 
     # TODO: maybe we just include height and width in the metadata_args
-    def __init__(self, yt_args, tmp_dir, encode_formats):
+    def __init__(self, yt_args, tmp_dir, encode_formats, ydl_pool=None):
         self.metadata_args = yt_args.get("yt_metadata_args", {})
         self.video_size = yt_args.get("download_size", 360)
         self.audio_rate = yt_args.get("download_audio_rate", 44100)
         self.video_codec = yt_args.get("video_codec", None)
         self.fps = yt_args.get("fps", 0)
+        self.extract_once = yt_args.get("extract_once", False)
+        self.ydl_pool = ydl_pool if ydl_pool is not None else YoutubeDLPool(max_uses=1)
         self.tmp_dir = tmp_dir
         self.encode_formats = encode_formats
 
+    def cache_args(self):
+        """The arguments that change what gets downloaded, part of the key of the download cache"""
+        return {
+            "encode_formats": self.encode_formats,
+            "download_size": self.video_size,
+            "download_audio_rate": self.audio_rate,
+            "video_codec": self.video_codec,
+            "fps": self.fps,
+            "yt_metadata_args": self.metadata_args,
+        }
+
+    def _download_from_info(self, url, format_strings):
+        """Extracts the info of url once and uses it to download each modality and build the metadata"""
+        extract_opts = {**(self.metadata_args or {}), "skip_download": True, "quiet": True, "no_warnings": True}
+        with self.ydl_pool.get(extract_opts) as ydl:
+            info_dict = ydl.extract_info(url, download=False)
+            # without the formats selected for the default format spec so each modality can select its own
+            download_info = ydl.sanitize_info(copy.deepcopy(info_dict))
+
+        modality_paths, error_message = {}, None
+        for modality, (ext, format_string) in format_strings.items():
+            modality_path = f"{self.tmp_dir}/{str(uuid.uuid4())}.{ext}"
+            ydl_opts = {
+                "outtmpl": modality_path,
+                "format": format_string,
+                "quiet": True,
+                "no_warnings": True,
+            }
+            try:
+                with self.ydl_pool.get(ydl_opts) as ydl:
+                    ydl.process_ie_result(copy.deepcopy(download_info), download=True)
+                modality_paths[modality] = modality_path
+            except Exception as e:  # pylint: disable=(broad-except)
+                error_message = error_message or str(e)
+                if os.path.exists(modality_path):
+                    os.remove(modality_path)
+
+        yt_meta_dict = yt_meta_from_info(info_dict, self.metadata_args) if self.metadata_args else {}
+        return modality_paths, yt_meta_dict, error_message
+
     def __call__(self, url):
-        modality_paths = {}
+        modality_paths, error_message = {}, None
 
         # using *= (for contains) instead of = (for exact match) -> allows specifying e.g. avc1 instead of avc1.64001F
         codec_format_string = f"[vcodec*={self.video_codec}]" if self.video_codec else ""
         video_format_string = (
             # worst video quality above minimum size, preferrably with enough fps
             f"(wv*[fps>={self.fps}]/wv*)[height>={self.video_size}][ext=mp4]{codec_format_string}/"
-            # otherwise take best video quality 
+            # otherwise take best video quality
             f"bv/b[ext=mp4]{codec_format_string}"
         )
         audio_fmt_string = (
             f"wa[asr>={self.audio_rate}][ext=m4a] / ba[ext=m4a]" if self.audio_rate > 0 else "ba[ext=m4a]"
         )
 
+        if self.extract_once:
+            format_strings = {}
+            if self.encode_formats.get("audio", None):
+                format_strings["audio"] = ("m4a", audio_fmt_string)
+            if self.encode_formats.get("video", None):
+                format_strings["video"] = ("mp4", video_format_string)
+            return self._download_from_info(url, format_strings)
+
         if self.encode_formats.get("audio", None):
             audio_path_m4a = f"{self.tmp_dir}/{str(uuid.uuid4())}.m4a"
             ydl_opts = {
@@ -204,11 +352,12 @@ class YtDlpDownloader:
 
             err = None
             try:
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                with self.ydl_pool.get(ydl_opts) as ydl:
                     ydl.download(url)
             except Exception as e:  # pylint: disable=(broad-except)
-                err = str(e)
-                os.remove(audio_path_m4a)
+                err = error_message = str(e)
+                if os.path.exists(audio_path_m4a):
+                    os.remove(audio_path_m4a)
 
             if err is None:
                 # TODO: look into this, don't think we can just do this
@@ -228,38 +377,78 @@ class YtDlpDownloader:
 
             err = None
             try:
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                with self.ydl_pool.get(ydl_opts) as ydl:
                     ydl.download(url)
             except Exception as e:  # pylint: disable=(broad-except)
                 err = str(e)
-                os.remove(video_path)
+                error_message = error_message or err
+                if os.path.exists(video_path):
+                    os.remove(video_path)
 
             if err is None:
                 modality_paths["video"] = video_path
 
-        err = None
         try:
             if self.metadata_args:
-                yt_meta_dict = get_yt_meta(url, self.metadata_args)
+                yt_meta_dict = get_yt_meta(url, self.metadata_args, self.ydl_pool)
             else:
                 yt_meta_dict = {}
         except Exception as e:  # pylint: disable=(broad-except)
-            err = str(e)
+            error_message = error_message or str(e)
             yt_meta_dict = {}
 
-        return modality_paths, yt_meta_dict, None
+        # the first error, so the transient ones (429, bot check) get retried and slow the domain down
+        return modality_paths, yt_meta_dict, error_message
 
 
 class VideoDataReader:
-    """Video data reader provide data for a video"""
+    """Video data reader provide data for a video
+
+    stream_files: if True the downloaded files are returned as FileStreams pointing at the temporary
+        files instead of being read into bytes, the caller is then responsible for removing them
+    """
 
-    def __init__(self, encode_formats, tmp_dir, reading_config):
+    def __init__(self, encode_formats, tmp_dir, reading_config, stream_files=False):
         self.webfile_downloader = WebFileDownloader(reading_config["timeout"], tmp_dir, encode_formats)
-        self.yt_downloader = YtDlpDownloader(reading_config["yt_args"], tmp_dir, encode_formats)
+        # lives as long as the reader so YoutubeDL instances get reused across urls
+        self.ydl_pool = YoutubeDLPool(reading_config["yt_args"].get("ydl_max_uses", 100))
+        self.yt_downloader = YtDlpDownloader(reading_config["yt_args"], tmp_dir, encode_formats, self.ydl_pool)
+        self.stream_files = stream_files
+        self.tmp_dir = tmp_dir
+        self.encode_formats = encode_formats
+        cache_args = reading_config.get("cache_args")
+        self.cache = DownloadCache(**cache_args) if cache_args is not None else None
+
+    def cache_key_args(self, url):
+        """The arguments that change what gets downloaded from url"""
+        if get_file_info(url):
+            return {"encode_formats": self.encode_formats}
+        return self.yt_downloader.cache_args()
+
+    def read_cache(self, url):
+        """Files and metadata of url from the download cache, None if they aren't cached"""
+        return self.cache.get(url, self.cache_key_args(url), self.tmp_dir) if self.cache is not None else None
+
+    def write_cache(self, url, modality_paths, meta_dict, error_message):
+        """Adds a successful download to the download cache, partial downloads (missing a modality) aren't cached"""
+        if self.cache is None or error_message is not None or set(modality_paths) != set(self.encode_formats):
+            return
+        try:
+            self.cache.put(url, self.cache_key_args(url), modality_paths, meta_dict)
+        except Exception as e:  # pylint: disable=(broad-except)
+            print(f"failed to cache {url}: {e}")
 
     def __call__(self, row):
+        return self.read(row)[:4]
+
+    def read(self, row):
+        """Like __call__ with whether the row was read from the download cache, (key, streams, meta, error, hit)"""
         key, url = row
 
+        cached = self.read_cache(url)
+        if cached is not None:
+            return key, self.load_streams(cached[0]), cached[1], None, True
+
         meta_dict = None
         try:
             # TODO: make nice function to detect what type of link we're dealing with
@@ -269,11 +458,18 @@ class VideoDataReader:
                 modality_paths, meta_dict, error_message = self.yt_downloader(url)
         except Exception as e:  # pylint: disable=(broad-except)
             modality_paths, meta_dict, error_message = {}, None, str(e)
+        self.write_cache(url, modality_paths, meta_dict, error_message)
 
+        return key, self.load_streams(modality_paths), meta_dict, error_message, False
+
+    def load_streams(self, modality_paths):
+        """Turns downloaded files into streams, reading (and removing) them unless stream_files is set"""
         streams = {}
         for modality, modality_path in modality_paths.items():
+            if self.stream_files:
+                streams[modality] = FileStream(modality_path)
+                continue
             with open(modality_path, "rb") as modality_file:
                 streams[modality] = modality_file.read()
             os.remove(modality_path)
-
-        return key, streams, meta_dict, error_message
+        return streams
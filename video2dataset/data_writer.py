@@ -2,6 +2,9 @@
 
 import json
 import os
+import shutil
+import tarfile
+import time
 
 import fsspec
 import numpy as np
@@ -9,6 +12,51 @@ import pyarrow as pa
 import pyarrow.parquet as pq
 import webdataset as wds
 
+from video2dataset.data_reader import CHUNK_SIZE
+from video2dataset.v2d_types import FileStream
+
+
+def stream_size(stream):
+    """Size in bytes of an in memory or on disk stream"""
+    if isinstance(stream, FileStream):
+        return os.path.getsize(stream.path)
+    return len(stream)
+
+
+def read_stream(stream):
+    """Bytes of a stream, formats that can't be written incrementally have to read FileStreams into memory"""
+    if isinstance(stream, FileStream):
+        with open(stream.path, "rb") as f:
+            return f.read()
+    return stream
+
+
+def merge_parquet(input_files, output_file):
+    """Concatenates parquet files with the same schema in order, one row group at a time"""
+    fs, output_path = fsspec.core.url_to_fs(output_file)
+    parquet_writer = None
+    with fs.open(output_path, "wb") as output_fd:
+        for input_file in input_files:
+            input_fs, input_path = fsspec.core.url_to_fs(input_file)
+            with input_fs.open(input_path, "rb") as f:
+                parquet_file = pq.ParquetFile(f)
+                if parquet_writer is None:
+                    parquet_writer = pq.ParquetWriter(output_fd, parquet_file.schema_arrow)
+                for i in range(parquet_file.num_row_groups):
+                    parquet_writer.write_table(parquet_file.read_row_group(i))
+        if parquet_writer is not None:
+            parquet_writer.close()
+
+
+def concat_files(input_files, output_file):
+    """Concatenates files in order in chunks"""
+    fs, output_path = fsspec.core.url_to_fs(output_file)
+    with fs.open(output_path, "wb") as output_fd:
+        for input_file in input_files:
+            input_fs, input_path = fsspec.core.url_to_fs(input_file)
+            with input_fs.open(input_path, "rb") as f:
+                shutil.copyfileobj(f, output_fd, CHUNK_SIZE)
+
 
 class BufferedParquetWriter:
     """Write samples to parquet files incrementally with a buffer"""
@@ -85,7 +133,7 @@ class ParquetSampleWriter:
         sample = {"key": key}
         for modality, stream in streams.items():
             ext = self.encode_formats[modality] if modality in self.encode_formats else modality
-            sample[ext] = stream
+            sample[ext] = read_stream(stream)
 
         if self.save_caption:
             sample["txt"] = str(caption) if caption is not None else ""
@@ -96,6 +144,13 @@ class ParquetSampleWriter:
     def close(self):
         self.buffered_parquet_writer.close()
 
+    @classmethod
+    def merge(cls, parts_folder, part_names, output_folder, shard_name):
+        """Merges the parts written to parts_folder into one shard, in the order of part_names"""
+        merge_parquet(
+            [f"{parts_folder}/{part}.parquet" for part in part_names], f"{output_folder}/{shard_name}.parquet"
+        )
+
 
 class WebDatasetSampleWriter:
     """WebDatasetSampleWriter is a video+caption writer to webdataset"""
@@ -128,9 +183,13 @@ class WebDatasetSampleWriter:
     def write(self, streams, key, caption, meta):
         """write sample to tars"""
         sample = {"__key__": key}
+        file_streams = {}
         for modality, stream in streams.items():
             ext = self.encode_formats[modality] if modality in self.encode_formats else modality
-            sample[ext] = stream
+            if isinstance(stream, FileStream):
+                file_streams[ext] = stream
+            else:
+                sample[ext] = stream
 
         if self.save_caption:
             sample["txt"] = str(caption) if caption is not None else ""
@@ -141,13 +200,42 @@ class WebDatasetSampleWriter:
         sample["json"] = json.dumps(meta, indent=4)
 
         self.tarwriter.write(sample)
+        for ext, stream in file_streams.items():
+            self._add_file(f"{key}.{ext}", stream.path)
         self.buffered_parquet_writer.write(meta)
 
+    def _add_file(self, name, path):
+        """Copies a file into the tar in chunks so it never has to be fully in memory"""
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.size = os.path.getsize(path)
+        tarinfo.mtime = self.tarwriter.mtime if self.tarwriter.mtime is not None else time.time()
+        tarinfo.mode = self.tarwriter.mode
+        tarinfo.uname = self.tarwriter.user
+        tarinfo.gname = self.tarwriter.group
+        with open(path, "rb") as f:
+            self.tarwriter.tarstream.addfile(tarinfo, f)
+
     def close(self):
         self.buffered_parquet_writer.close()
         self.tarwriter.close()
         self.tar_fd.close()
 
+    @classmethod
+    def merge(cls, parts_folder, part_names, output_folder, shard_name):
+        """Merges the parts written to parts_folder into one shard, in the order of part_names"""
+        fs, output_path = fsspec.core.url_to_fs(output_folder)
+        parts_fs, parts_path = fsspec.core.url_to_fs(parts_folder)
+        with fs.open(f"{output_path}/{shard_name}.tar", "wb") as tar_fd:
+            with tarfile.open(fileobj=tar_fd, mode="w|") as tar:
+                for part in part_names:
+                    with parts_fs.open(f"{parts_path}/{part}.tar", "rb") as f:
+                        with tarfile.open(fileobj=f, mode="r|") as part_tar:
+                            for member in part_tar:
+                                tar.addfile(member, part_tar.extractfile(member))
+        merge_parquet(
+            [f"{parts_folder}/{part}.parquet" for part in part_names], f"{output_folder}/{shard_name}.parquet"
+        )
+
 
 class TFRecordSampleWriter:
     """TFRecordSampleWriter is a video+caption writer to TFRecord"""
@@ -207,7 +295,7 @@ class TFRecordSampleWriter:
         sample = {"key": self._bytes_feature(key.encode())}
         for modality, stream in streams.items():
             ext = self.encode_formats[modality] if modality in self.encode_formats else modality
-            sample[ext] = self._bytes_feature(stream)
+            sample[ext] = self._bytes_feature(read_stream(stream))
 
         if self.save_caption:
             sample["txt"] = self._bytes_feature(str(caption) if caption is not None else "")
@@ -222,6 +310,17 @@ class TFRecordSampleWriter:
         self.buffered_parquet_writer.close()
         self.tf_writer.close()
 
+    @classmethod
+    def merge(cls, parts_folder, part_names, output_folder, shard_name):
+        """Merges the parts written to parts_folder into one shard, in the order of part_names"""
+        # tfrecord files are a plain sequence of records so they can be concatenated
+        concat_files(
+            [f"{parts_folder}/{part}.tfrecord" for part in part_names], f"{output_folder}/{shard_name}.tfrecord"
+        )
+        merge_parquet(
+            [f"{parts_folder}/{part}.parquet" for part in part_names], f"{output_folder}/{shard_name}.parquet"
+        )
+
     def _feature(self, value):
         if isinstance(value, list):
             return self._list_feature(value)
@@ -296,6 +395,9 @@ class FilesSampleWriter:
         for modality, stream in streams.items():
             ext = self.encode_formats[modality] if modality in self.encode_formats else modality
             filename = f"{self.subfolder}/{key}.{ext}"
+            if isinstance(stream, FileStream):
+                self.fs.put_file(stream.path, filename)
+                continue
             with self.fs.open(filename, "wb") as f:
                 f.write(stream)
 
@@ -319,6 +421,21 @@ class FilesSampleWriter:
     def close(self):
         self.buffered_parquet_writer.close()
 
+    @classmethod
+    def merge(cls, parts_folder, part_names, output_folder, shard_name):
+        """Merges the parts written to parts_folder into one shard, in the order of part_names"""
+        # parts live in the _tmp folder of the output folder so they're on the same filesystem
+        fs, subfolder = fsspec.core.url_to_fs(f"{output_folder}/{shard_name}")
+        _, parts_path = fsspec.core.url_to_fs(parts_folder)
+        if not fs.exists(subfolder):
+            fs.mkdir(subfolder)
+        for part in part_names:
+            for path in fs.ls(f"{parts_path}/{part}", detail=False):
+                fs.mv(path, f"{subfolder}/{path.split('/')[-1]}")
+        merge_parquet(
+            [f"{parts_folder}/{part}.parquet" for part in part_names], f"{output_folder}/{shard_name}.parquet"
+        )
+
 
 class DummySampleWriter:
     """Does not write"""
@@ -339,3 +456,7 @@ class DummySampleWriter:
 
     def close(self):
         pass
+
+    @classmethod
+    def merge(cls, parts_folder, part_names, output_folder, shard_name):
+        pass
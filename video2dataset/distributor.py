@@ -1,21 +1,26 @@
 """distributor defines the distribution strategies for img2dataset"""
 
 import os
+import queue
+import threading
 import time
 import subprocess
 import yaml
+from collections import Counter
 from datetime import datetime
 from contextlib import contextmanager
 from multiprocessing import get_context
+from multiprocessing.pool import ThreadPool
 from itertools import islice, chain
 
 import fsspec
 from tqdm import tqdm
 
 
-def retrier(runf, failed_shards, max_shard_retry):
+def retrier(runf, failed_shards, max_shard_retry, input_sharder=None):
     # retry failed shards max_shard_retry times
     for i in range(max_shard_retry):
+        failed_shards = claim_retries(input_sharder, failed_shards)
         if len(failed_shards) == 0:
             break
         print(f"Retrying {len(failed_shards)} shards, try {i+1}")
@@ -27,6 +32,21 @@ def retrier(runf, failed_shards, max_shard_retry):
         )
 
 
+def shard_finished(input_sharder, row, status):
+    """Tells the sampler of the input that a shard it handed out is finished (see SlurmShardClaimer)"""
+    sampler = getattr(input_sharder, "shard_sampler", None)
+    if hasattr(sampler, "shard_finished"):
+        sampler.shard_finished(row[1], status)
+
+
+def claim_retries(input_sharder, rows):
+    """Claims the failed shards again before retrying them, returns the ones that weren't taken by another task"""
+    sampler = getattr(input_sharder, "shard_sampler", None)
+    if not hasattr(sampler, "claim_retry"):
+        return rows
+    return [row for row in rows if sampler.claim_retry(row[1])]
+
+
 def no_distributor(process_count, worker, input_sharder, _, max_shard_retry):  # pylint: disable=unused-argument
     """Go through shards sequentially (useful for when things don't like multiprocessing)"""
 
@@ -34,12 +54,13 @@ def no_distributor(process_count, worker, input_sharder, _, max_shard_retry):  #
         failed_shards = []
         for shard in gen:
             status, row = worker(shard)
+            shard_finished(input_sharder, row, status)
             if status is False:
                 failed_shards.append(row)
         return failed_shards
 
     failed_shards = run(input_sharder)
-    retrier(run, failed_shards, max_shard_retry)
+    retrier(run, failed_shards, max_shard_retry, input_sharder)
 
 
 def multiprocessing_distributor(
@@ -52,19 +73,142 @@ def multiprocessing_distributor(
         def run(gen):
             failed_shards = []
             for status, row in tqdm(process_pool.imap_unordered(worker, gen)):
+                shard_finished(input_sharder, row, status)
                 if status is False:
                     failed_shards.append(row)
             return failed_shards
 
         failed_shards = run(input_sharder)
 
-        retrier(run, failed_shards, max_shard_retry)
+        retrier(run, failed_shards, max_shard_retry, input_sharder)
 
         process_pool.terminate()
         process_pool.join()
         del process_pool
 
 
+def _work_stealing_process(worker, tasks, results, n_threads):
+    """Runs n_threads loops that take parts from the shared queue until they get None"""
+
+    def work():
+        for part in iter(tasks.get, None):
+            results.put(worker.download_shard_part(part))
+
+    threads = [threading.Thread(target=work) for _ in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def work_stealing_distributor(
+    processes_count, worker, input_sharder, _, max_shard_retry, chunk_size=4, chunks_per_process=1
+):
+    """
+    Distribute the work to long lived processes at the granularity of chunks of samples.
+
+    Shards are split into parts of chunk_size samples which go into one shared queue. Each of the
+    processes_count processes works on chunks_per_process parts at a time and takes the next part
+    from the queue as soon as one is done, so idle processes pick up the remaining samples of slow
+    shards instead of waiting for them. The processes (and the worker they unpickled) are kept for
+    the whole run. Once all parts of a shard are downloaded they're merged in sample order into the
+    shard, so the output shards are the same as with the other distributors.
+
+    Only supported by the DownloadWorker (download stage).
+    """
+    ctx = get_context("spawn")
+    tasks = ctx.Queue()
+    results = ctx.Queue()
+    processes = [
+        ctx.Process(target=_work_stealing_process, args=(worker, tasks, results, chunks_per_process))
+        for _ in range(processes_count)
+    ]
+    for process in processes:
+        process.start()
+
+    lock = threading.Lock()
+    shards = {}  # shard_id -> [row, parts, number of parts left]
+    attempts: Counter = Counter()
+    n_pending = [0]
+    feed_errors = []
+
+    def feed():
+        try:
+            for row in input_sharder:
+                parts = worker.shard_parts(row, chunk_size)
+                with lock:
+                    shards[row[1]] = [row, parts, len(parts)]
+                    n_pending[0] += len(parts)
+                for part in parts:
+                    tasks.put(part)
+        except Exception as err:  # pylint: disable=broad-except
+            feed_errors.append(err)
+        finally:
+            results.put(None)
+
+    def merged(result):
+        status, row = result
+        if status is False:
+            print(f"shard {row[0]} failed to merge, you may restart the same command to retry it")
+        progress.update(1)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    failed_parts = []
+    try:
+        with ThreadPool(processes_count) as merge_pool, tqdm(unit="shard") as progress:
+            merges = []
+            feeding_done = False
+            while not feeding_done or n_pending[0] > 0:
+                try:
+                    result = results.get(timeout=10)
+                except queue.Empty:
+                    if not all(process.is_alive() for process in processes):
+                        raise RuntimeError("a work stealing process died")  # pylint: disable=raise-missing-from
+                    continue
+                if result is None:
+                    feeding_done = True
+                    continue
+
+                status, part = result
+                with lock:
+                    n_pending[0] -= 1
+                    if status is False:
+                        if attempts[part] < max_shard_retry:
+                            attempts[part] += 1
+                            n_pending[0] += 1
+                            tasks.put(part)
+                        else:
+                            failed_parts.append(part)
+                        continue
+                    shards[part[1]][2] -= 1
+                    if shards[part[1]][2] > 0:
+                        continue
+                    row, parts, _ = shards.pop(part[1])
+                merges.append(merge_pool.apply_async(worker.merge_shard_parts, (row, parts), callback=merged))
+
+            for merge in merges:
+                merge.wait()
+
+        for _ in range(processes_count * chunks_per_process):
+            tasks.put(None)
+        for process in processes:
+            process.join()
+        feeder.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    if feed_errors:
+        raise feed_errors[0]
+    if len(failed_parts) != 0:
+        print(
+            f"Retried {max_shard_retry} times, but {len(failed_parts)} parts of shards "
+            "still failed. You may restart the same command to retry again."
+        )
+
+
 def pyspark_distributor(
     processes_count, worker, input_sharder, subjob_size, max_shard_retry
 ):
@@ -82,13 +226,14 @@ def pyspark_distributor(
             for batch in batcher(gen, subjob_size):
                 rdd = spark.sparkContext.parallelize(batch, len(batch))
                 for status, row in rdd.map(worker).collect():
+                    shard_finished(input_sharder, row, status)
                     if status is False:
                         failed_shards.append(row)
             return failed_shards
 
         failed_shards = run(input_sharder)
 
-        retrier(run, failed_shards, max_shard_retry)
+        retrier(run, failed_shards, max_shard_retry, input_sharder)
 
 
 @contextmanager
@@ -145,6 +290,174 @@ class SlurmShardSampler:
         return shardlist
 
 
+class SlurmShardClaimer:
+    """
+    Sampler that lets the slurm tasks claim shards as they go instead of the static modulo split of the
+    SlurmShardSampler, so tasks that are done with their shards keep taking new ones until there are none left.
+
+    A shard is claimed by atomically creating {claims_path}/{full_shard_id}.lease, so claims_path needs to be on
+    a file system shared by all tasks that supports O_EXCL (f.e. NFS, Lustre). The leases of the shards a task
+    is working on are renewed every lease_timeout / 4 seconds. A lease that wasn't renewed for lease_timeout
+    seconds belongs to a task that died, so tasks that come across it take the shard over if it isn't done.
+    The distributor reports the shards whose worker returned with shard_finished(), the lease of a shard that
+    failed is released so another task can take the shard over, and taken again with claim_retry() before the
+    distributor retries the shard itself.
+    Tasks start scanning the shards at different offsets so they rarely compete for the same shards.
+
+    :param global_task_id: The global task id for the current task
+    :param num_tasks: The overall number of tasks
+    :param claims_path: folder for the lease files, shared by all the tasks of a job
+    :param output_folder: output folder of the job, a shard is done once its stats file is written there
+    :param oom_shard_count: the order of magnitude of the number of shards, used to find the stats files
+    :param claim_batch_size: number of shards claimed at once
+    :param max_claimed: maximum number of claimed shards that aren't done yet
+    :param lease_timeout: seconds after which a lease that isn't renewed expires
+    """
+
+    def __init__(
+        self,
+        global_task_id,
+        num_tasks,
+        claims_path,
+        output_folder,
+        oom_shard_count,
+        claim_batch_size=4,
+        max_claimed=16,
+        lease_timeout=1800,
+    ):
+        self.task_id = global_task_id
+        self.num_tasks = num_tasks
+        self.claims_path = claims_path
+        self.fs, self.output_path = fsspec.core.url_to_fs(output_folder)
+        self.oom_shard_count = oom_shard_count
+        self.claim_batch_size = claim_batch_size
+        self.max_claimed = max(max_claimed, claim_batch_size)
+        self.lease_timeout = lease_timeout
+        self.lock = threading.Lock()
+        self.claimed = set()  # shards claimed by this task that aren't done yet
+        self.heartbeat = None
+        os.makedirs(self.claims_path, exist_ok=True)
+
+    def _lease_path(self, full_shard_id):
+        return os.path.join(self.claims_path, f"{full_shard_id}.lease")
+
+    def _is_done(self, full_shard_id):
+        shard_name = "{shard_id:0{oom_shard_count}d}".format(  # pylint: disable=consider-using-f-string
+            shard_id=int(full_shard_id), oom_shard_count=self.oom_shard_count
+        )
+        return self.fs.exists(f"{self.output_path}/{shard_name}_stats.json")
+
+    def _is_expired(self, path):
+        return time.time() - os.path.getmtime(path) > self.lease_timeout
+
+    def _try_claim(self, full_shard_id):
+        """Creates the lease of the shard, or takes over its expired lease if it isn't done"""
+        path = self._lease_path(full_shard_id)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return self._try_reclaim(full_shard_id)
+        with os.fdopen(fd, "w") as f:
+            f.write(str(self.task_id))
+        return True
+
+    def _try_reclaim(self, full_shard_id):
+        """Takes over the lease of a shard that isn't done if it expired"""
+        path = self._lease_path(full_shard_id)
+        try:
+            if not self._is_expired(path) or self._is_done(full_shard_id):
+                return False
+            # only one of the tasks racing for an expired lease manages to move it away
+            stale_path = f"{path}.{self.task_id}.stale"
+            os.rename(path, stale_path)
+        except FileNotFoundError:  # another task is taking it over
+            return False
+        if not self._is_expired(stale_path):  # moved away a lease that was just taken over, put it back
+            os.rename(stale_path, path)
+            return False
+        os.remove(stale_path)
+        print(f"task {self.task_id} reclaiming shard {full_shard_id} from an expired lease")
+        return self._try_claim(full_shard_id)
+
+    def _renew_leases(self):
+        while True:
+            time.sleep(self.lease_timeout / 4)
+            with self.lock:
+                for full_shard_id in list(self.claimed):
+                    os.utime(self._lease_path(full_shard_id))
+
+    def shard_finished(self, full_shard_id, success):
+        """The worker of a shard returned, the shard is done if it succeeded, else its lease is released"""
+        with self.lock:
+            self.claimed.discard(full_shard_id)
+            if success:
+                return
+            path = self._lease_path(full_shard_id)
+            try:
+                with open(path, encoding="utf-8") as f:
+                    if f.read() == str(self.task_id):  # else it expired and another task took the shard over
+                        os.remove(path)
+            except FileNotFoundError:
+                pass
+        print(f"task {self.task_id} releasing failed shard {full_shard_id}")
+
+    def claim_retry(self, full_shard_id):
+        """Claims a failed shard again before retrying it, returns False if another task took it over"""
+        with self.lock:
+            if not self._try_claim(full_shard_id):
+                return False
+            self.claimed.add(full_shard_id)
+        return True
+
+    def _wait_for_room(self):
+        """
+        Waits until claiming another batch keeps the number of claimed shards that aren't done under max_claimed,
+        at most lease_timeout seconds in case the workers of some shards never return
+        """
+        deadline = time.monotonic() + self.lease_timeout
+        while True:
+            with self.lock:
+                self.claimed = {s for s in self.claimed if not self._is_done(s)}
+                if len(self.claimed) + self.claim_batch_size <= self.max_claimed:
+                    return
+            if time.monotonic() > deadline:
+                print(f"task {self.task_id} claiming more shards after waiting {self.lease_timeout}s for room")
+                return
+            time.sleep(min(5, self.lease_timeout))
+
+    def _claim_batch(self, shards):
+        """Claims up to claim_batch_size of the shards, returns the claimed, skipped and remaining shards"""
+        claimed, skipped = [], []
+        for i, shard in enumerate(shards):
+            if len(claimed) == self.claim_batch_size:
+                return claimed, skipped, shards[i:]
+            (claimed if self._try_claim(shard[0]) else skipped).append(shard)
+        return claimed, skipped, []
+
+    def _claim(self, shardfile_list):
+        """Yields the shards as they get claimed, in batches of claim_batch_size"""
+        if self.heartbeat is None:
+            self.heartbeat = threading.Thread(target=self._renew_leases, daemon=True)
+            self.heartbeat.start()
+
+        offset = len(shardfile_list) * self.task_id // self.num_tasks
+        to_try = shardfile_list[offset:] + shardfile_list[:offset]
+        # second pass over the shards claimed by other tasks in case their lease expired in the meantime
+        for _ in range(2):
+            all_skipped = []
+            while to_try:
+                self._wait_for_room()
+                batch, skipped, to_try = self._claim_batch(to_try)
+                all_skipped += skipped
+                with self.lock:
+                    self.claimed.update(full_shard_id for full_shard_id, _ in batch)
+                yield from batch
+            to_try = all_skipped
+
+    def __call__(self, shardfile_list):
+        return self._claim(list(shardfile_list))
+
+
 class SlurmDistributor:
     """Parallelism via slurm"""
 
@@ -167,10 +480,20 @@ class SlurmDistributor:
         timeout=240,
         reservation=None,
         verbose_wait=False,
+        shard_assignment="modulo",
+        claim_batch_size=4,  # pylint: disable=unused-argument
+        max_claimed=None,  # pylint: disable=unused-argument
+        lease_timeout=1800,  # pylint: disable=unused-argument
     ):
         """
         timeout - This is the timeout in MINUTES.
+        shard_assignment - how the tasks split the shards, "modulo" (static, shard_id % num_tasks) or
+            "claim" (tasks claim shards as they go with lease files in cache_path, see SlurmShardClaimer)
+        claim_batch_size, max_claimed, lease_timeout - see SlurmShardClaimer, only used with "claim" and read
+            from the config by the tasks
         """
+        if shard_assignment not in ("modulo", "claim"):
+            raise ValueError(f"Unknown shard_assignment {shard_assignment}")
         self.cpus_per_task = cpus_per_task
         self.job_name = job_name
         self.partition = partition
@@ -0,0 +1,165 @@
+"""cache of downloaded files shared between the workers and runs, so the same video is only downloaded once"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from urllib.parse import parse_qs, urlparse, urlunparse
+
+import fsspec
+from fsspec.implementations.local import LocalFileSystem
+
+
+YOUTUBE_HOSTS = {"youtube.com", "www.youtube.com", "m.youtube.com", "music.youtube.com"}
+
+
+def normalize_url(url):
+    """Same string for the urls that point to the same video (f.e. youtu.be/ID and youtube.com/watch?v=ID)"""
+    parsed = urlparse(url.strip())
+    host = parsed.netloc.lower()
+    if host in YOUTUBE_HOSTS:
+        video_id = parse_qs(parsed.query).get("v", [None])[0]
+        if video_id is None and parsed.path.startswith(("/shorts/", "/embed/", "/live/")):
+            video_id = parsed.path.split("/")[2]
+        if video_id:
+            return f"youtube:{video_id}"
+    if host == "youtu.be" and parsed.path.strip("/"):
+        return f"youtube:{parsed.path.strip('/')}"
+    if not parsed.scheme:  # local file or bare id
+        return url.strip()
+    return urlunparse((parsed.scheme.lower(), host, parsed.path, parsed.params, parsed.query, ""))
+
+
+class DownloadCache:
+    """
+    Downloaded files keyed by the hash of the normalized url and the arguments that change what gets downloaded
+    (formats, size, codec...), in a local or fsspec folder shared by the workers and by successive runs. The
+    least recently used entries are evicted once the cache is bigger than max_size.
+
+    Each entry is a folder {cache_dir}/{hash[:2]}/{hash} with one file per modality, meta.json (the modality
+    files and the metadata returned by the downloader) and last_used (the time of the last read, for eviction).
+    Entries are written in a {hash}.{uuid}.tmp folder renamed into place once complete, and never overwritten,
+    so readers (which may hard link the files) never see a partial entry.
+
+    cache_dir: folder of the cache
+    max_size: maximum size of the cache in bytes, None for no limit
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.fs, self.cache_path = fsspec.core.url_to_fs(cache_dir)
+        self.fs.makedirs(self.cache_path, exist_ok=True)
+        # estimated size of the cache, it's only listed (and evicted from) when it might be too big
+        self.size = None
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"cache_dir": self.cache_dir, "max_size": self.max_size}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def entry_path(self, url, args):
+        digest = hashlib.sha256(json.dumps([normalize_url(url), args], sort_keys=True).encode()).hexdigest()
+        return f"{self.cache_path}/{digest[:2]}/{digest}"
+
+    def _copy_out(self, path, local_path):
+        if isinstance(self.fs, LocalFileSystem):
+            try:
+                os.link(path, local_path)  # no copy when the cache is on the same file system
+                return
+            except OSError:
+                pass
+            shutil.copyfile(path, local_path)
+        else:
+            self.fs.get(path, local_path)
+
+    def get(self, url, args, tmp_dir):
+        """Copies the cached files of url to tmp_dir, returns (modality_paths, meta_dict), or None if not cached"""
+        entry = self.entry_path(url, args)
+        modality_paths = {}
+        try:
+            with self.fs.open(f"{entry}/meta.json", "r") as f:
+                cached = json.load(f)
+            for modality, name in cached["files"].items():
+                modality_paths[modality] = f"{tmp_dir}/{uuid.uuid4()}{os.path.splitext(name)[1]}"
+                self._copy_out(f"{entry}/{name}", modality_paths[modality])
+        except FileNotFoundError:  # not cached or evicted meanwhile
+            for path in modality_paths.values():
+                if os.path.exists(path):
+                    os.remove(path)
+            return None
+        self.fs.pipe(f"{entry}/last_used", str(time.time()).encode())
+        return modality_paths, cached["meta_dict"]
+
+    def put(self, url, args, modality_paths, meta_dict):
+        """Adds the downloaded files of url to the cache, the files are copied and stay where they are"""
+        entry = self.entry_path(url, args)
+        if self.fs.exists(f"{entry}/meta.json"):  # cached by another worker meanwhile
+            return
+        tmp_entry = f"{entry}.{uuid.uuid4().hex}.tmp"
+        files = {}
+        size = 0
+        self.fs.makedirs(tmp_entry, exist_ok=True)
+        for modality, path in modality_paths.items():
+            files[modality] = f"{modality}{os.path.splitext(path)[1]}"
+            self.fs.put(path, f"{tmp_entry}/{files[modality]}")
+            size += os.path.getsize(path)
+        last_used = str(time.time()).encode()
+        meta = json.dumps({"files": files, "meta_dict": meta_dict}, default=str).encode()
+        self.fs.pipe(f"{tmp_entry}/last_used", last_used)
+        self.fs.pipe(f"{tmp_entry}/meta.json", meta)
+        size += len(last_used) + len(meta)
+        if not self._rename(tmp_entry, entry):
+            self.fs.rm(tmp_entry, recursive=True)
+            return
+
+        if self.max_size is None:
+            return
+        with self.lock:
+            if self.size is not None:
+                self.size += size
+            if self.size is None or self.size > self.max_size:
+                self.size = self.evict()
+
+    def _rename(self, tmp_entry, entry):
+        """Moves tmp_entry to entry, returns False if entry was written by another worker meanwhile"""
+        if isinstance(self.fs, LocalFileSystem):
+            try:
+                os.rename(tmp_entry, entry)  # atomic, fails if entry is a non empty folder
+                return True
+            except OSError:
+                return False
+        if self.fs.exists(f"{entry}/meta.json"):
+            return False
+        self.fs.mv(tmp_entry, entry, recursive=True)
+        return True
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in max_size, returns its size"""
+        entries = {}
+        for path, info in self.fs.find(self.cache_path, detail=True).items():
+            entry = path.rsplit("/", 1)[0]
+            if entry.endswith(".tmp"):  # being written
+                continue
+            entries[entry] = entries.get(entry, 0) + info["size"]
+        size = sum(entries.values())
+        if size <= self.max_size:
+            return size
+
+        last_used = {}
+        for path, value in self.fs.cat([f"{entry}/last_used" for entry in entries], on_error="return").items():
+            last_used[path.rsplit("/", 1)[0]] = float(value) if isinstance(value, bytes) else 0.0
+        for entry in sorted(entries, key=lambda e: last_used.get(e, 0.0)):
+            if size <= self.max_size:
+                break
+            try:
+                self.fs.rm(entry, recursive=True)
+            except FileNotFoundError:  # evicted by another worker
+                pass
+            size -= entries[entry]
+        return size
@@ -4,11 +4,51 @@ from multiprocessing.pool import ThreadPool
 import math
 import fsspec
 import time
+import zlib
 import pyarrow.parquet as pq
 import pyarrow.csv as csv_pq
 import pyarrow as pa
+import pyarrow.compute as pc
 import pandas as pd
 
+from video2dataset.v2d_types import ParquetShard
+
+
+def _read_parquet_shard(shard, start, end):
+    """Read rows [start, end) of a parquet shard, only reading the row groups that contain them"""
+    first_row, last_row = shard.offset + start, shard.offset + end
+    fs, path = fsspec.core.url_to_fs(shard.path)
+    with fs.open(path, "rb") as file:
+        parquet_file = pq.ParquetFile(file)
+        row_groups, row_groups_start, row = [], 0, 0
+        for i in range(parquet_file.metadata.num_row_groups):
+            num_rows = parquet_file.metadata.row_group(i).num_rows
+            if row < last_row and row + num_rows > first_row:
+                if not row_groups:
+                    row_groups_start = row
+                row_groups.append(i)
+            row += num_rows
+        df = parquet_file.read_row_groups(row_groups, columns=list(shard.columns))
+    return df.slice(first_row - row_groups_start, last_row - first_row).rename_columns(list(shard.names))
+
+
+def read_shard(shard_file, start=0, end=None):
+    """Read rows [start, end) of a shard from its feather file or parquet descriptor"""
+    if isinstance(shard_file, ParquetShard):
+        return _read_parquet_shard(shard_file, start, shard_file.num_rows if end is None else end)
+    fs, shard_path = fsspec.core.url_to_fs(shard_file)
+    with fs.open(shard_path, "rb") as f:
+        df = pa.ipc.open_file(f).read_all()
+    return df if end is None else df.slice(start, end - start)
+
+
+def remove_shard(shard_file):
+    """Remove the feather file of a shard once it's done, parquet descriptors point to the input so there's nothing to do"""
+    if isinstance(shard_file, ParquetShard):
+        return
+    fs, shard_path = fsspec.core.url_to_fs(shard_file)
+    fs.rm(shard_path)
+
 
 class InputSharder:
     """
@@ -23,6 +63,15 @@ class InputSharder:
     - save_additional_columns: the list of additional columns to save
     - number_sample_per_shard: the number of samples per shard
     - done_shards: a set of already done shards
+    - stream_input: read the input files in batches and write each shard as soon as it's read instead of loading
+        whole input files in memory first (json input has to be line delimited)
+    - parquet_shard_descriptors: for parquet input, yield ParquetShard descriptors that the workers read straight
+        from the input file instead of writing each shard to a feather file
+    - group_by_url: put the rows that share a url in the same shard, where they're served by a single download
+        (shards can then have a few less than number_sample_per_shard rows)
+    - url_partitions: with stream_input and group_by_url, the rows are hash partitioned by url in this many
+        partitions that each fill up their own shards, so rows of a url only end up in different shards when
+        they're far apart in the input
     """
 
     def __init__(
@@ -37,6 +86,10 @@ class InputSharder:
         done_shards,
         tmp_path,
         sampler=lambda x: x,
+        stream_input=False,
+        parquet_shard_descriptors=False,
+        group_by_url=False,
+        url_partitions=16,
     ) -> None:
         self.input_format = input_format
         self.url_col = url_col
@@ -46,6 +99,14 @@ class InputSharder:
         self.number_sample_per_shard = number_sample_per_shard
         self.done_shards = done_shards
         self.shard_sampler = sampler
+        self.stream_input = stream_input
+        self.parquet_shard_descriptors = parquet_shard_descriptors
+        self.group_by_url = group_by_url
+        self.url_partitions = url_partitions
+        if parquet_shard_descriptors and input_format != "parquet":
+            raise ValueError("parquet_shard_descriptors is only supported for parquet input")
+        if parquet_shard_descriptors and group_by_url:
+            raise ValueError("group_by_url can't be used with parquet_shard_descriptors, shards are ranges of rows")
 
         fs, url_path = fsspec.core.url_to_fs(url_list)
         self.fs = fs
@@ -68,6 +129,187 @@ class InputSharder:
         else:
             raise ValueError(f"Invalid input format {self.input_format}")
 
+    def _columns_to_read(self):
+        """Names of the input columns that end up in the shards"""
+        columns_to_read = [self.url_col]
+        if self.caption_col is not None:
+            columns_to_read += [self.caption_col]
+        if self.clip_col is not None:
+            columns_to_read += [self.clip_col]
+        if self.save_additional_columns is not None:
+            columns_to_read += self.save_additional_columns
+        return columns_to_read
+
+    def _rename_columns(self, df):
+        column_names = df.column_names
+        if self.caption_col is not None:
+            column_names = [c if c != self.caption_col else "caption" for c in column_names]
+        if self.clip_col is not None:
+            column_names = [c if c != self.clip_col else "clips" for c in column_names]
+        column_names = [c if c != self.url_col else "url" for c in column_names]
+        return df.rename_columns(column_names)
+
+    def _write_shard(self, df_shard, full_shard_id):
+        """Write the rows of a shard to an arrow file in the temporary directory"""
+        tmp_file = self.tmp_path + f"/{full_shard_id}.feather"
+        for i in range(10):
+            try:
+                fs, tmp_path = fsspec.core.url_to_fs(tmp_file)
+                with fs.open(tmp_path, "wb") as file:
+                    with pa.ipc.new_file(file, df_shard.schema) as writer:
+                        writer.write_table(df_shard)
+                return (full_shard_id, tmp_file)
+            except Exception as e:  # pylint: disable=broad-except
+                if i != 9:
+                    print("retrying to write to file due to error:", e)
+                    time.sleep(1)
+                else:
+                    raise e
+        # can't reach here
+        raise ValueError("Failed to write to file.")
+
+    def _iter_batches(self, input_file):
+        """Read the input file as a stream of record batches"""
+        if self.input_format in ["txt", "csv", "tsv", "tsv.gz"]:
+            if self.input_format == "txt":
+                read_options = csv_pq.ReadOptions(column_names=["url"])
+                convert_options = csv_pq.ConvertOptions(column_types={"url": pa.string()})
+            else:
+                read_options = csv_pq.ReadOptions()
+                # types are inferred from the first block, make sure later blocks can't conflict for text columns
+                text_columns = [c for c in [self.url_col, self.caption_col] if c is not None]
+                convert_options = csv_pq.ConvertOptions(
+                    column_types={c: pa.string() for c in text_columns}, include_columns=self._columns_to_read()
+                )
+            delimiter = "," if self.input_format == "csv" else "\t"
+            compression = "gzip" if self.input_format == "tsv.gz" else None
+            with self.fs.open(input_file, mode="rb", compression=compression) as file:
+                yield from csv_pq.open_csv(
+                    file,
+                    read_options=read_options,
+                    parse_options=csv_pq.ParseOptions(delimiter=delimiter),
+                    convert_options=convert_options,
+                )
+        elif self.input_format == "json":
+            with self.fs.open(input_file, mode="rb") as file:
+                schema = None
+                for df in pd.read_json(file, lines=True, chunksize=self.number_sample_per_shard):
+                    batch = pa.RecordBatch.from_pandas(df[self._columns_to_read()], schema=schema, preserve_index=False)
+                    schema = batch.schema
+                    yield batch
+        elif self.input_format == "parquet":
+            with self.fs.open(input_file, mode="rb") as file:
+                yield from pq.ParquetFile(file).iter_batches(
+                    batch_size=self.number_sample_per_shard, columns=self._columns_to_read()
+                )
+        else:
+            raise ValueError(f"Unknown input format {self.input_format}")
+
+    def _plan_url_groups(self, urls):
+        """
+        Row indices of each shard, the rows of a url are kept together in the shard of its first row unless
+        they don't fit in a whole shard. Shards are filled in input order
+        """
+        groups = {}
+        for i, url in enumerate(urls):
+            groups.setdefault(url, []).append(i)
+
+        shards, shard = [], []
+        for group in groups.values():
+            if len(shard) + len(group) > self.number_sample_per_shard and shard:
+                shards.append(shard)
+                shard = []
+            while len(group) > self.number_sample_per_shard:
+                shards.append(group[: self.number_sample_per_shard])
+                group = group[self.number_sample_per_shard :]
+            shard += group
+        if shard:
+            shards.append(shard)
+        return shards
+
+    def _iter_url_partitioned_tables(self, input_file):
+        """Regroup the record batches of the input file into tables of number_sample_per_shard rows of a partition"""
+        partitions = [[] for _ in range(self.url_partitions)]
+        partition_rows = [0] * self.url_partitions
+        url_col = self.url_col if self.input_format != "txt" else "url"
+        for batch in self._iter_batches(input_file):
+            urls = batch.column(url_col).to_pylist()
+            # a stable hash, so the shards are the same when resuming
+            partition_ids = pa.array([zlib.crc32(str(url).encode()) % self.url_partitions for url in urls])
+            for p in sorted(set(partition_ids.to_pylist())):
+                rows = batch.filter(pc.equal(partition_ids, p))
+                partitions[p].append(rows)
+                partition_rows[p] += rows.num_rows
+                if partition_rows[p] >= self.number_sample_per_shard:
+                    df = pa.Table.from_batches(partitions[p])
+                    plan = self._plan_url_groups(df.column(url_col).to_pylist())
+                    # the last shard of the plan is held back since more rows of its urls may come
+                    for indices in plan[:-1]:
+                        yield df.take(indices)
+                    df = df.take(plan[-1])
+                    partitions[p], partition_rows[p] = df.to_batches(), df.num_rows
+        for batches in partitions:
+            if batches:
+                df = pa.Table.from_batches(batches)
+                for indices in self._plan_url_groups(df.column(url_col).to_pylist()):
+                    yield df.take(indices)
+
+    def _iter_shard_tables(self, input_file):
+        """Regroup the record batches of the input file into tables of number_sample_per_shard rows"""
+        if self.group_by_url:
+            yield from self._iter_url_partitioned_tables(input_file)
+            return
+        batches, number_rows = [], 0
+        for batch in self._iter_batches(input_file):
+            batches.append(batch)
+            number_rows += batch.num_rows
+            while number_rows >= self.number_sample_per_shard:
+                df = pa.Table.from_batches(batches)
+                yield df.slice(0, self.number_sample_per_shard)
+                df = df.slice(self.number_sample_per_shard)
+                batches, number_rows = df.to_batches(), df.num_rows
+        if number_rows > 0:
+            yield pa.Table.from_batches(batches)
+
+    def _stream_to_arrow(self, input_file, start_shard_id):
+        """Write the shards of the input file to arrow files as soon as they're read, returns the number of shards"""
+        number_shards = 0
+        for shard_id, df in enumerate(self._iter_shard_tables(input_file)):
+            number_shards += 1
+            if start_shard_id + shard_id in self.done_shards:
+                continue
+            for full_shard_id, _ in self.shard_sampler([(start_shard_id + shard_id, shard_id)]):
+                full_shard_id, arrow_file = self._write_shard(
+                    self._rename_columns(df).select(self.column_list), full_shard_id
+                )
+                yield (arrow_file, full_shard_id)
+        return number_shards
+
+    def _parquet_descriptors(self, input_file, start_shard_id):
+        """Describe the shards of a parquet input file by their rows, only the parquet footer is read"""
+        with self.fs.open(input_file, mode="rb") as file:
+            number_samples = pq.ParquetFile(file).metadata.num_rows
+
+        number_shards = math.ceil(number_samples / self.number_sample_per_shard)
+        shards_to_write = [
+            (start_shard_id + shard_id, shard_id)
+            for shard_id in range(number_shards)
+            if start_shard_id + shard_id not in self.done_shards
+        ]
+        shards_to_write = self.shard_sampler(shards_to_write)
+
+        input_names = {"url": self.url_col, "caption": self.caption_col, "clips": self.clip_col}
+        columns = tuple(input_names.get(name, name) for name in self.column_list)
+        path = self.fs.unstrip_protocol(input_file)
+
+        def describe_shard(t):
+            full_shard_id, shard_id = t
+            offset = shard_id * self.number_sample_per_shard
+            num_rows = min(number_samples, offset + self.number_sample_per_shard) - offset
+            return (full_shard_id, ParquetShard(path, offset, num_rows, columns, tuple(self.column_list)))
+
+        return (describe_shard(shard) for shard in shards_to_write), number_shards
+
     def _save_to_arrow(self, input_file, start_shard_id):
         """Read the input file and save to arrow files in a temporary directory"""
         if self.input_format in ["txt", "json", "csv", "tsv"]:
@@ -87,29 +329,20 @@ class InputSharder:
                 df = csv_pq.read_csv(file, parse_options=csv_pq.ParseOptions(delimiter="\t"))
         elif self.input_format == "parquet":
             with self.fs.open(input_file, mode="rb") as file:
-                columns_to_read = [self.url_col]
-                if self.caption_col is not None:
-                    columns_to_read += [self.caption_col]
-                if self.clip_col is not None:
-                    columns_to_read += [self.clip_col]
-                if self.save_additional_columns is not None:
-                    columns_to_read += self.save_additional_columns
-                df = pq.read_table(file, columns=columns_to_read)
+                df = pq.read_table(file, columns=self._columns_to_read())
         else:
             raise ValueError(f"Unknown input format {self.input_format}")
 
-        column_names = df.column_names
-        if self.caption_col is not None:
-            column_names = [c if c != self.caption_col else "caption" for c in column_names]
-        if self.clip_col is not None:
-            column_names = [c if c != self.clip_col else "clips" for c in column_names]
-        column_names = [c if c != self.url_col else "url" for c in column_names]
-
-        df = df.rename_columns(column_names)
+        df = self._rename_columns(df)
 
         number_samples = df.num_rows
 
-        number_shards = math.ceil(df.num_rows / self.number_sample_per_shard)
+        # row indices of each shard when the rows are grouped by url
+        url_groups = self._plan_url_groups(df["url"].to_pylist()) if self.group_by_url else None
+
+        number_shards = (
+            len(url_groups) if url_groups is not None else math.ceil(number_samples / self.number_sample_per_shard)
+        )
         shards_to_write = [
             (start_shard_id + shard_id, shard_id)
             for shard_id in range(number_shards)
@@ -117,32 +350,19 @@ class InputSharder:
         ]
 
         shards_to_write = self.shard_sampler(shards_to_write)
-        number_shards = len(shards_to_write)
-
-        if len(shards_to_write) == 0:
-            return [], number_shards
 
         def write_shard(t):
             full_shard_id, shard_id = t
+            if url_groups is not None:
+                return self._write_shard(df.take(url_groups[shard_id]).select(self.column_list), full_shard_id)
             begin_shard = shard_id * self.number_sample_per_shard
             end_shard = min(number_samples, (1 + shard_id) * self.number_sample_per_shard)
             df_shard = df.slice(begin_shard, end_shard - begin_shard).select(self.column_list)
-            tmp_file = self.tmp_path + f"/{full_shard_id}.feather"
-            for i in range(10):
-                try:
-                    fs, tmp_path = fsspec.core.url_to_fs(tmp_file)
-                    with fs.open(tmp_path, "wb") as file:
-                        with pa.ipc.new_file(file, df_shard.schema) as writer:
-                            writer.write_table(df_shard)
-                    return (full_shard_id, tmp_file)
-                except Exception as e:  # pylint: disable=broad-except
-                    if i != 9:
-                        print("retrying to write to file due to error:", e)
-                        time.sleep(1)
-                    else:
-                        raise e
-            # can't reach here
-            raise ValueError("Failed to write to file.")
+            return self._write_shard(df_shard, full_shard_id)
+
+        if not isinstance(shards_to_write, list):
+            # samplers that claim shards as they go (f.e. SlurmShardClaimer) are consumed one shard at a time
+            return (write_shard(shard) for shard in shards_to_write), number_shards
 
         for i in range(10):
             shards = []
@@ -176,8 +396,20 @@ class InputSharder:
         for i, input_file in enumerate(self.input_files):
             print("Sharding file number " + str(i + 1) + " of " + str(len(self.input_files)) + " called " + input_file)
 
+            if self.parquet_shard_descriptors:
+                shards, number_shards = self._parquet_descriptors(input_file, start_shard_id)
+                yield from ((descriptor, shard_id) for shard_id, descriptor in shards)
+                start_shard_id += number_shards
+                continue
+
+            if self.stream_input:
+                print("Downloading starts as soon as the first shard is read")
+                start_shard_id += yield from self._stream_to_arrow(input_file, start_shard_id)
+                continue
+
             shards, number_shards = self._save_to_arrow(input_file, start_shard_id)
-            print("File sharded in " + str(len(shards)) + " shards")
+            if isinstance(shards, list):
+                print("File sharded in " + str(len(shards)) + " shards")
             print(
                 "Downloading starting now, check your bandwidth speed (with bwm-ng)"
                 "your cpu (with htop), and your disk usage (with iotop)!"
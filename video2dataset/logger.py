@@ -1,14 +1,22 @@
 """logging utils for the downloader"""
 
 import wandb
+import math
+import threading
 import time
 from collections import Counter
+from contextlib import contextmanager
 import fsspec
 import json
 import multiprocessing
 import queue
 import traceback
 
+from video2dataset.completion_index import CompletionIndex, record_done_shard
+from video2dataset.data_writer import stream_size
+from video2dataset.rate_limiter import merge_domain_stats
+from video2dataset.telemetry import TelemetryReceiver, report_shard
+
 
 class CappedCounter:
     """Maintain a counter with a capping to avoid memory issues"""
@@ -43,6 +51,150 @@ class CappedCounter:
         return c
 
 
+class LatencyHistogram:
+    """
+    Histogram of durations in log spaced buckets (like an HDR histogram) so percentiles are within
+    BUCKET_PRECISION of the real ones whatever the durations, in a bounded number of buckets that histograms
+    of different shards can be merged from
+    """
+
+    BUCKET_PRECISION = 0.02
+    MIN_DURATION = 1e-6
+
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        bucket = math.ceil(math.log(max(duration, self.MIN_DURATION)) / math.log1p(self.BUCKET_PRECISION))
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def update(self, histogram):
+        self.buckets.update(histogram.buckets)
+        self.count += histogram.count
+        self.total += histogram.total
+        self.max = max(self.max, histogram.max)
+
+    def percentile(self, p):
+        """Upper bound of the bucket of the p-th percentile duration"""
+        rank = math.ceil(p / 100 * self.count)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min((1 + self.BUCKET_PRECISION) ** bucket, self.max)
+        return self.max
+
+    def dump(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "max": self.max,
+            "buckets": {str(bucket): count for bucket, count in sorted(self.buckets.items())},
+        }
+
+    @classmethod
+    def load(cls, d):
+        h = LatencyHistogram()
+        h.buckets = Counter({int(bucket): count for bucket, count in d["buckets"].items()})
+        h.count, h.total, h.max = d["count"], d["total"], d["max"]
+        return h
+
+
+class StageStats:
+    """Durations of each processing stage of the samples of a shard and size of the streams in and out of it"""
+
+    def __init__(self):
+        self.histograms = {}
+        self.bytes_in = Counter()
+        self.bytes_out = Counter()
+        # stages can be timed from the threads that feed the samples
+        self.lock = threading.Lock()
+
+    def add(self, stage, duration, bytes_in=0, bytes_out=0):
+        with self.lock:
+            self.histograms.setdefault(stage, LatencyHistogram()).add(duration)
+            self.bytes_in[stage] += bytes_in
+            self.bytes_out[stage] += bytes_out
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def iterate(self, stage, iterable):
+        """Yield the items of iterable and record the time it takes to get each of them"""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(stage, time.perf_counter() - start)
+            yield item
+
+    def run(self, stage, subsampler, streams, *args):
+        """Call subsampler(streams, *args) and record its duration and the size of the streams in and out"""
+        # before the call, subsamplers can replace the streams in place
+        bytes_in = streams_size(streams)
+        start = time.perf_counter()
+        result = subsampler(streams, *args)
+        self.add(stage, time.perf_counter() - start, bytes_in, streams_size(result[0]))
+        return result
+
+    def update(self, stage_stats):
+        for stage, histogram in stage_stats.histograms.items():
+            self.histograms.setdefault(stage, LatencyHistogram()).update(histogram)
+        self.bytes_in.update(stage_stats.bytes_in)
+        self.bytes_out.update(stage_stats.bytes_out)
+
+    def summary(self):
+        """Count, mean, p50, p95, p99 and max duration and bytes in and out of each stage"""
+        return {
+            stage: {
+                "count": h.count,
+                "mean": h.total / h.count,
+                "p50": h.percentile(50),
+                "p95": h.percentile(95),
+                "p99": h.percentile(99),
+                "max": h.max,
+                "bytes_in": self.bytes_in[stage],
+                "bytes_out": self.bytes_out[stage],
+            }
+            for stage, h in self.histograms.items()
+            if h.count
+        }
+
+    def dump(self):
+        summary = self.summary()
+        return {stage: {**summary[stage], "histogram": self.histograms[stage].dump()} for stage in summary}
+
+    @classmethod
+    def load(cls, d):
+        s = StageStats()
+        for stage, stage_dict in d.items():
+            s.histograms[stage] = LatencyHistogram.load(stage_dict["histogram"])
+            s.bytes_in[stage] = stage_dict["bytes_in"]
+            s.bytes_out[stage] = stage_dict["bytes_out"]
+        return s
+
+
+def streams_size(streams):
+    """Total size of the streams of a sample ({modality: [stream, ...]}), 0 for the output of a failed subsampler"""
+    if not isinstance(streams, dict):
+        return 0
+    return sum(stream_size(stream) for modality_streams in streams.values() for stream in modality_streams)
+
+
 class Logger:
     """logger which logs when number of calls reaches a value or a time interval has passed"""
 
@@ -184,6 +336,35 @@ class StatusTableLogger(Logger):
             wandb.run.log({"status": status_table})
 
 
+class StageStatsLogger(Logger):
+    """Log the latency percentiles and bytes in and out of each processing stage"""
+
+    def __init__(self, min_interval=60, enable_wandb=False, **logger_args):
+        super().__init__(min_interval=min_interval, **logger_args)
+        self.enable_wandb = enable_wandb
+
+    def do_log(self, stage_stats):  # pylint: disable=arguments-differ
+        summary = stage_stats.summary()
+        for stage, stats in summary.items():
+            print(
+                " - ".join(
+                    [
+                        f"{stage:<20}",
+                        f"count: {stats['count']}",
+                        f"p50: {stats['p50']:.3f}s",
+                        f"p95: {stats['p95']:.3f}s",
+                        f"p99: {stats['p99']:.3f}s",
+                        f"max: {stats['max']:.3f}s",
+                        f"bytes in: {stats['bytes_in']}",
+                        f"bytes out: {stats['bytes_out']}",
+                    ]
+                )
+            )
+
+        if self.enable_wandb and summary:
+            wandb.log({f"stages/{stage}/{k}": v for stage, stats in summary.items() for k, v in stats.items()})
+
+
 def write_stats(
     output_folder,
     shard_id,
@@ -196,6 +377,8 @@ def write_stats(
     end_time,
     status_dict,
     oom_shard_count,
+    stage_stats=None,
+    domain_stats=None,
 ):
     """Write stats to disk"""
     stats = {
@@ -209,6 +392,10 @@ def write_stats(
         "end_time": end_time,
         "status_dict": status_dict.dump(),
     }
+    if stage_stats is not None:
+        stats["stage_stats"] = stage_stats.dump()
+    if domain_stats is not None:
+        stats["domain_stats"] = domain_stats
     fs, output_path = fsspec.core.url_to_fs(output_folder)
     shard_name = (
         shard_id
@@ -220,6 +407,47 @@ def write_stats(
     json_file = f"{output_path}/{shard_name}_stats.json"
     with fs.open(json_file, "w") as f:
         json.dump(stats, f, indent=4)
+    if shard_name.isdigit():  # not a part of a shard
+        record_done_shard(output_folder, int(shard_name))
+        report_shard(json_file)
+
+
+def merge_stats(stats_files, output_folder, shard_id, oom_shard_count):
+    """Sums up the stats of the parts of a shard and writes them as the stats of the shard"""
+    totals = {"count": 0, "successes": 0, "failed_to_download": 0, "failed_to_subsample": 0, "bytes_downloaded": 0}
+    start_time, end_time = float("inf"), float("-inf")
+    status_dict = CappedCounter()
+    stage_stats = None
+    domain_stats = []
+    for stats_file in stats_files:
+        fs, stats_path = fsspec.core.url_to_fs(stats_file)
+        with fs.open(stats_path, "r") as f:
+            stats = json.load(f)
+        for k in totals:
+            totals[k] += stats[k]
+        start_time = min(start_time, stats["start_time"])
+        end_time = max(end_time, stats["end_time"])
+        status_dict.update(CappedCounter.load(stats["status_dict"]))
+        if "stage_stats" in stats:
+            stage_stats = stage_stats or StageStats()
+            stage_stats.update(StageStats.load(stats["stage_stats"]))
+        if "domain_stats" in stats:
+            domain_stats.append(stats["domain_stats"])
+    write_stats(
+        output_folder,
+        shard_id,
+        totals["count"],
+        totals["successes"],
+        totals["failed_to_download"],
+        totals["failed_to_subsample"],
+        totals["bytes_downloaded"],
+        start_time,
+        end_time,
+        status_dict,
+        oom_shard_count,
+        stage_stats,
+        merge_domain_stats(domain_stats) if domain_stats else None,
+    )
 
 
 # https://docs.python.org/3/library/multiprocessing.html
@@ -234,22 +462,61 @@ class LoggerProcess(multiprocessing.context.SpawnProcess):
         wandb_project,
         config_parameters,
         log_interval=5,
+        oom_shard_count=None,
+        live_stats=False,
     ):
+        """
+        oom_shard_count: if set, new stats files are found through the completion index of the output folder
+            (started from journal_offset) instead of listing the output folder
+        live_stats: if True, the workers push their stats to the logger through a socket at telemetry_address
+            (passed to them in the TELEMETRY_ENV environment variable), the throughput is logged as samples
+            are done and new stats files are read as soon as their shard is done instead of listing the output folder
+        """
         super().__init__()
         self.log_interval = log_interval
         self.enable_wandb = enable_wandb
         self.output_folder = output_folder
+        self.oom_shard_count = oom_shard_count
+        self.journal_offset = 0
         self.stats_files = set()
         self.wandb_project = wandb_project
         self.done_shards = set()
         self.config_parameters = config_parameters
         ctx = multiprocessing.get_context("spawn")
         self.q = ctx.Queue()
+        self.telemetry_address = TelemetryReceiver.new_address() if live_stats else None
+        self.telemetry_ready = ctx.Event()
+
+    def start(self):
+        """Start logger process, once it listens for the stats of the workers if live_stats is set"""
+        super().start()
+        if self.telemetry_address is not None and not self.telemetry_ready.wait(60):
+            raise RuntimeError("logger process failed to start listening for stats")
+
+    def _receive(self, receiver, live_stats, new_stats_files):
+        """Wait for stats from the workers, sample stats are added up in live_stats"""
+        if receiver is None:
+            time.sleep(0.1)
+            return
+        for message in receiver.receive(timeout=0.1):
+            if message["type"] == "shard":
+                new_stats_files.add(message["stats_file"])
+            elif message["type"] == "sample":
+                live_stats["count"] += 1
+                live_stats[message["status"]] += 1
+                live_stats["bytes_downloaded"] += message["bytes_downloaded"]
 
     def run(self):
         """Run logger process"""
 
         fs, output_path = fsspec.core.url_to_fs(self.output_folder, use_listings_cache=False)
+        completion_index = CompletionIndex(self.output_folder) if self.oom_shard_count is not None else None
+        receiver = None
+        if self.telemetry_address is not None:
+            receiver = TelemetryReceiver(self.telemetry_address)
+            self.telemetry_ready.set()
+        live_stats: Counter = Counter()
+        reported_stats_files: set = set()
 
         if self.enable_wandb:
             self.current_run = wandb.init(
@@ -261,10 +528,13 @@ class LoggerProcess(multiprocessing.context.SpawnProcess):
             self.current_run = None
         self.total_speed_logger = SpeedLogger("total", enable_wandb=self.enable_wandb)
         self.status_table_logger = StatusTableLogger(enable_wandb=self.enable_wandb)
+        self.stage_stats_logger = StageStatsLogger(enable_wandb=self.enable_wandb)
         last_check = 0
+        live_start_time = time.time()
         total_status_dict = CappedCounter()
+        total_stage_stats = StageStats()
         while True:
-            time.sleep(0.1)
+            self._receive(receiver, live_stats, reported_stats_files)
             try:
                 self.q.get(False)
                 last_one = True
@@ -274,8 +544,32 @@ class LoggerProcess(multiprocessing.context.SpawnProcess):
                 continue
 
             try:
-                # read stats files
-                stats_files = fs.glob(output_path + "/*.json")
+                # throughput of the samples done since the last check
+                live_end_time = time.time()
+                if live_stats:
+                    SpeedLogger("live", enable_wandb=self.enable_wandb)(
+                        count=live_stats["count"],
+                        success=live_stats["success"],
+                        failed_to_download=live_stats["failed_to_download"],
+                        failed_to_subsample=live_stats["failed_to_subsample"],
+                        bytes_downloaded=live_stats["bytes_downloaded"],
+                        start_time=live_start_time,
+                        end_time=live_end_time,
+                    )
+                    live_stats.clear()
+                live_start_time = live_end_time
+
+                if receiver is not None and not last_one:
+                    stats_files = list(reported_stats_files)
+                    reported_stats_files.clear()
+                elif completion_index is not None:
+                    shard_ids, self.journal_offset = completion_index.read_journal(self.journal_offset)
+                    stats_files = [
+                        f"{output_path}/{shard_id:0{self.oom_shard_count}d}_stats.json" for shard_id in shard_ids
+                    ]
+                else:
+                    # read stats files, also at the end with live_stats in case a shard message was lost
+                    stats_files = fs.glob(output_path + "/*.json")
 
                 # filter out files that have an id smaller that are already done
                 stats_files = [f for f in stats_files if int(f.split("/")[-1].split("_")[0]) not in self.done_shards]
@@ -284,7 +578,7 @@ class LoggerProcess(multiprocessing.context.SpawnProcess):
                 new_stats_files = set(stats_files) - self.stats_files
                 if len(new_stats_files) == 0:
                     if last_one:
-                        self.finish()
+                        self.finish(receiver)
                         return
 
                 # read new stats files
@@ -313,6 +607,9 @@ class LoggerProcess(multiprocessing.context.SpawnProcess):
                             status_dict = CappedCounter.load(stats["status_dict"])
                             total_status_dict.update(status_dict)
                             self.status_table_logger(total_status_dict, self.total_speed_logger.count)
+                            if "stage_stats" in stats:
+                                total_stage_stats.update(StageStats.load(stats["stage_stats"]))
+                                self.stage_stats_logger(total_stage_stats)
                         except Exception as err:  # pylint: disable=broad-except
                             print(f"failed to parse stats file {stats_file}", err)
 
@@ -320,18 +617,21 @@ class LoggerProcess(multiprocessing.context.SpawnProcess):
                 last_check = time.perf_counter()
 
                 if last_one:
-                    self.finish()
+                    self.finish(receiver)
                     return
             except Exception as e:  # pylint: disable=broad-except
                 traceback.print_exc()
                 print("logger error", e)
-                self.finish()
+                self.finish(receiver)
                 return
 
-    def finish(self):
+    def finish(self, receiver=None):
         """Finish logger process"""
+        if receiver is not None:
+            receiver.close()
         self.total_speed_logger.sync()
         self.status_table_logger.sync()
+        self.stage_stats_logger.sync()
         if self.current_run is not None:
             self.current_run.finish()
 
@@ -1,15 +1,19 @@
 """Create dataset from video links and metadata."""
+import math
 import os
 import sys
 import signal
 import fire
 import fsspec
 
+from functools import partial
 from omegaconf import OmegaConf
 from typing import List, Optional, Any
 import numpy as np  # pylint: disable=unused-import
 
+from video2dataset.completion_index import CompletionIndex
 from video2dataset.logger import LoggerProcess
+from video2dataset.telemetry import TELEMETRY_ENV
 from video2dataset.data_writer import (
     WebDatasetSampleWriter,
     FilesSampleWriter,
@@ -23,7 +27,9 @@ from video2dataset.distributor import (
     no_distributor,
     multiprocessing_distributor,
     pyspark_distributor,
+    work_stealing_distributor,
     SlurmDistributor,
+    SlurmShardClaimer,
     SlurmShardSampler,
 )
 from video2dataset.workers import DownloadWorker, SubsetWorker, OpticalFlowWorker, CaptionWorker, WhisperWorker
@@ -55,6 +61,7 @@ def video2dataset(
     max_shard_retry: int = 1,
     tmp_dir: str = "/tmp",
     config: Any = "default",
+    live_stats: bool = False,
 ):
     """
     Create datasets from video/audio links
@@ -97,6 +104,8 @@ def video2dataset(
     max_shard_retry: Maximum amount of attempts to retry a failed shard
     tmp_dir: Path to temporary directory on your file system
     config: Path to your config of choice or the config itself (more info on configs in API doc)
+    live_stats: Whether the workers push their stats to the logger through a local socket so throughput is
+        logged as samples are done instead of when shards are done (multiprocessing and work_stealing only)
     """
     local_args = dict(locals())
     if isinstance(config, str):
@@ -108,19 +117,6 @@ def video2dataset(
     if config["reading"]["sampler"] is None:
         config["reading"]["sampler"] = identity
 
-    called_from_slurm = "CALLED_FROM_SLURM" in os.environ
-    if called_from_slurm:
-        global_task_id = int(os.environ["GLOBAL_RANK"])
-        num_tasks = (
-            config["distribution"]["distributor_args"]["n_nodes"]
-            * config["distribution"]["distributor_args"]["tasks_per_node"]
-        )
-        config["reading"]["sampler"] = SlurmShardSampler(global_task_id=global_task_id, num_tasks=num_tasks)
-        config["distribution"]["distributor"] = "multiprocessing"
-
-        # Only log from master
-        enable_wandb = enable_wandb and (global_task_id == 0)
-
     # TODO: find better location for this code
     # TODO: figure out minimum yt_meta_args for subtitles to be added to metadata
     if config["storage"]["captions_are_subtitles"]:
@@ -142,7 +138,43 @@ def video2dataset(
     output_folder = make_path_absolute(output_folder)
     url_list = make_path_absolute(url_list)
 
-    logger_process = LoggerProcess(output_folder, enable_wandb, wandb_project, local_args)
+    called_from_slurm = "CALLED_FROM_SLURM" in os.environ
+    if called_from_slurm:
+        global_task_id = int(os.environ["GLOBAL_RANK"])
+        slurm_args = config["distribution"]["distributor_args"]
+        num_tasks = slurm_args["n_nodes"] * slurm_args["tasks_per_node"]
+        if slurm_args.get("shard_assignment", "modulo") == "claim":
+            config["reading"]["sampler"] = SlurmShardClaimer(
+                global_task_id=global_task_id,
+                num_tasks=num_tasks,
+                # the leases are per job so that restarting a job doesn't wait for the leases of the previous one
+                claims_path=os.path.join(
+                    slurm_args.get("cache_path") or ".video2dataset_cache/",
+                    f"claims_{os.environ.get('SLURM_JOB_ID', 'local')}",
+                ),
+                output_folder=output_folder,
+                oom_shard_count=config["storage"]["oom_shard_count"],
+                claim_batch_size=slurm_args.get("claim_batch_size", 4),
+                max_claimed=slurm_args.get("max_claimed") or 2 * config["distribution"]["processes_count"],
+                lease_timeout=slurm_args.get("lease_timeout", 1800),
+            )
+        else:
+            config["reading"]["sampler"] = SlurmShardSampler(global_task_id=global_task_id, num_tasks=num_tasks)
+        config["distribution"]["distributor"] = "multiprocessing"
+
+        # Only log from master
+        enable_wandb = enable_wandb and (global_task_id == 0)
+
+    use_completion_index = config["storage"].get("completion_index", False)
+    logger_process = LoggerProcess(
+        output_folder,
+        enable_wandb,
+        wandb_project,
+        local_args,
+        oom_shard_count=config["storage"]["oom_shard_count"] if use_completion_index else None,
+        # the workers of the other distributors can run on other machines than the logger
+        live_stats=live_stats and config["distribution"]["distributor"] in ["multiprocessing", "work_stealing"],
+    )
     tmp_path = output_folder + "/_tmp"
     fs, run_tmp_dir = fsspec.core.url_to_fs(tmp_path)
     if not fs.exists(run_tmp_dir):
@@ -167,7 +199,10 @@ def video2dataset(
         done_shards = set()
     else:
         if incremental_mode == "incremental":
-            done_shards = set(int(x.split("/")[-1].split("_")[0]) for x in fs.glob(output_path + "/*.json"))
+            if use_completion_index and CompletionIndex(output_folder).exists():
+                done_shards = CompletionIndex(output_folder).done_shards()
+            else:
+                done_shards = set(int(x.split("/")[-1].split("_")[0]) for x in fs.glob(output_path + "/*.json"))
         elif incremental_mode == "overwrite":
             fs.rm(output_path, recursive=True)
             fs.mkdir(output_path)
@@ -175,8 +210,19 @@ def video2dataset(
         else:
             raise ValueError(f"Unknown incremental mode {incremental_mode}")
 
+    if use_completion_index:
+        completion_index = CompletionIndex(output_folder)
+        if completion_index.exists():
+            completion_index.compact()
+        else:
+            completion_index.create(done_shards)
+        logger_process.journal_offset = completion_index.journal_size()
+
     logger_process.done_shards = done_shards
     logger_process.start()
+    if logger_process.telemetry_address is not None:
+        # inherited by the worker processes
+        os.environ[TELEMETRY_ENV] = logger_process.telemetry_address
 
     if output_format == "webdataset":
         sample_writer_class = WebDatasetSampleWriter
@@ -207,6 +253,10 @@ def video2dataset(
             done_shards,
             tmp_path,
             config["reading"]["sampler"],
+            config["reading"].get("stream_input", False),
+            config["reading"].get("parquet_shard_descriptors", False),
+            config["reading"].get("group_by_url", False),
+            config["reading"].get("url_partitions", 16),
         )
 
     if stage == "download":
@@ -262,6 +312,19 @@ def video2dataset(
     if config["distribution"]["distributor"] == "multiprocessing" or called_from_slurm:
         distributor_fn = multiprocessing_distributor if stage not in ["whisper", "caption"] else no_distributor
         called_from_slurm = "GLOBAL_RANK" in os.environ
+    elif config["distribution"]["distributor"] == "work_stealing":
+        if stage != "download":
+            raise ValueError("The work_stealing distributor only supports the download stage")
+        distributor_args = config["distribution"].get("distributor_args") or {}
+        chunk_size = distributor_args.get("chunk_size", 4)
+        distributor_fn = partial(
+            work_stealing_distributor,
+            chunk_size=chunk_size,
+            # enough parts in flight per process to keep thread_count downloads going
+            chunks_per_process=distributor_args.get(
+                "chunks_per_process", math.ceil(config["distribution"]["thread_count"] / chunk_size)
+            ),
+        )
     elif config["distribution"]["distributor"] == "pyspark":
         distributor_fn = pyspark_distributor
     elif config["distribution"]["distributor"] == "slurm":
@@ -280,6 +343,7 @@ def video2dataset(
         max_shard_retry,
     )
     logger_process.join()
+    os.environ.pop(TELEMETRY_ENV, None)
     if not called_from_slurm:
         fs.rm(run_tmp_dir, recursive=True)
 
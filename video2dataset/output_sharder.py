@@ -18,6 +18,7 @@ class OutputSharder:
     def __init__(self, shard_list, input_format, done_shards, sampler=lambda x: x) -> None:
         self.input_format = input_format
         self.done_shards = done_shards
+        self.shard_sampler = sampler
         self.column_list = None
         fs, url_path = fsspec.core.url_to_fs(shard_list)
 
@@ -42,8 +43,9 @@ class OutputSharder:
             [(s_id, s) for s_id, s in zip(self.shard_ids, self.shard_list) if int(s_id) not in self.done_shards]
         )
 
-        num_shards = len(self.shards)
-        print(f"Processing a total of {num_shards} shards!")
+        if isinstance(self.shards, list):  # samplers that claim shards as they go don't know how many they'll get
+            num_shards = len(self.shards)
+            print(f"Processing a total of {num_shards} shards!")
 
     def __iter__(self):
         """
@@ -0,0 +1,262 @@
+"""per domain limits on the number of downloads in flight, adapted to how each domain responds"""
+
+import re
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from urllib.parse import urlparse
+
+
+# responses of a domain that doesn't want more requests from us
+THROTTLED = re.compile(
+    "|".join(
+        [
+            r"HTTP Error (403|429)",  # yt-dlp
+            r"^(403|429) Client Error",  # requests
+            r"^(403|429), message=",  # aiohttp
+            r"returned status (403|429)",  # range requests
+            r"Sign in to confirm",  # youtube bot check
+        ]
+    )
+)
+
+
+# downloads are compared per this many bytes, smaller files are compared whole since their latency is mostly the
+# round trips to the domain
+LATENCY_UNIT_BYTES = 1 << 20
+
+
+def get_domain(url):
+    return urlparse(url).netloc
+
+
+def normalized_latency(latency, size):
+    """Seconds per LATENCY_UNIT_BYTES of a download, so a big file doesn't look like a congested domain"""
+    return latency / max(1.0, size / LATENCY_UNIT_BYTES)
+
+
+class DomainWindow:
+    """Concurrency window and counters of one domain"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.min_latency = float("inf")
+        self.cooldown_until = 0.0
+        self.since_decrease = 0
+
+
+class AdaptiveRateLimiter:
+    """
+    Limits the number of downloads in flight to each domain, the limit of a domain is adapted with AIMD like TCP
+    congestion control: it grows by one download every limit successful downloads (additive increase) and is
+    multiplied by decrease_factor (multiplicative decrease) when the domain throttles (403, 429, youtube's bot
+    check) or when a download takes more than latency_factor times the fastest one seen, per MiB for the files
+    bigger than that (see normalized_latency). After a throttle no download to the domain starts for cooldown
+    seconds.
+
+    schedule(rows) hands out the (key, url) rows as their domain has room, rows of a domain that's full wait
+    while the ones of the other domains go ahead. Several shards can be scheduled at once (f.e. the chunks of
+    the work stealing distributor), they share the limits of the domains.
+
+    initial_limit: downloads in flight to a domain before anything is known about it
+    min_limit: the limit never goes below this
+    max_limit: the limit never goes above this
+    decrease_factor: the limit is multiplied by this on congestion, at most once per window of limit downloads
+    latency_factor: downloads slower (per MiB) than this times the fastest one count as congestion, None to only
+        react to throttling
+    cooldown: seconds without starting downloads to a domain after it throttled
+    """
+
+    def __init__(
+        self,
+        initial_limit=4,
+        min_limit=1,
+        max_limit=64,
+        decrease_factor=0.5,
+        latency_factor=4.0,
+        cooldown=5.0,
+    ):
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+        self.windows = {}
+        self.condition = threading.Condition()
+
+    def __getstate__(self):
+        # a limiter sent to another process starts without knowing the domains
+        return {
+            "initial_limit": self.initial_limit,
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+            "decrease_factor": self.decrease_factor,
+            "latency_factor": self.latency_factor,
+            "cooldown": self.cooldown,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _window(self, domain):
+        if domain not in self.windows:
+            self.windows[domain] = DomainWindow(self.initial_limit)
+        return self.windows[domain]
+
+    def _decrease(self, window):
+        if window.since_decrease >= window.limit:  # once per window, the downloads in flight saw the same state
+            window.limit = max(self.min_limit, window.limit * self.decrease_factor)
+            window.since_decrease = 0
+
+    def _done(self, domain, latency, error_message):
+        """Frees a slot of domain and adapts its limit to the outcome of the download, under the condition"""
+        window = self._window(domain)
+        window.in_flight -= 1
+        if latency is None:
+            self.condition.notify_all()
+            return
+        window.since_decrease += 1
+        if error_message is not None and THROTTLED.search(error_message):
+            window.cooldown_until = time.monotonic() + self.cooldown
+            self._decrease(window)
+        elif error_message is None:
+            window.min_latency = min(window.min_latency, latency)
+            if self.latency_factor is not None and latency > self.latency_factor * window.min_latency:
+                self._decrease(window)
+            else:
+                window.limit = min(self.max_limit, window.limit + 1 / window.limit)
+        self.condition.notify_all()
+
+    def _pop_startable(self, waiting):
+        """The first waiting row whose domain has room, its slot is taken. Else None and how long to wait"""
+        now = time.monotonic()
+        wait = None
+        for domain, rows in waiting.items():
+            window = self._window(domain)
+            if window.cooldown_until > now:
+                wait = min(wait or float("inf"), window.cooldown_until - now)
+            elif window.in_flight < max(self.min_limit, int(window.limit)):
+                window.in_flight += 1
+                row = rows.popleft()
+                # round robin between the domains
+                waiting.move_to_end(domain)
+                if not rows:
+                    del waiting[domain]
+                return row, None
+        return None, wait
+
+    def schedule(self, rows):
+        """Hands out the (key, url) rows as their domain has room, see DomainSchedule"""
+        return DomainSchedule(self, rows)
+
+
+class DomainSchedule:
+    """
+    The rows of a shard handed out by AdaptiveRateLimiter.schedule, iterating it yields the (key, url) rows as
+    their domain has room. The rows are read in another thread since they can block.
+
+    Each row yielded holds a slot of its domain until done() is called for its url, close() frees the slots the
+    shard still holds (f.e. when it failed) so they don't stay taken for the other shards scheduled on the limiter.
+    """
+
+    def __init__(self, limiter, rows):
+        self.limiter = limiter
+        self.in_flight: Counter = Counter()  # domain -> slots held by this shard
+        self.downloads: Counter = Counter()
+        self.throttled: Counter = Counter()
+        self.rows = self._iterate(rows)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.rows)
+
+    def _iterate(self, rows):
+        """Yields the rows as their domain has room, taking a slot of the domain for this shard"""
+        condition = self.limiter.condition
+        waiting: OrderedDict = OrderedDict()  # domain -> rows
+        exhausted = []
+
+        def feed():
+            try:
+                for row in rows:
+                    with condition:
+                        waiting.setdefault(get_domain(row[1]), deque()).append(row)
+                        condition.notify_all()
+            finally:
+                with condition:
+                    exhausted.append(True)
+                    condition.notify_all()
+
+        threading.Thread(target=feed, daemon=True).start()
+        while True:
+            with condition:
+                row, wait = self.limiter._pop_startable(waiting)  # pylint: disable=protected-access
+                while row is None:
+                    if exhausted and not waiting:
+                        return
+                    condition.wait(wait)
+                    row, wait = self.limiter._pop_startable(waiting)  # pylint: disable=protected-access
+                self.in_flight[get_domain(row[1])] += 1
+            yield row
+
+    def done(self, url, latency, error_message, size=0):
+        """
+        Frees the slot of a download and adapts the limit of its domain to the outcome, latency is None when
+        the domain wasn't contacted (f.e. the download was read from the cache), size is the bytes downloaded
+        """
+        domain = get_domain(url)
+        if latency is not None:
+            latency = normalized_latency(latency, size)
+        with self.limiter.condition:
+            if self.in_flight[domain] <= 0:  # already freed by close()
+                return
+            self.in_flight[domain] -= 1
+            if latency is not None:
+                self.downloads[domain] += 1
+                if error_message is not None and THROTTLED.search(error_message):
+                    self.throttled[domain] += 1
+            self.limiter._done(domain, latency, error_message)  # pylint: disable=protected-access
+
+    def close(self):
+        """Frees the slots of the downloads of the shard that never finished"""
+        with self.limiter.condition:
+            for domain, count in self.in_flight.items():
+                self.limiter.windows[domain].in_flight -= count
+            self.in_flight.clear()
+            self.limiter.condition.notify_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def dump(self):
+        """Counters of the shard and current limit of each domain it downloaded from, for the stats of the shard"""
+        with self.limiter.condition:
+            return {
+                domain: {
+                    "downloads": count,
+                    "throttled": self.throttled[domain],
+                    "limit": self.limiter.windows[domain].limit,
+                }
+                for domain, count in self.downloads.items()
+            }
+
+
+def merge_domain_stats(domain_stats_list):
+    """Sums up the domain stats of several shards (or parts of a shard), keeping the lowest limit of each domain"""
+    merged = {}
+    for domain_stats in domain_stats_list:
+        for domain, stats in domain_stats.items():
+            if domain not in merged:
+                merged[domain] = dict(stats)
+                continue
+            merged[domain]["downloads"] += stats["downloads"]
+            merged[domain]["throttled"] += stats["throttled"]
+            merged[domain]["limit"] = min(merged[domain]["limit"], stats["limit"])
+    return merged
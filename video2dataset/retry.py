@@ -0,0 +1,155 @@
+"""retrying the samples that failed to download because of transient errors (rate limits, dropped connections...)"""
+
+import heapq
+import random
+import re
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlparse
+
+import fsspec
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+
+# errors that can go away by trying again later, anything else (404, private video...) is permanent
+TRANSIENT_ERRORS = re.compile(
+    "|".join(
+        [
+            r"HTTP Error (429|5\d\d)",  # yt-dlp
+            r"^(429|5\d\d) (Client|Server) Error",  # requests
+            r"^(429|5\d\d), message=",  # aiohttp
+            r"returned status (429|5\d\d)",  # range requests
+            r"Connection (reset|refused|aborted|broken)",
+            r"RemoteDisconnected|Remote end closed connection|ServerDisconnectedError",
+            r"IncompleteRead|payload is not completed",
+            r"timed out|TimeoutError",
+            r"Temporary failure in name resolution",
+            r"Sign in to confirm",  # youtube bot check
+        ]
+    )
+)
+
+# columns added to the input columns in the parquet files of the shards
+SAMPLE_COLUMNS = ["key", "status", "error_message"]
+
+
+def is_transient(error_message):
+    """Whether a download error is worth retrying"""
+    return error_message is not None and TRANSIENT_ERRORS.search(error_message) is not None
+
+
+class SampleRetryQueue:
+    """
+    Samples of a shard that failed to download with a transient error, waiting to be downloaded again
+
+    iterate(rows) yields the rows of the shard followed by the retries as they come due, it only stops once
+    every sample is done (see done()) since any in flight sample could still need a retry.
+
+    count: number of samples in the shard
+    max_retries: maximum number of retries of a sample, 0 disables retrying
+    backoff: seconds before the first retry of a sample, doubled for each following retry (with jitter)
+    max_backoff: maximum seconds between two attempts
+    domain_budget: maximum number of retries to the same domain in the shard, so a domain that's down
+        doesn't hold up the shard
+    """
+
+    def __init__(self, count, max_retries=2, backoff=1.0, max_backoff=30.0, domain_budget=100):
+        self.pending = count
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.domain_budget = domain_budget
+        self.attempts: Counter = Counter()
+        self.domain_retries: Counter = Counter()
+        self.due: list = []  # heap of (due time, key, url)
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def retry(self, key, url, error_message):
+        """Queue the sample again if its error is transient and it has retries left, returns whether it was"""
+        if not is_transient(error_message):
+            return False
+        domain = urlparse(url).netloc
+        with self.condition:
+            if self.attempts[key] >= self.max_retries or self.domain_retries[domain] >= self.domain_budget:
+                return False
+            delay = min(self.backoff * 2 ** self.attempts[key], self.max_backoff) * random.uniform(0.5, 1.0)
+            self.attempts[key] += 1
+            self.domain_retries[domain] += 1
+            heapq.heappush(self.due, (time.monotonic() + delay, key, url))
+            self.condition.notify_all()
+        return True
+
+    def done(self):
+        """A sample won't be retried anymore"""
+        with self.condition:
+            self.pending -= 1
+            self.condition.notify_all()
+
+    def close(self):
+        """Stops iterate() even if some samples aren't done, f.e. when the shard failed"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def _pop_due(self, wait):
+        """The next retry that is due, waits for it if wait is set. None if there is none"""
+        with self.condition:
+            while not self.closed:
+                now = time.monotonic()
+                if self.due and self.due[0][0] <= now:
+                    _, key, url = heapq.heappop(self.due)
+                    return key, url
+                if not wait or (not self.due and self.pending <= 0):
+                    return None
+                self.condition.wait(self.due[0][0] - now if self.due else None)
+            return None
+
+    def iterate(self, rows):
+        """Yields the rows, with the retries that are due in between, then the remaining retries as they come due"""
+        if self.max_retries <= 0:
+            yield from rows
+            return
+        for row in rows:
+            retry = self._pop_due(wait=False)
+            while retry is not None:
+                yield retry
+                retry = self._pop_due(wait=False)
+            yield row
+        retry = self._pop_due(wait=True)
+        while retry is not None:
+            yield retry
+            retry = self._pop_due(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def failed_samples(output_folder, retry_permanent=False):
+    """
+    Reads the parquet files of the shards in output_folder and returns the input rows of the samples that failed
+    to download with a transient error (or any error if retry_permanent is set), to download them again with
+    input_format="parquet". The column names are the ones of the output (url, caption, clips...)
+    """
+    fs, output_path = fsspec.core.url_to_fs(output_folder)
+    tables = []
+    for path in sorted(fs.glob(f"{output_path}/*.parquet")):
+        with fs.open(path, "rb") as f:
+            parquet_file = pq.ParquetFile(f)
+            # the streams are only in the parquet files of the parquet output format
+            columns = [field.name for field in parquet_file.schema_arrow if not pa.types.is_binary(field.type)]
+            table = parquet_file.read(columns=columns)
+        failed = table.filter(pc.equal(table["status"], "failed_to_download"))
+        if not retry_permanent:
+            transient = [is_transient(error) for error in failed["error_message"].to_pylist()]
+            failed = failed.filter(pa.array(transient, pa.bool_()))
+        tables.append(failed.select([c for c in failed.column_names if c not in SAMPLE_COLUMNS]))
+    if not tables:
+        return pa.table({})
+    return pa.concat_tables(tables)
@@ -5,6 +5,7 @@ Transform video and audio by reducing fps, extracting videos, changing resolutio
 from .audio_rate_subsampler import AudioRateSubsampler
 from .clipping_subsampler import ClippingSubsampler, _get_seconds, _split_time_frame, Streams
 from .frame_subsampler import FrameSubsampler
+from .fused_subsampler import FusedSubsampler, split_fusable
 from .ffprobe_subsampler import FFProbeSubsampler
 from .noop_subsampler import NoOpSubsampler
 from .resolution_subsampler import ResolutionSubsampler
@@ -3,9 +3,7 @@ frame subsampler adjusts the fps of the videos to some constant value
 """
 
 
-import tempfile
-import os
-import ffmpeg
+from .ffmpeg_runner import run_ffmpeg
 
 
 class AudioRateSubsampler:
@@ -18,28 +16,21 @@ class AudioRateSubsampler:
 
     def __init__(self, sample_rate, encode_format, n_audio_channels=None):
         self.sample_rate = sample_rate
-        self.encode_formats = encode_formats
+        self.encode_formats = {"audio": encode_format}
         self.n_audio_channels = n_audio_channels
 
     def __call__(self, streams, metadata=None):
         audio_bytes = streams.pop("audio")
         subsampled_bytes = []
         for aud_bytes in audio_bytes:
-            with tempfile.TemporaryDirectory() as tmpdir:
-                with open(os.path.join(tmpdir, "input.m4a"), "wb") as f:
-                    f.write(aud_bytes)
-                ext = self.encode_formats
-                try:
-                    # TODO: for now assuming m4a, change this
-                    ffmpeg_args = {"ar": str(self.sample_rate), "f": ext}
-                    if self.n_audio_channels is not None:
-                        ffmpeg_args["ac"] = str(self.n_audio_channels)
-                    _ = ffmpeg.input(f"{tmpdir}/input.m4a")
-                    _ = _.output(f"{tmpdir}/output.{ext}", **ffmpeg_args).run(capture_stdout=True, quiet=True)
-                except Exception as err:  # pylint: disable=broad-except
-                    return [], None, str(err)
-
-                with open(f"{tmpdir}/output.{ext}", "rb") as f:
-                    subsampled_bytes.append(f.read())
+            ext = self.encode_formats["audio"]
+            try:
+                ffmpeg_args = {"ar": str(self.sample_rate)}
+                if self.n_audio_channels is not None:
+                    ffmpeg_args["ac"] = str(self.n_audio_channels)
+                # TODO: for now assuming m4a input, change this
+                subsampled_bytes.append(run_ffmpeg(aud_bytes, "m4a", ext, **ffmpeg_args))
+            except Exception as err:  # pylint: disable=broad-except
+                return [], None, str(err)
         streams["audio"] = subsampled_bytes
         return streams, metadata, None
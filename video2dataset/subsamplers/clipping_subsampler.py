@@ -2,14 +2,16 @@
 clipping subsampler turns full videos into clips of videos according to clip_col
 """
 from collections.abc import Iterable
+from contextlib import ExitStack, contextmanager
 import copy
 import datetime
 import ffmpeg
 import glob
 import os
 import tempfile
-from typing import Any, Union, List, Tuple, Dict, Literal, cast
+from typing import Any, Union, Iterator, List, Tuple, Dict, Literal, cast
 
+from video2dataset.subsamplers.ffmpeg_runner import input_path
 from video2dataset.subsamplers.subsampler import Subsampler
 from video2dataset.v2d_types import EncodeFormats, Streams
 
@@ -108,23 +110,22 @@ def _collate_clip_spans(clip_spans: List[ClipSpan]) -> Tuple[str, List[int]]:
 def _process_stream(
     tmpdir: Any,  # BytesPath
     stream_bytes: bytes,
-    encode_formats: str,
+    encode_format: str,
     ffmpeg_kwargs: dict,
 ) -> List[str]:
     """Processes a stream into clips using ffmpeg"""
     # TODO: we need to put the extension into the metadata
-    # TODO: This can be done better using pipes I just don't feel like sinking too much time into this rn
-    with open(os.path.join(tmpdir, f"input.{encode_formats}"), "wb") as f:
-        f.write(stream_bytes)
-    try:
-        (
-            ffmpeg.input(f"{tmpdir}/input.{encode_formats}")
-            .output(f"{tmpdir}/clip_%d.{encode_formats}", **ffmpeg_kwargs)
-            .run(capture_stdout=True, quiet=True)
-        )
-    except Exception as err:  # pylint: disable=broad-except
-        raise err
-    stream_clips = glob.glob(f"{tmpdir}/clip*.{encode_formats}")
+    # the input is piped in when possible, the segment muxer can only write its clips to files
+    with input_path(stream_bytes, encode_format) as path:
+        try:
+            (
+                ffmpeg.input(path)
+                .output(f"{tmpdir}/clip_%d.{encode_format}", **ffmpeg_kwargs)
+                .run(input=stream_bytes if path == "pipe:" else None, capture_stdout=True, quiet=True)
+            )
+        except Exception as err:  # pylint: disable=broad-except
+            raise err
+    stream_clips = glob.glob(f"{tmpdir}/clip*.{encode_format}")
     stream_clips.sort(key=lambda x: int(x.split("_")[-1].split(".")[0]))
     return stream_clips
 
@@ -152,40 +153,36 @@ def _extract_subtitles(clip_span: ClipSpan, meta_clip: dict) -> List[dict]:
 
 
 def _get_clip_metadata(
-    clip_spans: List[ClipSpan],
-    clip_idxs: List[int],
+    clip_id: int,
+    clip_span: ClipSpan,
     metadata: dict,
     oom_clip_count: int,
     strtime_formatting: bool,
-) -> List[dict]:
-    """Gets metadata for each clip"""
-    metadata_clips = []
-    for clip_id, (clip_span, _) in enumerate(zip(clip_spans, clip_idxs)):
-        clip_key = "{clip_id:0{oom_clip_count}d}".format(  # pylint: disable=consider-using-f-string
-            clip_id=clip_id, oom_clip_count=oom_clip_count
-        )
-        meta_clip = copy.deepcopy(metadata)
-        # set the timeframe of this clip
-        if strtime_formatting:
-            #  Keep clip_spans in the original format to be compatible with the data schema.
-            meta_clip["clips"] = [(_get_strtime(clip_span[0]), _get_strtime(clip_span[1]))]
-        else:
-            meta_clip["clips"] = [clip_span]
-        meta_clip["key"] = f"{meta_clip['key']}_{clip_key}"
-
-        yt_md_dict = meta_clip.get("yt_meta_dict", {})
-        if (yt_md_dict is not None) and (yt_md_dict.get("subtitles", None) is not None):
-            meta_clip["clip_subtitles"] = _extract_subtitles(clip_span, meta_clip)
-        metadata_clips.append(meta_clip)
+) -> dict:
+    """Gets metadata for one clip, the fields that are the same for every clip are shared with metadata"""
+    clip_key = "{clip_id:0{oom_clip_count}d}".format(  # pylint: disable=consider-using-f-string
+        clip_id=clip_id, oom_clip_count=oom_clip_count
+    )
+    meta_clip = dict(metadata)
+    # set the timeframe of this clip
+    if strtime_formatting:
+        #  Keep clip_spans in the original format to be compatible with the data schema.
+        meta_clip["clips"] = [(_get_strtime(clip_span[0]), _get_strtime(clip_span[1]))]
+    else:
+        meta_clip["clips"] = [clip_span]
+    meta_clip["key"] = f"{meta_clip['key']}_{clip_key}"
 
+    yt_md_dict = meta_clip.get("yt_meta_dict", {})
+    if (yt_md_dict is not None) and (yt_md_dict.get("subtitles", None) is not None):
+        meta_clip["clip_subtitles"] = _extract_subtitles(clip_span, meta_clip)
     # remove redundant metadata from clips after the first
-    for m_clips in metadata_clips[1:]:
-        m_clips["yt_meta_dict"] = {}
-
-    return metadata_clips
+    if clip_id > 0:
+        meta_clip["yt_meta_dict"] = {}
+    return meta_clip
 
 
-def _get_clips(
+@contextmanager
+def _clip_files(
     streams: Streams,
     encode_formats: EncodeFormats,
     precision: str,
@@ -193,8 +190,8 @@ def _get_clips(
     metadata: dict,
     oom_clip_count: int,
     strtime_formatting: bool,
-) -> Tuple[Dict[str, List[bytes]], List[dict]]:
-    """Gets clips from streams"""
+) -> Iterator[List[Tuple[Dict[str, str], dict]]]:
+    """Cuts the streams into clips, gives the (clip file paths, clip metadata) of all clips until the exit"""
     clip_times, clip_idxs = _collate_clip_spans(clip_spans)
 
     ffmpeg_kwargs = {
@@ -208,36 +205,72 @@ def _get_clips(
     else:
         ffmpeg_kwargs["c"] = "copy"
 
-    clips: Dict[str, List[bytes]] = {}
-    for k in streams.keys():
-        k = cast(Literal["audio", "video"], k)
-        with tempfile.TemporaryDirectory() as tmpdir:
+    with ExitStack() as stack:
+        clip_paths: Dict[str, List[str]] = {}
+        for k in streams.keys():
+            k = cast(Literal["audio", "video"], k)
             stream_bytes = streams[k][0]  # pre-broadcast so only one
             if stream_bytes is None:
                 continue
-            try:
-                stream_clips = _process_stream(
-                    tmpdir=tmpdir,
-                    stream_bytes=stream_bytes,
-                    encode_format=encode_formats[k],
-                    ffmpeg_kwargs=ffmpeg_kwargs,
-                )
-            except Exception as err:  # pylint: disable=broad-except
-                raise err
-
-            clips[k] = []
-            for clip_idx in clip_idxs:
-                with open(stream_clips[clip_idx], "rb") as vid_f:
-                    clip_bytes = vid_f.read()
-                    clips[k].append(clip_bytes)
-
-    clip_metadata = _get_clip_metadata(
+            stream_clips = _process_stream(
+                tmpdir=stack.enter_context(tempfile.TemporaryDirectory()),
+                stream_bytes=stream_bytes,
+                encode_format=encode_formats[k],
+                ffmpeg_kwargs=ffmpeg_kwargs,
+            )
+            # fails before any clip is given if the muxer wrote fewer segments than expected
+            clip_paths[k] = [stream_clips[clip_idx] for clip_idx in clip_idxs]
+
+        yield [
+            (
+                {k: paths[clip_id] for k, paths in clip_paths.items()},
+                _get_clip_metadata(
+                    clip_id=clip_id,
+                    clip_span=clip_span,
+                    metadata=metadata,
+                    oom_clip_count=oom_clip_count,
+                    strtime_formatting=strtime_formatting,
+                ),
+            )
+            for clip_id, clip_span in enumerate(clip_spans)
+        ]
+
+
+def _read_clip(clip_paths: Dict[str, str]) -> Dict[str, bytes]:
+    """Reads the files of a clip and removes them"""
+    clip_streams = {}
+    for k, path in clip_paths.items():
+        with open(path, "rb") as vid_f:
+            clip_streams[k] = vid_f.read()
+        os.remove(path)
+    return clip_streams
+
+
+def _get_clips(
+    streams: Streams,
+    encode_formats: EncodeFormats,
+    precision: str,
+    clip_spans: List[ClipSpan],
+    metadata: dict,
+    oom_clip_count: int,
+    strtime_formatting: bool,
+) -> Tuple[Dict[str, List[bytes]], List[dict]]:
+    """Gets clips from streams"""
+    clips: Dict[str, List[bytes]] = {k: [] for k, v in streams.items() if v[0] is not None}
+    clip_metadata = []
+    with _clip_files(
+        streams=streams,
+        encode_formats=encode_formats,
+        precision=precision,
         clip_spans=clip_spans,
-        clip_idxs=clip_idxs,
         metadata=metadata,
         oom_clip_count=oom_clip_count,
         strtime_formatting=strtime_formatting,
-    )
+    ) as clip_files:
+        for clip_paths, meta_clip in clip_files:
+            for k, clip_bytes in _read_clip(clip_paths).items():
+                clips[k].append(clip_bytes)
+            clip_metadata.append(meta_clip)
 
     return clips, clip_metadata
 
@@ -287,10 +320,9 @@ class ClippingSubsampler(Subsampler):
         self.max_length_strategy = max_length_strategy
         self.precision = precision
 
-    def __call__(self, streams: Streams, metadata: dict):
-        strtime_formatting = isinstance(metadata["clips"][0][0], str)
-
-        clip_spans = _adjust_clip_spans(
+    def get_clip_spans(self, metadata: dict) -> List[ClipSpan]:
+        """Pops the clips (and keyframes if needed) from the metadata and turns them into adjusted clip spans"""
+        return _adjust_clip_spans(
             clip_spans=metadata.pop("clips"),
             keyframe_timestamps=(
                 # TODO: make it so if keyframe timestamps not present, get it yourself
@@ -302,6 +334,37 @@ class ClippingSubsampler(Subsampler):
             max_length=self.max_length,
             max_length_strategy=self.max_length_strategy,
         )
+
+    @contextmanager
+    def clip_files(self, streams: Streams, metadata: dict) -> Iterator[List[Tuple[Dict[str, str], dict]]]:
+        """
+        Like __call__ but gives the (clip file paths, clip metadata) of the clips, so only the clip being read
+        (see read_clip) is held in memory. The files are removed at the exit and errors are raised instead of
+        returned
+        """
+        strtime_formatting = isinstance(metadata["clips"][0][0], str)
+
+        clip_spans = self.get_clip_spans(metadata)
+        if len(clip_spans) == 0:
+            raise ValueError(f"Video had no clip_spans longer than {self.min_length}")
+
+        with _clip_files(
+            streams=streams,
+            encode_formats=self.encode_formats,
+            precision=self.precision,
+            clip_spans=clip_spans,
+            metadata=metadata,
+            oom_clip_count=self.oom_clip_count,
+            strtime_formatting=strtime_formatting,
+        ) as clips:
+            yield clips
+
+    read_clip = staticmethod(_read_clip)
+
+    def __call__(self, streams: Streams, metadata: dict):
+        strtime_formatting = isinstance(metadata["clips"][0][0], str)
+
+        clip_spans = self.get_clip_spans(metadata)
         if len(clip_spans) == 0:
             return {}, [], f"Video had no clip_spans longer than {self.min_length}"
 
@@ -0,0 +1,354 @@
+"""
+reads keyframe timestamps from the index of mp4 (sample tables, fragments) and webm/mkv (cues) containers
+instead of listing every packet with ffprobe
+"""
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+
+# trun sample flags
+MP4_NON_SYNC_SAMPLE = 0x00010000
+MP4_DEPENDS_ON_OTHERS = 0x01000000
+# trun flag of each per sample field, in the order they are stored
+MP4_TRUN_COLUMNS = [(0x100, "duration"), (0x200, "size"), (0x400, "flags"), (0x800, "cto")]
+
+EBML_HEADER = 0x1A45DFA3
+MKV_SEGMENT = 0x18538067
+MKV_INFO = 0x1549A966
+MKV_TIMECODE_SCALE = 0x2AD7B1
+MKV_TRACKS = 0x1654AE6B
+MKV_TRACK_ENTRY = 0xAE
+MKV_TRACK_NUMBER = 0xD7
+MKV_TRACK_TYPE = 0x83
+MKV_CUES = 0x1C53BB6B
+MKV_CUE_POINT = 0xBB
+MKV_CUE_TIME = 0xB3
+MKV_CUE_TRACK_POSITIONS = 0xB7
+MKV_CUE_TRACK = 0xF7
+
+
+class UnsupportedIndex(Exception):
+    """The container has no index the keyframes can be read from, or one this module doesn't handle"""
+
+
+def keyframe_timestamps(stream_bytes: bytes) -> Optional[List[float]]:
+    """
+    Presentation timestamps in seconds of the keyframes of the first video track, like ffprobe reports them
+    (rounded to the microsecond), or None if they can't be read from the container index
+    """
+    try:
+        if stream_bytes[4:8] in (b"ftyp", b"styp", b"moov", b"free", b"wide", b"mdat", b"skip"):
+            return mp4_keyframe_timestamps(stream_bytes)
+        if stream_bytes[:4] == EBML_HEADER.to_bytes(4, "big"):
+            return mkv_keyframe_timestamps(stream_bytes)
+    except (UnsupportedIndex, ValueError, IndexError):
+        pass
+    return None
+
+
+def _uint(data: bytes, offset: int, size: int) -> int:
+    if offset + size > len(data):
+        raise UnsupportedIndex("truncated box")
+    return int.from_bytes(data[offset : offset + size], "big")
+
+
+def _int(data: bytes, offset: int, size: int) -> int:
+    if offset + size > len(data):
+        raise UnsupportedIndex("truncated box")
+    return int.from_bytes(data[offset : offset + size], "big", signed=True)
+
+
+def _array(data: bytes, offset: int, count: int, fields: int = 1, dtype: str = ">u4") -> np.ndarray:
+    """count rows of fields 4 byte integers starting at offset"""
+    if offset + count * fields * 4 > len(data):
+        raise UnsupportedIndex("truncated box")
+    return np.frombuffer(data, dtype=dtype, count=count * fields, offset=offset).reshape(count, fields)
+
+
+def iter_boxes(data: bytes, offset: int = 0, end: Optional[int] = None) -> Iterator[Tuple[bytes, int, int]]:
+    """Yields (type, payload offset, end) of the ISO BMFF boxes between offset and end"""
+    end = len(data) if end is None else min(end, len(data))
+    while offset + 8 <= end:
+        size, box_type, header = _uint(data, offset, 4), data[offset + 4 : offset + 8], 8
+        if size == 1:
+            size, header = _uint(data, offset + 8, 8), 16
+        elif size == 0:  # extends to the end
+            size = end - offset
+        if size < header:
+            raise UnsupportedIndex("invalid box size")
+        if offset + size > end:  # truncated file, the index would list samples that aren't there
+            raise UnsupportedIndex("box larger than its parent")
+        yield box_type, offset + header, offset + size
+        offset += size
+
+
+def find_box(data: bytes, offset: int, end: int, path: List[bytes]) -> Optional[Tuple[int, int]]:
+    """(payload offset, end) of the first box at path under the boxes between offset and end"""
+    for box_type, payload, box_end in iter_boxes(data, offset, end):
+        if box_type == path[0]:
+            if len(path) == 1:
+                return payload, box_end
+            found = find_box(data, payload, box_end, path[1:])
+            if found is not None:
+                return found
+    return None
+
+
+def _full_box_field(data: bytes, payload: int, v0_offset: int, v1_offset: int, v0_size: int, v1_size: int):
+    """Field of a full box whose offset and size depend on the box version"""
+    if data[payload] == 1:
+        return _uint(data, payload + v1_offset, v1_size)
+    return _uint(data, payload + v0_offset, v0_size)
+
+
+class Mp4Track:
+    """The timing information of an mp4 video track needed to place its keyframes"""
+
+    def __init__(self, data: bytes, trak: Tuple[int, int], movie_timescale: int):
+        payload, end = trak
+        tkhd = find_box(data, payload, end, [b"tkhd"])
+        mdhd = find_box(data, payload, end, [b"mdia", b"mdhd"])
+        if tkhd is None or mdhd is None:
+            raise UnsupportedIndex("track without tkhd or mdhd")
+        self.track_id = _full_box_field(data, tkhd[0], 12, 20, 4, 4)
+        self.timescale = _full_box_field(data, mdhd[0], 12, 20, 4, 4)
+        if not self.timescale:
+            raise UnsupportedIndex("track without timescale")
+        self.shift = self._edit_list_shift(data, find_box(data, payload, end, [b"edts", b"elst"]), movie_timescale)
+        # defaults of the fragments from trex
+        self.default_duration = 0
+        self.default_flags = 0
+
+    def _edit_list_shift(self, data, elst, movie_timescale):
+        """
+        What to add to the composition times to get the presentation times: an empty edit delays the track,
+        the media time of the edit is where the presentation starts. Other edit lists aren't handled.
+        """
+        if elst is None:
+            return 0
+        payload, _ = elst
+        version, count = data[payload], _uint(data, payload + 4, 4)
+        entry_size = 20 if version == 1 else 12
+        size = 8 if version == 1 else 4
+        shift, media_edits = 0, 0
+        for i in range(count):
+            entry = payload + 8 + i * entry_size
+            segment_duration, media_time = _uint(data, entry, size), _int(data, entry + size, size)
+            if media_time == -1:
+                shift += segment_duration * self.timescale // movie_timescale
+            else:
+                media_edits += 1
+                shift -= media_time
+        if media_edits > 1:
+            raise UnsupportedIndex("edit list with several edits")
+        return shift
+
+    def sample_table_keyframes(self, data: bytes, stbl: Tuple[int, int]) -> Tuple[np.ndarray, int]:
+        """Composition times of the keyframes listed in the sample tables and the decode time after the last sample"""
+        payload, end = stbl
+        stts = find_box(data, payload, end, [b"stts"])
+        if stts is None:
+            raise UnsupportedIndex("sample table without stts")
+        entries = _array(data, stts[0] + 8, _uint(data, stts[0] + 4, 4), 2)
+        deltas = np.repeat(entries[:, 1].astype(np.int64), entries[:, 0])
+        decode_times = np.concatenate([[0], np.cumsum(deltas)])
+        sample_count = len(deltas)
+
+        stss = find_box(data, payload, end, [b"stss"])
+        if stss is None:  # every sample is a keyframe
+            keyframes = np.arange(sample_count)
+        else:
+            keyframes = _array(data, stss[0] + 8, _uint(data, stss[0] + 4, 4))[:, 0].astype(np.int64) - 1
+            keyframes = keyframes[(keyframes >= 0) & (keyframes < sample_count)]
+        times = decode_times[keyframes]
+
+        ctts = find_box(data, payload, end, [b"ctts"])
+        if ctts is not None:
+            # offsets are signed in version 1 and read as signed by ffmpeg in version 0 too
+            entries = _array(data, ctts[0] + 8, _uint(data, ctts[0] + 4, 4), 2, ">i4")
+            offsets = np.repeat(entries[:, 1].astype(np.int64), entries[:, 0].astype(np.uint32))
+            if len(offsets) < sample_count:
+                offsets = np.concatenate([offsets, np.zeros(sample_count - len(offsets), dtype=np.int64)])
+            times = times + offsets[keyframes]
+        return times, int(decode_times[-1])
+
+    def fragment_keyframes(self, data: bytes, traf: Tuple[int, int], decode_time: int) -> Tuple[np.ndarray, int]:
+        """Composition times of the keyframes of a track fragment and the decode time after its last sample"""
+        payload, end = traf
+        tfhd = find_box(data, payload, end, [b"tfhd"])
+        flags = _uint(data, tfhd[0], 4) & 0xFFFFFF
+        field = tfhd[0] + 8  # after version, flags and track_ID
+        default_duration, default_flags = self.default_duration, self.default_flags
+        if flags & 0x01:  # base data offset
+            field += 8
+        if flags & 0x02:  # sample description index
+            field += 4
+        if flags & 0x08:
+            default_duration = _uint(data, field, 4)
+            field += 4
+        if flags & 0x10:  # default sample size
+            field += 4
+        if flags & 0x20:
+            default_flags = _uint(data, field, 4)
+
+        tfdt = find_box(data, payload, end, [b"tfdt"])
+        if tfdt is not None:
+            decode_time = _full_box_field(data, tfdt[0], 4, 4, 4, 8)
+
+        times = []
+        for box_type, trun, _ in iter_boxes(data, payload, end):
+            if box_type != b"trun":
+                continue
+            version, flags, count = data[trun], _uint(data, trun, 4) & 0xFFFFFF, _uint(data, trun + 4, 4)
+            field = trun + 8
+            if flags & 0x01:  # data offset
+                field += 4
+            first_flags = None
+            if flags & 0x04:
+                first_flags = _uint(data, field, 4)
+                field += 4
+            columns = [name for bit, name in MP4_TRUN_COLUMNS if flags & bit]
+            samples = _array(data, field, count, len(columns)) if columns else np.zeros((count, 0), dtype=">u4")
+
+            durations = (
+                samples[:, columns.index("duration")].astype(np.int64)
+                if "duration" in columns
+                else np.full(count, default_duration, dtype=np.int64)
+            )
+            sample_flags = (
+                samples[:, columns.index("flags")].astype(np.int64)
+                if "flags" in columns
+                else np.full(count, default_flags, dtype=np.int64)
+            )
+            if first_flags is not None and count:
+                sample_flags[0] = first_flags
+            offsets = np.zeros(count, dtype=np.int64)
+            if "cto" in columns:
+                offsets = samples[:, columns.index("cto")].astype(np.uint32)
+                offsets = offsets.astype(np.int32 if version == 1 else np.uint32).astype(np.int64)
+                if (offsets < 0).any():  # ffmpeg shifts these timestamps in ways not worth reproducing
+                    raise UnsupportedIndex("negative composition offsets")
+
+            decode_times = decode_time + np.concatenate([[0], np.cumsum(durations)])
+            keyframes = np.flatnonzero((sample_flags & (MP4_NON_SYNC_SAMPLE | MP4_DEPENDS_ON_OTHERS)) == 0)
+            times.append(decode_times[keyframes] + offsets[keyframes])
+            decode_time = int(decode_times[-1])
+        return (np.concatenate(times) if times else np.zeros(0, dtype=np.int64)), decode_time
+
+
+def mp4_keyframe_timestamps(data: bytes) -> List[float]:
+    """Keyframes of the first video track from the sample tables (stss, stts, ctts) or the fragments (trun)"""
+    moov = find_box(data, 0, len(data), [b"moov"])
+    if moov is None:
+        raise UnsupportedIndex("no moov box")
+    mvhd = find_box(data, *moov, [b"mvhd"])
+    movie_timescale = _full_box_field(data, mvhd[0], 12, 20, 4, 4) if mvhd is not None else 1000
+
+    track, stbl = None, None
+    for box_type, payload, end in iter_boxes(data, *moov):
+        hdlr = find_box(data, payload, end, [b"mdia", b"hdlr"]) if box_type == b"trak" else None
+        if hdlr is not None and data[hdlr[0] + 8 : hdlr[0] + 12] == b"vide":
+            track = Mp4Track(data, (payload, end), movie_timescale)
+            stbl = find_box(data, payload, end, [b"mdia", b"minf", b"stbl"])
+            break
+    if track is None:
+        raise UnsupportedIndex("no video track")
+
+    for box_type, payload, end in iter_boxes(data, *moov):
+        if box_type != b"mvex":
+            continue
+        for child_type, trex, _ in iter_boxes(data, payload, end):
+            if child_type == b"trex" and _uint(data, trex + 4, 4) == track.track_id:
+                track.default_duration = _uint(data, trex + 12, 4)
+                track.default_flags = _uint(data, trex + 20, 4)
+
+    times, decode_time = [], 0
+    if stbl is not None:
+        keyframes, decode_time = track.sample_table_keyframes(data, stbl)
+        times.append(keyframes)
+    for box_type, payload, end in iter_boxes(data):
+        if box_type != b"moof":
+            continue
+        for child_type, traf, traf_end in iter_boxes(data, payload, end):
+            tfhd = find_box(data, traf, traf_end, [b"tfhd"]) if child_type == b"traf" else None
+            if tfhd is not None and _uint(data, tfhd[0] + 4, 4) == track.track_id:
+                keyframes, decode_time = track.fragment_keyframes(data, (traf, traf_end), decode_time)
+                times.append(keyframes)
+
+    times = np.concatenate(times) if times else np.zeros(0, dtype=np.int64)
+    if times.size == 0:
+        raise UnsupportedIndex("no keyframes in the index")
+    return [round(float(t) / track.timescale, 6) for t in np.sort(times + track.shift)]
+
+
+def _vint(data: bytes, offset: int, keep_marker: bool) -> Tuple[int, int, bool]:
+    """EBML variable size integer at offset: (value, length, whether all value bits are set)"""
+    first = data[offset]
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8:
+        raise UnsupportedIndex("invalid EBML integer")
+    value = _uint(data, offset, length)
+    if not keep_marker:
+        value &= (1 << (7 * length)) - 1
+    return value, length, value == (1 << (7 * length)) - 1
+
+
+def iter_elements(data: bytes, offset: int, end: int) -> Iterator[Tuple[int, int, int]]:
+    """Yields (id, payload offset, end) of the EBML elements between offset and end"""
+    end = min(end, len(data))
+    while offset < end:
+        element_id, id_length, _ = _vint(data, offset, keep_marker=True)
+        size, size_length, unknown = _vint(data, offset + id_length, keep_marker=False)
+        payload = offset + id_length + size_length
+        if unknown:  # live streams, the end of the element isn't known without parsing its children
+            raise UnsupportedIndex("element of unknown size")
+        if payload + size > end:
+            raise UnsupportedIndex("element larger than its parent")
+        yield element_id, payload, payload + size
+        offset = payload + size
+
+
+def mkv_keyframe_timestamps(data: bytes) -> List[float]:
+    """Keyframes of the first video track from the cues of a webm/mkv file"""
+    segment = next((e for e in iter_elements(data, 0, len(data)) if e[0] == MKV_SEGMENT), None)
+    if segment is None:
+        raise UnsupportedIndex("no segment")
+    timecode_scale, video_track, cues = 1000000, None, None
+    # the cues can come after the clusters, skipping over those is cheap
+    for element_id, payload, end in iter_elements(data, segment[1], segment[2]):
+        if element_id == MKV_INFO:
+            for child_id, child, child_end in iter_elements(data, payload, end):
+                if child_id == MKV_TIMECODE_SCALE:
+                    timecode_scale = _uint(data, child, child_end - child)
+        elif element_id == MKV_TRACKS and video_track is None:
+            for child_id, child, child_end in iter_elements(data, payload, end):
+                if child_id != MKV_TRACK_ENTRY:
+                    continue
+                fields = {i: _uint(data, p, e - p) for i, p, e in iter_elements(data, child, child_end) if e - p <= 8}
+                if fields.get(MKV_TRACK_TYPE) == 1:
+                    video_track = fields.get(MKV_TRACK_NUMBER)
+                    break
+        elif element_id == MKV_CUES:
+            cues = (payload, end)
+    if video_track is None or cues is None:
+        raise UnsupportedIndex("no video track or no cues")
+
+    times = set()
+    for element_id, payload, end in iter_elements(data, *cues):
+        if element_id != MKV_CUE_POINT:
+            continue
+        cue_time, tracks = None, []
+        for child_id, child, child_end in iter_elements(data, payload, end):
+            if child_id == MKV_CUE_TIME:
+                cue_time = _uint(data, child, child_end - child)
+            elif child_id == MKV_CUE_TRACK_POSITIONS:
+                tracks += [
+                    _uint(data, p, e - p) for i, p, e in iter_elements(data, child, child_end) if i == MKV_CUE_TRACK
+                ]
+        if cue_time is not None and video_track in tracks:
+            times.add(cue_time)
+    if not times:
+        raise UnsupportedIndex("no cues for the video track")
+    return [round(t * timecode_scale / 1e9, 6) for t in sorted(times)]
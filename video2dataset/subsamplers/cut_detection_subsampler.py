@@ -2,10 +2,18 @@
 cut detection subsampler detects cuts in a video
 """
 
-import numpy as np
-from scenedetect import ContentDetector, AdaptiveDetector, SceneManager, open_video
+import io
+import itertools
 import os
 import tempfile
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+from scenedetect import ContentDetector, AdaptiveDetector, FrameTimecode, SceneManager, open_video
+from scenedetect.backends import VideoStreamAv  # None if PyAV isn't installed
+from scenedetect.scene_manager import Interpolation
+from scenedetect.video_stream import VideoStream
 
 from .subsampler import Subsampler
 
@@ -13,6 +21,13 @@ from .subsampler import Subsampler
 # from scenedetect import scene_manager and set that in correct namespace
 # best solution is just figure out best value for them and submit PR
 DEFAULT_MIN_WIDTH = 64
+# frames scored together by the vectorized detector
+VECTORIZED_BATCH_SIZE = 256
+# bytes of downscaled frames buffered for the passes at other framerates, longer videos are decoded once per pass
+MAX_DECODED_FRAMES_SIZE = 256 * 2**20
+# AdaptiveDetector defaults
+ADAPTIVE_WINDOW_WIDTH = 2
+ADAPTIVE_MIN_CONTENT_VAL = 15.0
 
 
 def get_scenes_from_scene_manager(scene_manager, cut_detection_mode):
@@ -25,6 +40,18 @@ def get_scenes_from_scene_manager(scene_manager, cut_detection_mode):
     for clip in scene_list:
         scene.append([clip[0].get_frames(), clip[1].get_frames()])
 
+    return select_scenes(scene, cut_detection_mode)
+
+
+def get_scenes_from_cuts(cuts, start, end, cut_detection_mode):
+    """
+    Returns a list of cuts from the frame numbers of the cuts, like get_scenes_from_scene_manager
+    """
+    scene = [[first, last] for first, last in zip([start] + cuts, cuts + [end])]
+    return select_scenes(scene, cut_detection_mode)
+
+
+def select_scenes(scene, cut_detection_mode):
     if cut_detection_mode == "longest":  # we have multiple cuts, pick the longest
         longest_clip = np.argmax([clip[1] - clip[0] for clip in scene])
         scene = [scene[longest_clip]]
@@ -32,6 +59,263 @@ def get_scenes_from_scene_manager(scene_manager, cut_detection_mode):
     return scene
 
 
+if VideoStreamAv is not None:
+
+    class BytesVideoStreamAv(VideoStreamAv):
+        """PyAV VideoStream over in memory bytes that can be reset (scenedetect doesn't rewind file objects)"""
+
+        def __init__(self, video_bytes):
+            super().__init__(io.BytesIO(video_bytes))
+
+        def reset(self):
+            self._io.seek(0)
+            super().reset()
+
+        def read_downscaled(self, width, height):
+            """
+            read() with the frame downscaled while converting it to BGR, a lot cheaper than converting the
+            full frame and resizing it afterwards. Fast bilinear samples a few pixels like cv2's linear resize
+            does at these scales, so the frames score like the ones the SceneManager gets.
+            """
+            if not self.read(decode=False):
+                return False
+            return self._frame.reformat(
+                width=width, height=height, format="bgr24", interpolation="FAST_BILINEAR"
+            ).to_ndarray()
+
+
+@contextmanager
+def open_video_bytes(video_bytes):
+    """
+    Opens in memory video bytes as a scenedetect VideoStream, PyAV can read from a file object directly
+    while the OpenCV backend needs a path
+    """
+    if VideoStreamAv is not None:
+        yield BytesVideoStreamAv(video_bytes)
+        return
+    with tempfile.TemporaryDirectory() as tmpdir:
+        video_path = os.path.join(tmpdir, "input.mp4")
+        with open(video_path, "wb") as f:
+            f.write(video_bytes)
+        yield open_video(video_path)
+
+
+class FrameBufferFull(Exception):
+    """The downscaled frames of the video don't fit in MAX_DECODED_FRAMES_SIZE"""
+
+
+class DecodedFrames:
+    """
+    Frames of a video decoded once and downscaled like the SceneManager does it, kept in a buffer that every
+    cut detection pass reads so the passes at other framerates don't decode the video again (they skip frames
+    by index). Only the downscaled frames are kept, DEFAULT_MIN_WIDTH to 2x as wide, and FrameBufferFull is
+    raised once they take more than max_size bytes.
+    """
+
+    def __init__(self, video, downscale, max_size):
+        frames, positions, size = [], [], 0
+        while True:
+            frame = video.read()
+            if frame is False:
+                break
+            if downscale > 1:
+                frame = cv2.resize(
+                    frame,
+                    (round(frame.shape[1] / downscale), round(frame.shape[0] / downscale)),
+                    interpolation=Interpolation.LINEAR.value,
+                )
+            size += frame.nbytes
+            if size > max_size:
+                raise FrameBufferFull(f"the frames of the video take more than {max_size} bytes")
+            frames.append(frame)
+            positions.append(video.position.frame_num)
+        if not frames:
+            raise ValueError("video has no frames")
+        self.frames = frames
+        self.positions = positions
+        self.frame_rate = video.frame_rate
+        self.duration = video.duration
+        self.aspect_ratio = video.aspect_ratio
+
+
+class FrameBufferStream(VideoStream):
+    """scenedetect VideoStream over DecodedFrames"""
+
+    BACKEND_NAME = "frame_buffer"
+
+    def __init__(self, decoded_frames):
+        super().__init__()
+        self.decoded_frames = decoded_frames
+        self._index = -1
+
+    @property
+    def path(self):
+        return ""
+
+    @property
+    def name(self):
+        return ""
+
+    @property
+    def is_seekable(self):
+        return True
+
+    @property
+    def frame_rate(self):
+        return self.decoded_frames.frame_rate
+
+    @property
+    def duration(self):
+        return self.decoded_frames.duration
+
+    @property
+    def frame_size(self):
+        return (self.decoded_frames.frames[0].shape[1], self.decoded_frames.frames[0].shape[0])
+
+    @property
+    def aspect_ratio(self):
+        return self.decoded_frames.aspect_ratio
+
+    @property
+    def position(self):
+        if self._index < 0:
+            return self.base_timecode
+        return FrameTimecode(self.decoded_frames.positions[self._index], self.frame_rate)
+
+    @property
+    def position_ms(self):
+        return self.position.get_seconds() * 1000.0
+
+    @property
+    def frame_number(self):
+        return self.position.frame_num + 1 if self._index >= 0 else 0
+
+    def read(self, decode=True, advance=True):
+        if advance:
+            if self._index + 1 >= len(self.decoded_frames.positions):
+                return False
+            self._index += 1
+        if decode:
+            return self.decoded_frames.frames[self._index]
+        return advance
+
+    def reset(self):
+        self._index = -1
+
+    def seek(self, target):
+        # the next frame read is the first one at or after target, like the other backends
+        target_frame = (self.base_timecode + target).frame_num
+        self._index = int(np.searchsorted(self.decoded_frames.positions, target_frame)) - 1
+
+
+def read_downscaled_frames(video, downscale):
+    """Yields (frame number, downscaled BGR frame) for every frame of a scenedetect VideoStream"""
+    width, height = round(video.frame_size[0] / downscale), round(video.frame_size[1] / downscale)
+    while True:
+        if hasattr(video, "read_downscaled"):
+            frame = video.read_downscaled(width, height)
+        else:
+            frame = video.read()
+            if frame is not False and downscale > 1:
+                frame = cv2.resize(frame, (width, height), interpolation=Interpolation.LINEAR.value)
+        if frame is False:
+            return
+        yield video.position.frame_num, frame
+
+
+def content_scores(previous, frames):
+    """
+    ContentDetector score of each HSV frame compared to the one before it, previous is the frame before the
+    first one. This is the average of the mean absolute hue, saturation and value differences.
+    """
+    frames = np.concatenate([previous[None], frames]).astype(np.int16)
+    distances = np.abs(np.diff(frames, axis=0)).sum(axis=(1, 2), dtype=np.int64) / float(
+        frames.shape[1] * frames.shape[2]
+    )
+    return (distances[:, 0] + distances[:, 1] + distances[:, 2]) / 3.0
+
+
+def score_frames(frames, strides):
+    """
+    Scores batches of frames at once for several passes over the video, the pass with stride s scores one frame
+    out of s like the SceneManager does with frame_skip=s - 1
+
+    frames: iterable of (frame number, BGR frame)
+    returns {stride: (frame numbers, scores)} and the number of the last frame
+    """
+    passes = {stride: ([], []) for stride in strides}
+    previous = {}
+    frames = iter(frames)
+    index, frame_num = 0, None
+    while True:
+        batch = list(itertools.islice(frames, VECTORIZED_BATCH_SIZE))
+        if not batch:
+            break
+        batch_frame_nums = np.array([frame_num for frame_num, _ in batch])
+        images = np.stack([image for _, image in batch])
+        n, height, width, _ = images.shape
+        # one conversion for the whole batch
+        hsv = cv2.cvtColor(images.reshape(n * height, width, 3), cv2.COLOR_BGR2HSV).reshape(images.shape)
+
+        for stride, (frame_nums, scores) in passes.items():
+            selected = (np.arange(index, index + n) % stride) == 0
+            if not selected.any():
+                continue
+            if stride not in previous:  # the first frame scores 0
+                previous[stride] = hsv[selected][0]
+                scores.append(np.zeros(1))
+                scores.append(content_scores(previous[stride], hsv[selected][1:]))
+            else:
+                scores.append(content_scores(previous[stride], hsv[selected]))
+            frame_nums.append(batch_frame_nums[selected])
+            previous[stride] = hsv[selected][-1]
+        index += n
+        frame_num = batch_frame_nums[-1]
+
+    if frame_num is None:
+        raise ValueError("video has no frames")
+    return {
+        stride: (np.concatenate(frame_nums), np.concatenate(scores)) for stride, (frame_nums, scores) in passes.items()
+    }, frame_num
+
+
+def apply_min_scene_len(frame_nums, candidates, min_scene_len, last_cut=None):
+    """Frame numbers of the candidate cuts that are at least min_scene_len frames after the previous cut"""
+    cuts = []
+    for i in candidates:
+        if last_cut is None or frame_nums[i] - last_cut >= min_scene_len:
+            last_cut = int(frame_nums[i])
+            cuts.append(last_cut)
+    return cuts
+
+
+def content_cuts(frame_nums, scores, threshold, min_scene_len):
+    """Cuts ContentDetector finds from the frame scores"""
+    return apply_min_scene_len(frame_nums, np.flatnonzero(scores >= threshold), min_scene_len, int(frame_nums[0]))
+
+
+def adaptive_cuts(frame_nums, scores, adaptive_threshold, min_scene_len):
+    """Cuts AdaptiveDetector finds from the frame scores: score compared to the average of the frames around"""
+    window = ADAPTIVE_WINDOW_WIDTH
+    n = len(scores) - 2 * window
+    if n <= 0:
+        return []
+    target = scores[window : window + n]
+    average = np.zeros(n)
+    for i in range(2 * window + 1):
+        if i != window:
+            average = average + scores[i : i + n]
+    average = average / (2.0 * window)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.where(
+            np.abs(average) < 0.00001,
+            np.where(target >= ADAPTIVE_MIN_CONTENT_VAL, 255.0, 0.0),
+            np.minimum(target / average, 255.0),
+        )
+    candidates = np.flatnonzero((ratio >= adaptive_threshold) & (target >= ADAPTIVE_MIN_CONTENT_VAL)) + window
+    return apply_min_scene_len(frame_nums, candidates, min_scene_len)
+
+
 class CutDetectionSubsampler(Subsampler):
     """
     Detects cuts in input videos and returns contiguous segments in a video as metadata.
@@ -40,6 +324,8 @@ class CutDetectionSubsampler(Subsampler):
     - cuts_are_clips: whether to create video clips from the source video based on cuts
 
     initialization args:
+    - algorithm to be "adaptive" or "content" (PySceneDetect's AdaptiveDetector and ContentDetector),
+      "vectorized" or "vectorized_content" to compute the same scores on batches of frames with numpy
     - cut_detection_mode to be either "longest" to pick the longest cut or "all" to pick all cuts
     - framerates to be None (for original fps only) or a list of target framerates to detect cuts in
     - threshold - determines roughly how much motion is required for a "cut" (tunable parameter)
@@ -64,64 +350,89 @@ class CutDetectionSubsampler(Subsampler):
         self.base_fps = base_fps
         self.algorithm = algorithm
 
+    def make_detector(self, min_scene_len):
+        if self.algorithm == "content":
+            return ContentDetector(threshold=self.threshold, min_scene_len=min_scene_len)
+        if self.algorithm == "adaptive":
+            return AdaptiveDetector(adaptive_threshold=self.threshold, min_scene_len=min_scene_len)
+        raise ValueError("Other detection algorithm not implemented.")
+
+    def detect_scenes(self, video, original_fps, min_scene_len):
+        """cuts at the original fps and at each of the framerates with PySceneDetect"""
+        downscale = video.frame_size[0] // DEFAULT_MIN_WIDTH
+        if self.framerates:  # several passes over the same frames
+            try:
+                video = FrameBufferStream(DecodedFrames(video, downscale, MAX_DECODED_FRAMES_SIZE))
+                downscale = 1
+            except FrameBufferFull:  # each pass decodes the video
+                video.reset()
+
+        scene_manager = SceneManager()
+        scene_manager.add_detector(self.make_detector(min_scene_len))
+        scene_manager.auto_downscale = False
+        scene_manager.downscale = downscale
+
+        cuts = {}
+        scene_manager.detect_scenes(video=video)
+        cuts["cuts_original_fps"] = get_scenes_from_scene_manager(scene_manager, self.cut_detection_mode)
+        if self.framerates is not None:
+            for target_fps in self.framerates:
+                video.reset()
+
+                scene_manager = SceneManager()
+                scene_manager.add_detector(self.make_detector(min_scene_len))
+                scene_manager.auto_downscale = False
+                scene_manager.downscale = downscale
+                frame_skip = max(
+                    int(original_fps // target_fps) - 1, 0
+                )  # if we take 1 frame and skip N frames we're sampling 1/N+1 % of the video
+                # so if we desire to sample 1/N of the video, we need to subtract one when doing frame skipping
+
+                scene_manager.detect_scenes(video=video, frame_skip=frame_skip)
+                cuts[f"cuts_{target_fps}"] = get_scenes_from_scene_manager(scene_manager, self.cut_detection_mode)
+                scene_manager.clear()
+        return cuts
+
+    def detect_scenes_vectorized(self, video, original_fps, min_scene_len):
+        """same as detect_scenes, the video is decoded once and all the passes are scored batch by batch"""
+        strides = {"cuts_original_fps": 1}
+        for target_fps in self.framerates or []:
+            strides[f"cuts_{target_fps}"] = max(int(original_fps // target_fps), 1)
+
+        frames = read_downscaled_frames(video, max(video.frame_size[0] // DEFAULT_MIN_WIDTH, 1))
+        scores, last_frame_num = score_frames(frames, set(strides.values()))
+
+        cuts = {}
+        for key, stride in strides.items():
+            frame_nums, frame_scores = scores[stride]
+            if self.algorithm == "vectorized_content":
+                cut_list = content_cuts(frame_nums, frame_scores, self.threshold, min_scene_len)
+            else:
+                cut_list = adaptive_cuts(frame_nums, frame_scores, self.threshold, min_scene_len)
+            cuts[key] = get_scenes_from_cuts(
+                cut_list, int(frame_nums[0]), int(last_frame_num) + 1, self.cut_detection_mode
+            )
+        return cuts
+
     def __call__(self, streams, metadata=None):
         video_bytes = streams["video"][0]
 
         try:
-            with tempfile.TemporaryDirectory() as tmpdir:
-                video_path = os.path.join(tmpdir, "input.mp4")
-                with open(video_path, "wb") as f:
-                    f.write(video_bytes)
-
-                video = open_video(video_path)
+            with open_video_bytes(video_bytes) as video:
                 original_fps = video.frame_rate
 
                 # adapt self.min_scene_len based on deviation from base_fps
                 # so different fps don't affect cut detection behaviour
                 if self.base_fps:
-                    min_scene_len = int(
-                        self.min_scene_len * original_fps / self.base_fps
-                    )
+                    min_scene_len = int(self.min_scene_len * original_fps / self.base_fps)
                 else:
                     min_scene_len = self.min_scene_len
 
-                if self.algorithm == "content":
-                    detector = ContentDetector(
-                        threshold=self.threshold, min_scene_len=min_scene_len
-                    )
-                elif self.algorithm == "adaptive":
-                    detector = AdaptiveDetector(
-                        adaptive_threshold=self.threshold, min_scene_len=min_scene_len
-                    )
-                else:
-                    raise ValueError("Other detection algorithm not implemented.")
-                scene_manager = SceneManager()
-                scene_manager.add_detector(detector)
-                scene_manager.auto_downscale = False
-                scene_manager.downscale = video.frame_size[0] // DEFAULT_MIN_WIDTH
-
                 cuts = {"original_fps": original_fps, "base_fps": self.base_fps}
-                scene_manager.detect_scenes(video=video)
-                cuts["cuts_original_fps"] = get_scenes_from_scene_manager(
-                    scene_manager, self.cut_detection_mode
-                )
-                if self.framerates is not None:
-                    for target_fps in self.framerates:
-                        video.reset()
-
-                        # we can simply re-use the existing detector here.
-                        scene_manager = SceneManager()
-                        scene_manager.add_detector(detector)
-                        frame_skip = max(
-                            int(original_fps // target_fps) - 1, 0
-                        )  # if we take 1 frame and skip N frames we're sampling 1/N+1 % of the video
-                        # so if we desire to sample 1/N of the video, we need to subtract one when doing frame skipping
-
-                        scene_manager.detect_scenes(video=video, frame_skip=frame_skip)
-                        cuts[f"cuts_{target_fps}"] = get_scenes_from_scene_manager(
-                            scene_manager, self.cut_detection_mode
-                        )
-                        scene_manager.clear()
+                if self.algorithm in ["vectorized", "vectorized_content"]:
+                    cuts.update(self.detect_scenes_vectorized(video, original_fps, min_scene_len))
+                else:
+                    cuts.update(self.detect_scenes(video, original_fps, min_scene_len))
         except Exception as err:  # pylint: disable=broad-except
             return {}, None, str(err)
 
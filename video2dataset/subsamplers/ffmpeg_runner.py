@@ -0,0 +1,152 @@
+"""
+shared ffmpeg/ffprobe runner that passes bytes through stdin/stdout pipes instead of temp files where the formats
+allow it
+"""
+import os
+import subprocess
+import tempfile
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+
+import ffmpeg
+
+
+# extension -> ffmpeg muxer, anything not in here is assumed to be named like its extension
+MUXERS = {
+    "m4a": "ipod",
+    "mkv": "matroska",
+    "jpg": "image2pipe",
+    "jpeg": "image2pipe",
+}
+# muxers that need to seek back to write the moov atom, these get fragmented output when piped and write the
+# final files of run_ffmpeg to a temp file to move the moov atom to the front
+FRAGMENTED_MUXERS = {"mp4", "ipod", "mov"}
+FRAGMENTED_MOVFLAGS = "frag_keyframe+empty_moov"
+FASTSTART_MOVFLAGS = "+faststart"
+
+
+def _has_child_box(stream_bytes: bytes, offset: int, size: int, child_type: bytes) -> bool:
+    """Whether the box at offset directly contains a box of child_type"""
+    child_offset, end = offset + 8, min(offset + size, len(stream_bytes))
+    while child_offset + 8 <= end:
+        child_size = int.from_bytes(stream_bytes[child_offset : child_offset + 4], "big")
+        if stream_bytes[child_offset + 4 : child_offset + 8] == child_type:
+            return True
+        if child_size < 8:
+            break
+        child_offset += child_size
+    return False
+
+
+def mp4_layout(stream_bytes: bytes) -> Optional[str]:
+    """
+    Walks the top level ISO BMFF (mp4/m4a/mov) boxes and tells how the container is laid out:
+    - "moov_first": index before the media data, can be demuxed from a pipe
+    - "moov_last": index after the media data, needs seeking
+    - "fragmented": moof fragments, can be demuxed from a pipe but only the full file gives correct durations
+    - None: not an ISO BMFF container (webm, mp3, ...)
+    """
+    if stream_bytes[4:8] not in (b"ftyp", b"styp", b"moov", b"free", b"wide", b"mdat", b"skip"):
+        return None
+    seen_mdat = False
+    offset = 0
+    while offset + 8 <= len(stream_bytes):
+        size = int.from_bytes(stream_bytes[offset : offset + 4], "big")
+        box_type = stream_bytes[offset + 4 : offset + 8]
+        if size == 1:
+            size = int.from_bytes(stream_bytes[offset + 8 : offset + 16], "big")
+        elif size == 0:  # box extends to the end of the file
+            size = len(stream_bytes) - offset
+        if box_type in (b"moof", b"sidx"):
+            return "fragmented"
+        if box_type == b"moov":
+            if seen_mdat:
+                return "moov_last"
+            return "fragmented" if _has_child_box(stream_bytes, offset, size, b"mvex") else "moov_first"
+        if box_type == b"mdat":
+            seen_mdat = True
+        if size < 8:
+            break
+        offset += size
+    return "moov_last"
+
+
+def needs_seekable_input(stream_bytes: bytes, probing: bool = False) -> bool:
+    """Whether ffmpeg (or ffprobe if probing) can only handle these bytes as a seekable file"""
+    layout = mp4_layout(stream_bytes)
+    if layout == "moov_last":
+        return True
+    # fragment durations are only summed up when the whole file can be scanned
+    return probing and layout == "fragmented"
+
+
+@contextmanager
+def input_path(stream_bytes: bytes, encode_format: str, probing: bool = False) -> Iterator[str]:
+    """Yields "pipe:" if the bytes can be streamed to ffmpeg, otherwise a temp file holding them"""
+    if not needs_seekable_input(stream_bytes, probing):
+        yield "pipe:"
+        return
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, f"input.{encode_format}")
+        with open(path, "wb") as f:
+            f.write(stream_bytes)
+        yield path
+
+
+def output_kwargs(encode_format: str, **kwargs) -> dict:
+    """ffmpeg output kwargs that make a muxer for encode_format write to a pipe, mp4 like muxers write fragments"""
+    muxer = MUXERS.get(encode_format, encode_format)
+    kwargs["format"] = muxer
+    if muxer in FRAGMENTED_MUXERS:
+        kwargs["movflags"] = FRAGMENTED_MOVFLAGS
+    return kwargs
+
+
+def run_ffmpeg(
+    stream_bytes: bytes,
+    input_format: str,
+    encode_format: str,
+    transform: Callable = lambda stream: stream,
+    input_kwargs: Optional[dict] = None,
+    **kwargs,
+) -> bytes:
+    """
+    Runs ffmpeg on in memory bytes and returns the output bytes.
+
+    Args:
+        stream_bytes: input media
+        input_format: extension of the input, only used to name the temp file for inputs that need seeking
+        encode_format: extension of the output (mp4, m4a, mp3, jpg...), mp4 like outputs are written to a temp
+            file with their index at the front (+faststart) since they're final files, the others are piped
+        transform: gets the ffmpeg-python input node and returns the node to write (f.e. with filters applied)
+        input_kwargs: extra ffmpeg input options
+        kwargs: extra ffmpeg output options
+    """
+    muxer = MUXERS.get(encode_format, encode_format)
+    with input_path(stream_bytes, input_format) as path:
+        node = transform(ffmpeg.input(path, **(input_kwargs or {})))
+        run_kwargs = {
+            "input": stream_bytes if path == "pipe:" else None,
+            "capture_stdout": True,
+            "capture_stderr": True,
+        }
+        if muxer not in FRAGMENTED_MUXERS:
+            out, _ = node.output("pipe:", **output_kwargs(encode_format, **kwargs)).run(**run_kwargs)
+            return out
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output_path = os.path.join(tmpdir, f"output.{encode_format}")
+            node.output(output_path, format=muxer, movflags=FASTSTART_MOVFLAGS, **kwargs).run(**run_kwargs)
+            with open(output_path, "rb") as f:
+                return f.read()
+
+
+def run_ffprobe(stream_bytes: bytes, input_format: str, args: list) -> str:
+    """Runs ffprobe with args on in memory bytes and returns stdout"""
+    with input_path(stream_bytes, input_format, probing=True) as path:
+        process = subprocess.run(
+            ["ffprobe", *args, path],
+            input=stream_bytes if path == "pipe:" else None,
+            capture_output=True,
+            check=True,
+        )
+    return process.stdout.decode("utf-8")
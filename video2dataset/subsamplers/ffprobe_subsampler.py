@@ -1,58 +1,175 @@
 """extracts basic video compression metadata."""
-import os
+import io
 import json
-import subprocess
-import tempfile
+from fractions import Fraction
 
+try:
+    import av
+except ImportError:  # only needed for the pyav backend
+    av = None
+
+from . import container_index
+from .ffmpeg_runner import run_ffprobe
 from .subsampler import Subsampler
 
 
-# TODO: figuer out why this is so slow (12 samples/s)
+def _fraction(value):
+    return "0/0" if not value else f"{value.numerator}/{value.denominator}"
+
+
+def _seconds(value, time_base):
+    return None if value is None else f"{float(value * time_base):.6f}"
+
+
+def _codec_tag(tag):
+    """(codec_tag_string, codec_tag) like ffprobe prints them"""
+    tag_bytes = (tag or "").encode("latin-1").ljust(4, b"\0")[:4]
+    tag_string = "".join(chr(c) if chr(c).isalnum() or chr(c) in " ._" else f"[{c}]" for c in tag_bytes)
+    return tag_string, f"0x{int.from_bytes(tag_bytes, 'little'):04x}"
+
+
+def _stream_metadata(stream):
+    """ffprobe -show_streams entry of a PyAV stream, with the fields PyAV exposes"""
+    codec_context = stream.codec_context
+    codec_tag_string, codec_tag = _codec_tag(codec_context.codec_tag)
+    info = {
+        "index": stream.index,
+        "codec_name": codec_context.codec.canonical_name,
+        "codec_long_name": codec_context.codec.long_name,
+        "profile": codec_context.profile,
+        "codec_type": stream.type,
+        "codec_tag_string": codec_tag_string,
+        "codec_tag": codec_tag,
+    }
+    if stream.type == "video":
+        sample_aspect_ratio = codec_context.sample_aspect_ratio or Fraction(1)
+        display_aspect_ratio = Fraction(codec_context.width, codec_context.height or 1) * sample_aspect_ratio
+        info.update(
+            {
+                "width": codec_context.width,
+                "height": codec_context.height,
+                "sample_aspect_ratio": f"{sample_aspect_ratio.numerator}:{sample_aspect_ratio.denominator}",
+                "display_aspect_ratio": f"{display_aspect_ratio.numerator}:{display_aspect_ratio.denominator}",
+                "pix_fmt": codec_context.pix_fmt,
+                "level": codec_context.level,
+            }
+        )
+    elif stream.type == "audio":
+        info.update(
+            {
+                "sample_fmt": codec_context.format.name if codec_context.format else None,
+                "sample_rate": str(codec_context.sample_rate),
+                "channels": codec_context.channels,
+                "channel_layout": codec_context.layout.name if codec_context.layout else None,
+            }
+        )
+    info.update(
+        {
+            "id": f"0x{stream.id:x}",
+            "r_frame_rate": _fraction(stream.base_rate) if stream.type == "video" else "0/0",
+            "avg_frame_rate": _fraction(stream.average_rate) if stream.type == "video" else "0/0",
+            "time_base": _fraction(stream.time_base),
+            "start_pts": stream.start_time,
+            "start_time": _seconds(stream.start_time, stream.time_base),
+            "duration_ts": stream.duration,
+            "duration": _seconds(stream.duration, stream.time_base),
+            "bit_rate": str(codec_context.bit_rate) if codec_context.bit_rate else None,
+            "nb_frames": str(stream.frames) if stream.frames else None,
+            "extradata_size": codec_context.extradata_size,
+            "disposition": {
+                name: int(bool(stream.disposition & flag)) for name, flag in av.stream.Disposition.__members__.items()
+            },
+            "tags": dict(stream.metadata),
+        }
+    )
+    return {key: value for key, value in info.items() if value is not None}
+
+
+def pyav_probe(stream_bytes, select_video=False, show_packets=False):
+    """
+    ffprobe -show_format -show_streams JSON of in memory bytes, read in process with PyAV. Fields PyAV doesn't
+    expose (probe_score, refs, colors, coded size, ...) are missing and codec_long_name is the decoder's.
+
+    select_video: only list the first video stream, like -select_streams v:0
+    show_packets: also list the pts_time and flags of its packets, like -show_entries packet=pts_time,flags
+    """
+    with av.open(io.BytesIO(stream_bytes)) as container:
+        selected = container.streams.video[:1] if select_video else container.streams
+        video_metadata = {
+            "streams": [_stream_metadata(stream) for stream in selected],
+            "format": {
+                "filename": "pipe:",
+                "nb_streams": len(container.streams),
+                "format_name": container.format.name,
+                "format_long_name": container.format.long_name,
+                "start_time": _seconds(container.start_time, 1 / av.time_base),
+                "duration": _seconds(container.duration, 1 / av.time_base),
+                "size": str(len(stream_bytes)),
+                "bit_rate": str(container.bit_rate) if container.bit_rate else None,
+                "tags": dict(container.metadata),
+            },
+        }
+        if show_packets:
+            video_metadata["packets"] = [
+                {"pts_time": _seconds(packet.pts, packet.time_base), "flags": "K" if packet.is_keyframe else "_"}
+                for packet in (container.demux(selected[0]) if selected else [])
+                if packet.pts is not None
+            ]
+    video_metadata["format"] = {key: value for key, value in video_metadata["format"].items() if value is not None}
+    return video_metadata
+
+
 class FFProbeSubsampler(Subsampler):
     """
     Extracts metadata from bytes.
     Args:
-        extract_keyframes (bool): Whether to extract keyframe timestamps.
+        extract_keyframes (bool): Whether to extract keyframe timestamps. They are read from the container index
+            (mp4 sample tables and fragments, webm/mkv cues) when possible, otherwise ffprobe lists all the packets.
+        backend (str): "ffprobe" to run ffprobe, "pyav" to read the metadata in process with PyAV (same schema,
+            without the few fields PyAV doesn't expose). Falls back to ffprobe with PyAV versions too old for it.
     """
 
-    def __init__(self, extract_keyframes=False):
+    def __init__(self, extract_keyframes=False, backend="ffprobe"):
+        if backend not in ["ffprobe", "pyav"]:
+            raise ValueError(f"Unknown probing backend {backend}")
+        if backend == "pyav" and av is None:
+            raise ModuleNotFoundError("the pyav probing backend requires PyAV to be installed. Run `pip install av`.")
+        if backend == "pyav" and not hasattr(av.stream, "Disposition"):  # only in recent PyAV versions
+            print(f"PyAV {av.__version__} doesn't expose the stream dispositions, probing with ffprobe instead")
+            backend = "ffprobe"
         self.extract_keyframes = extract_keyframes
+        self.backend = backend
 
     def __call__(self, streams, metadata):
         # TODO: this should also work for audio (maybe others)
         video_bytes = streams["video"][0]
-        with tempfile.TemporaryDirectory() as tmpdir:
-            with open(os.path.join(tmpdir, "input.mp4"), "wb") as f:
-                f.write(video_bytes)
-            try:
-                command = [
-                    "ffprobe",
-                    "-v",
-                    "quiet",
-                    "-print_format",
-                    "json",
-                    "-show_format",
-                    "-show_streams",
-                    f"{tmpdir}/input.mp4",
-                ]
+        try:
+            keyframe_timestamps = container_index.keyframe_timestamps(video_bytes) if self.extract_keyframes else None
+            # no index we can read, list the packets
+            show_packets = self.extract_keyframes and keyframe_timestamps is None
 
+            if self.backend == "pyav":
+                video_metadata = pyav_probe(video_bytes, self.extract_keyframes, show_packets)
+            else:
+                args = ["-v", "quiet", "-print_format", "json", "-show_format", "-show_streams"]
                 if self.extract_keyframes:
-                    command.extend(["-select_streams", "v:0", "-show_entries", "packet=pts_time,flags"])
+                    args.extend(["-select_streams", "v:0"])
+                if show_packets:
+                    args.extend(["-show_entries", "packet=pts_time,flags"])
+                video_metadata = json.loads(run_ffprobe(video_bytes, "mp4", args))
 
-                process = subprocess.run(command, capture_output=True, text=True, check=True)
-                video_metadata = json.loads(process.stdout)
-
-                if self.extract_keyframes:
+            if self.extract_keyframes:
+                if keyframe_timestamps is None:
                     keyframe_info = [entry for entry in video_metadata["packets"] if "K" in entry.get("flags", "")]
                     keyframe_timestamps = [float(entry["pts_time"]) for entry in keyframe_info]
-                    if "duration" in video_metadata["format"]:
-                        duration = float(video_metadata["format"]["duration"])
-                        keyframe_timestamps.append(duration)
-                    video_metadata["keyframe_timestamps"] = keyframe_timestamps
                     video_metadata.pop("packets")  # Don't need it anymore
-                metadata["video_metadata"] = video_metadata
+                if "duration" in video_metadata["format"]:
+                    duration = float(video_metadata["format"]["duration"])
+                    keyframe_timestamps.append(duration)
+                video_metadata["keyframe_timestamps"] = keyframe_timestamps
+            metadata["video_metadata"] = video_metadata
 
-            except Exception as err:  # pylint: disable=broad-except
-                return streams, metadata, str(err)
+        except Exception as err:  # pylint: disable=broad-except
+            return streams, metadata, str(err)
 
         return streams, metadata, None
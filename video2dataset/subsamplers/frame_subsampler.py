@@ -9,6 +9,7 @@ import ffmpeg
 
 from .subsampler import Subsampler
 from .clipping_subsampler import _get_seconds
+from .ffmpeg_runner import output_kwargs, run_ffmpeg
 
 
 class FrameSubsampler(Subsampler):
@@ -39,33 +40,42 @@ class FrameSubsampler(Subsampler):
         self.output_modality = "video" if downsample_method == "fps" else "jpg"
         self.encode_formats = {"video": encode_format}
 
+    def add_filters(self, stream):
+        """Appends the fps filter to an ffmpeg-python video stream"""
+        return stream.filter("fps", fps=self.frame_rate)
+
     def __call__(self, streams, metadata=None):
         video_bytes = streams["video"]
+        ext = self.encode_formats["video"]
         subsampled_bytes, subsampled_metas = [], []
         for i, vid_bytes in enumerate(video_bytes):
-            with tempfile.TemporaryDirectory() as tmpdir:
-                with open(os.path.join(tmpdir, "input.mp4"), "wb") as f:
-                    f.write(vid_bytes)
-                try:
-                    ext = "mp4"
-                    if self.downsample_method == "fps":
-                        _ = ffmpeg.input(f"{tmpdir}/input.mp4")
-                        _ = _.filter("fps", fps=self.frame_rate)
-                        _ = _.output(f"{tmpdir}/output.mp4", reset_timestamps=1).run(capture_stdout=True, quiet=True)
-                    elif self.downsample_method == "keyframe":
-                        _ = ffmpeg.input(f"{tmpdir}/input.mp4", discard="nokey")
-                        # _ = _.filter("select", "eq(pict_type,I)")
-                        _ = _.output(f"{tmpdir}/output.mp4", **{"c:s": "copy", "c": "copy", "copyts": None})
-                        _ = _.run(capture_stdout=True, quiet=True)
-                    elif "frame" in self.downsample_method:
-                        _ = ffmpeg.input(f"{tmpdir}/input.mp4")
-                        _ = _.filter("select", "eq(n,0)")
-                        _ = _.output(f"{tmpdir}/output.jpg").run(capture_stdout=True, quiet=True)
-                        ext = "jpg"
-                    elif self.downsample_method == "yt_subtitle":
-                        subtitles = metadata[i]["yt_meta_dict"]["subtitles"]
-                        starts = [_get_seconds(s["start"]) for s in subtitles]
+            try:
+                if self.downsample_method == "fps":
+                    subsampled_bytes.append(run_ffmpeg(vid_bytes, "mp4", ext, self.add_filters, reset_timestamps=1))
+                elif self.downsample_method == "keyframe":
+                    subsampled_bytes.append(
+                        run_ffmpeg(
+                            vid_bytes,
+                            "mp4",
+                            ext,
+                            input_kwargs={"discard": "nokey"},
+                            **{"c:s": "copy", "c": "copy", "copyts": None},
+                        )
+                    )
+                elif "frame" in self.downsample_method:
+                    subsampled_bytes.append(
+                        run_ffmpeg(
+                            vid_bytes, "mp4", "jpg", lambda s: s.filter("select", "eq(n,0)"), vframes=1, vcodec="mjpeg"
+                        )
+                    )
+                elif self.downsample_method == "yt_subtitle":
+                    subtitles = metadata[i]["yt_meta_dict"]["subtitles"]
+                    starts = [_get_seconds(s["start"]) for s in subtitles]
 
+                    # seeking to every subtitle start only works on a file
+                    with tempfile.TemporaryDirectory() as tmpdir:
+                        with open(os.path.join(tmpdir, "input.mp4"), "wb") as f:
+                            f.write(vid_bytes)
                         for frame_id, start_t in enumerate(starts):
                             frame_key = f"{frame_id:04d}"
                             meta_frame = copy.deepcopy(metadata[i])
@@ -75,21 +85,15 @@ class FrameSubsampler(Subsampler):
                             meta_frame["key"] = f"{meta_frame['key']}_{frame_key}"
 
                             _ = ffmpeg.input(f"{tmpdir}/input.mp4", ss=start_t)
-                            _ = _.output(f"{tmpdir}/frame_{frame_id}.jpg", vframes=1, **{"q:v": 2}).run(
-                                capture_stdout=True, quiet=True
-                            )
-                            with open(f"{tmpdir}/frame_{frame_id}.jpg", "rb") as f:
-                                subsampled_bytes.append(f.read())
+                            frame_bytes, _ = _.output(
+                                "pipe:", vframes=1, **output_kwargs("jpg", vcodec="mjpeg", **{"q:v": 2})
+                            ).run(capture_stdout=True, quiet=True)
+                            subsampled_bytes.append(frame_bytes)
                             subsampled_metas.append(meta_frame)
-
-                except Exception as err:  # pylint: disable=broad-except
-                    return [], None, str(err)
-
-                if self.downsample_method != "yt_subtitle":
-                    with open(f"{tmpdir}/output.{ext}", "rb") as f:
-                        subsampled_bytes.append(f.read())
-                else:
                     metadata = subsampled_metas
 
+            except Exception as err:  # pylint: disable=broad-except
+                return [], None, str(err)
+
         streams[self.output_modality] = subsampled_bytes
         return streams, metadata, None
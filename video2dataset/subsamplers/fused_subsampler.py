@@ -0,0 +1,123 @@
+"""
+fused subsampler runs clipping, resizing and fps subsampling as a single ffmpeg pass
+"""
+import glob
+import tempfile
+from typing import Any, Dict, List, Tuple
+
+import ffmpeg
+
+from .clipping_subsampler import ClippingSubsampler, _collate_clip_spans, _get_clips
+from .ffmpeg_runner import input_path, run_ffmpeg
+from .frame_subsampler import FrameSubsampler
+from .resolution_subsampler import ResolutionSubsampler
+from .subsampler import Subsampler
+
+
+def is_fusable(subsampler: Any) -> bool:
+    """Whether a video subsampler can be expressed as filters inside of a fused ffmpeg graph"""
+    if isinstance(subsampler, ResolutionSubsampler):
+        return True
+    return isinstance(subsampler, FrameSubsampler) and subsampler.downsample_method == "fps"
+
+
+def split_fusable(video_subsamplers: List[Any]) -> Tuple[List[Any], List[Any]]:
+    """Splits video subsamplers into the longest fusable prefix and the ones that still need to run afterwards"""
+    n_fusable = 0
+    while n_fusable < len(video_subsamplers) and is_fusable(video_subsamplers[n_fusable]):
+        n_fusable += 1
+    return video_subsamplers[:n_fusable], video_subsamplers[n_fusable:]
+
+
+class FusedSubsampler(Subsampler):
+    """
+    Compiles the broadcast subsampler (clipping or no-op) and the filter based video subsamplers
+    into one ffmpeg filter graph (segment + fps + scale/crop/pad) so each source video is decoded
+    once and each output clip is encoded once, instead of a decode/encode cycle per subsampler.
+
+    The fps filter is placed first in the graph so the resize filters only process kept frames.
+    Since the video is re-encoded anyway, keyframes are forced at the clip boundaries which makes
+    cuts exact regardless of the clipping precision. Non-video streams are clipped by stream copy
+    like in the ClippingSubsampler.
+
+    Args:
+        broadcast_subsampler (ClippingSubsampler | NoOpSubsampler): 1 video -> many videos subsampler to fuse,
+            also used as is for samples without a video stream
+        video_subsamplers (list): fusable video subsamplers (see split_fusable) in the order they're configured
+        encode_formats (dict): output formats, the video format is used for the fused output
+    """
+
+    def __init__(self, broadcast_subsampler, video_subsamplers, encode_formats):
+        assert all(is_fusable(s) for s in video_subsamplers)
+        self.broadcast_subsampler = broadcast_subsampler
+        self.clipping_subsampler = (
+            broadcast_subsampler if isinstance(broadcast_subsampler, ClippingSubsampler) else None
+        )
+        # fps first so scaling/cropping/padding only runs on frames that are kept
+        self.video_subsamplers = [s for s in video_subsamplers if isinstance(s, FrameSubsampler)] + [
+            s for s in video_subsamplers if not isinstance(s, FrameSubsampler)
+        ]
+        self.encode_formats = encode_formats
+
+    def _add_filters(self, stream):
+        """Builds the fused filter graph on top of an ffmpeg-python input node"""
+        stream = stream.video
+        for subsampler in self.video_subsamplers:
+            stream = subsampler.add_filters(stream)
+        return stream
+
+    def _clip_video(self, video_bytes: bytes, clip_spans: List[List[float]]) -> List[bytes]:
+        """Clips and transforms the video in one pass using the segment muxer"""
+        clip_times, clip_idxs = _collate_clip_spans(clip_spans)
+        ext = self.encode_formats["video"]
+        with tempfile.TemporaryDirectory() as tmpdir, input_path(video_bytes, "mp4") as path:
+            self._add_filters(ffmpeg.input(path)).output(
+                f"{tmpdir}/clip_%d.{ext}",
+                f="segment",
+                segment_times=clip_times,
+                force_key_frames=clip_times,
+                reset_timestamps=1,
+            ).run(input=video_bytes if path == "pipe:" else None, capture_stdout=True, quiet=True)
+            stream_clips = glob.glob(f"{tmpdir}/clip*.{ext}")
+            stream_clips.sort(key=lambda x: int(x.split("_")[-1].split(".")[0]))
+            clips = []
+            for clip_idx in clip_idxs:
+                with open(stream_clips[clip_idx], "rb") as f:
+                    clips.append(f.read())
+        return clips
+
+    def _transform_video(self, video_bytes: bytes) -> bytes:
+        """Transforms the whole video in one pass"""
+        return run_ffmpeg(video_bytes, "mp4", self.encode_formats["video"], self._add_filters, reset_timestamps=1)
+
+    def __call__(self, streams, metadata):
+        if streams.get("video", [None])[0] is None:  # nothing to fuse, e.g. audio only samples
+            return self.broadcast_subsampler(streams, metadata)
+        video_bytes = streams["video"][0]  # pre-broadcast so only one
+        other_streams = {k: v for k, v in streams.items() if k != "video"}
+
+        try:
+            if self.clipping_subsampler is None:
+                fused_streams: Dict[str, List[bytes]] = {k: list(v) for k, v in other_streams.items()}
+                fused_streams["video"] = [self._transform_video(video_bytes)]
+                return fused_streams, [metadata], None
+
+            strtime_formatting = isinstance(metadata["clips"][0][0], str)
+            clip_spans = self.clipping_subsampler.get_clip_spans(metadata)
+            if len(clip_spans) == 0:
+                return {}, [], f"Video had no clip_spans longer than {self.clipping_subsampler.min_length}"
+
+            fused_streams, clip_metadata = _get_clips(
+                streams=other_streams,
+                encode_formats=self.clipping_subsampler.encode_formats,
+                precision=self.clipping_subsampler.precision,
+                clip_spans=clip_spans,
+                metadata=metadata,
+                oom_clip_count=self.clipping_subsampler.oom_clip_count,
+                strtime_formatting=strtime_formatting,
+            )
+            fused_streams["video"] = self._clip_video(video_bytes, clip_spans)
+        except Exception as err:  # pylint: disable=broad-except
+            return {}, [], str(err)
+
+        return fused_streams, clip_metadata, None
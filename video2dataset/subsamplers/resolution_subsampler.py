@@ -1,11 +1,9 @@
 """
 resolution subsampler adjusts the resolution of the videos to some constant value
 """
-import os
-import ffmpeg
-import tempfile
 from typing import Literal
 
+from .ffmpeg_runner import run_ffmpeg
 from .subsampler import Subsampler
 
 
@@ -40,31 +38,30 @@ class ResolutionSubsampler(Subsampler):
         self.height = height if video_size < 0 else video_size
         self.width = width if video_size < 0 else video_size
         self.video_size = video_size
-        self.encode_formats = encode_formats
+        self.encode_formats = {"video": encode_formats}
+
+    def add_filters(self, stream):
+        """Appends the resize filters to an ffmpeg-python video stream"""
+        if "scale" in self.resize_mode:
+            if self.height > 0:
+                stream = stream.filter("scale", -2, self.height)
+            else:
+                stream = stream.filter("scale", self.width, -2)
+        if "crop" in self.resize_mode:
+            stream = stream.filter("crop", w=self.width, h=self.height)
+        if "pad" in self.resize_mode:
+            stream = stream.filter("pad", w=self.width, h=self.height)
+        return stream
 
     def __call__(self, streams, metadata=None):
         video_bytes = streams["video"]
         subsampled_bytes = []
         for vid_bytes in video_bytes:
-            with tempfile.TemporaryDirectory() as tmpdir:
-                with open(os.path.join(tmpdir, "input.mp4"), "wb") as f:
-                    f.write(vid_bytes)
-                try:
-                    _ = ffmpeg.input(f"{tmpdir}/input.mp4")
-                    if "scale" in self.resize_mode:
-                        if self.height > 0:
-                            _ = _.filter("scale", -2, self.height)
-                        else:
-                            _ = _.filter("scale", self.width, -2)
-                    if "crop" in self.resize_mode:
-                        _ = _.filter("crop", w=self.width, h=self.height)
-                    if "pad" in self.resize_mode:
-                        _ = _.filter("pad", w=self.width, h=self.height)
-                    _ = _.output(f"{tmpdir}/output.mp4", reset_timestamps=1).run(capture_stdout=True, quiet=True)
-                except Exception as err:  # pylint: disable=broad-except
-                    return [], None, str(err)
-
-                with open(f"{tmpdir}/output.mp4", "rb") as f:
-                    subsampled_bytes.append(f.read())
+            try:
+                subsampled_bytes.append(
+                    run_ffmpeg(vid_bytes, "mp4", self.encode_formats["video"], self.add_filters, reset_timestamps=1)
+                )
+            except Exception as err:  # pylint: disable=broad-except
+                return [], None, str(err)
         streams["video"] = subsampled_bytes
         return streams, metadata, None
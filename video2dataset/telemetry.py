@@ -0,0 +1,90 @@
+"""push based stats from the workers to the logger process through a local UNIX datagram socket"""
+
+import json
+import os
+import socket
+import tempfile
+import uuid
+
+
+# address of the logger's socket, inherited by the worker processes
+TELEMETRY_ENV = "VIDEO2DATASET_TELEMETRY"
+
+
+class TelemetryClient:
+    """Sends stats to the logger, sample stats are dropped instead of slowing the workers down if the logger lags"""
+
+    def __init__(self, address):
+        self.address = address
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def _send(self, message, block):
+        try:
+            self.socket.settimeout(1.0 if block else 0.0)
+            self.socket.sendto(json.dumps(message).encode(), self.address)
+        except OSError:  # logger gone or busy
+            pass
+
+    def sample(self, status, bytes_downloaded):
+        self._send({"type": "sample", "status": status, "bytes_downloaded": bytes_downloaded}, block=False)
+
+    def shard(self, stats_file):
+        self._send({"type": "shard", "stats_file": stats_file}, block=True)
+
+
+_clients = {}
+
+
+def get_client():
+    """The telemetry client of this process if the logger listens for stats, None otherwise"""
+    address = os.environ.get(TELEMETRY_ENV)
+    if address is None:
+        return None
+    # one per process, sockets don't survive forks
+    key = (os.getpid(), address)
+    if key not in _clients:
+        _clients[key] = TelemetryClient(address)
+    return _clients[key]
+
+
+def report_sample(status, bytes_downloaded):
+    client = get_client()
+    if client is not None:
+        client.sample(status, bytes_downloaded)
+
+
+def report_shard(stats_file):
+    client = get_client()
+    if client is not None:
+        client.shard(stats_file)
+
+
+class TelemetryReceiver:
+    """Socket the logger process receives the stats of the workers on"""
+
+    def __init__(self, address):
+        self.address = address
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(address)
+
+    @staticmethod
+    def new_address():
+        # short path in the temp dir since UNIX socket paths are limited to ~100 characters
+        return os.path.join(tempfile.gettempdir(), f"v2d_{uuid.uuid4().hex[:16]}.sock")
+
+    def receive(self, timeout):
+        """Waits up to timeout seconds for messages, then returns all the messages that are available"""
+        messages = []
+        self.socket.settimeout(timeout)
+        try:
+            while True:
+                messages.append(json.loads(self.socket.recv(65536)))
+                self.socket.settimeout(0.0)
+        except (BlockingIOError, socket.timeout):
+            pass
+        return messages
+
+    def close(self):
+        self.socket.close()
+        if os.path.exists(self.address):
+            os.remove(self.address)
@@ -1,5 +1,5 @@
 """Type definitions for video2dataset."""
-from typing import List, TypedDict
+from typing import List, NamedTuple, Tuple, TypedDict
 
 
 class EncodeFormats(TypedDict, total=False):
@@ -10,3 +10,19 @@ class EncodeFormats(TypedDict, total=False):
 class Streams(TypedDict, total=False):
     video: List[bytes]
     audio: List[bytes]
+
+
+class FileStream(NamedTuple):
+    """A downloaded stream that stays on disk until it's written, instead of being read into memory"""
+
+    path: str
+
+
+class ParquetShard(NamedTuple):
+    """Rows [offset, offset + num_rows) of a parquet input file, read by the workers in place of a feather shard file"""
+
+    path: str
+    offset: int
+    num_rows: int
+    columns: Tuple[str, ...]  # input columns to read
+    names: Tuple[str, ...]  # names of these columns in the shard (url, caption, ...)
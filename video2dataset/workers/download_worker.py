@@ -1,6 +1,9 @@
 """the downloader module handles the downloading"""
 
+import contextlib
+import copy
 import math
+import os
 import time
 import pyarrow as pa
 import traceback
@@ -8,21 +11,32 @@ import traceback
 import fsspec
 
 from multiprocessing.pool import ThreadPool
-from threading import Semaphore
-from typing import List, Any
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Semaphore
+from typing import Dict, List, Any, Union
 import numpy as np
 
+from video2dataset.async_data_reader import AsyncDownloadPool
 from video2dataset.data_reader import VideoDataReader
-from video2dataset.logger import CappedCounter
+from video2dataset.data_writer import stream_size
+from video2dataset.input_sharder import read_shard, remove_shard
+from video2dataset.logger import CappedCounter, StageStats
+from video2dataset.logger import merge_stats
 from video2dataset.logger import write_stats
+from video2dataset.rate_limiter import AdaptiveRateLimiter
+from video2dataset.retry import SampleRetryQueue
+from video2dataset.telemetry import report_sample
+from video2dataset.v2d_types import ParquetShard
 from video2dataset.subsamplers import (
     ClippingSubsampler,
     CutDetectionSubsampler,
     FrameSubsampler,
     FFProbeSubsampler,
+    FusedSubsampler,
     NoOpSubsampler,
     ResolutionSubsampler,
     AudioRateSubsampler,
+    split_fusable,
 )
 
 
@@ -35,6 +49,32 @@ def compute_key(key, shard_id, oom_sample_per_shard, oom_shard_count):
     return str_key
 
 
+def merge_modal_metas(metas, modal_metas):
+    """
+    Merges the metas returned by the subsamplers of each modality, which ran on their own copies of metas, into
+    (metas, error_message). The fields set by the modalities are merged, unless a modality changed the number of
+    samples (f.e. a frame per subtitle), then it has to be the only modality that changed the metas.
+    """
+    modal_changes = {
+        modality: [
+            {k: v for k, v in modal_meta.items() if k not in meta or meta[k] is not v}
+            for meta, modal_meta in zip(metas, m)
+        ]
+        for modality, m in modal_metas.items()
+        if len(m) == len(metas)
+    }
+    resized = [modality for modality in modal_metas if modality not in modal_changes]
+    if not resized:
+        merged_metas = [dict(meta) for meta in metas]
+        for changes in modal_changes.values():
+            for merged_meta, fields in zip(merged_metas, changes):
+                merged_meta.update(fields)
+        return merged_metas, None
+    if len(resized) == 1 and not any(fields for changes in modal_changes.values() for fields in changes):
+        return modal_metas[resized[0]], None
+    return metas, f"the metadata set by the {' and '.join(modal_metas)} subsamplers can't be merged"
+
+
 class DownloadWorker:
     """The downloader class gets calls with shards, download them then call the writer to write them down"""
 
@@ -51,12 +91,13 @@ class DownloadWorker:
         self.sample_writer_class = sample_writer_class
         self.save_caption = save_caption
         self.output_folder = output_folder
+        # parts of shards downloaded by the work stealing distributor, merged into shards once complete
+        self.parts_folder = output_folder + "/_tmp/parts"
         self.column_list = column_list
+        self.tmp_dir = tmp_dir
         self.encode_formats = encode_formats
         self.config = config
 
-        self.data_reader = VideoDataReader(encode_formats, tmp_dir, config["reading"])
-
         self.clipping_subsampler = ClippingSubsampler(
             5,  # oom_clip_count
             encode_formats,
@@ -92,8 +133,46 @@ class DownloadWorker:
         if "AudioRateSubsampler" in self.config["subsampling"]:
             audio_subsamplers.append(AudioRateSubsampler(**self.config["subsampling"]["AudioRateSubsampler"]["args"]))
 
+        # 1 video -> many videos (either clipping or noop which does identity broadcasting)
+        self.broadcast_subsampler = (
+            self.clipping_subsampler
+            if ("clips" in self.column_list or self.config["storage"]["captions_are_subtitles"] or self.cuts_are_clips)
+            else self.noop_subsampler
+        )
+
+        # decode and encode once for clipping + resizing + fps subsampling
+        self.fused_encode_format = None
+        if "FusedSubsampler" in self.config["subsampling"]:
+            fused_video_subsamplers, video_subsamplers = split_fusable(video_subsamplers)
+            if fused_video_subsamplers:
+                self.fused_encode_format = fused_video_subsamplers[0].encode_formats["video"]
+                self.broadcast_subsampler = FusedSubsampler(
+                    self.broadcast_subsampler,
+                    fused_video_subsamplers,
+                    {"video": self.fused_encode_format},
+                )
+
         self.subsamplers = {"video": video_subsamplers, "audio": audio_subsamplers}
 
+        # when clipping is the only subsampling after the broadcast, each clip is written as soon as it's read
+        # instead of holding all the clips of the video in memory
+        self.write_clips_incrementally = self.broadcast_subsampler is self.clipping_subsampler and not any(
+            self.subsamplers.values()
+        )
+
+        # without subsampling the downloaded files can be copied into the shard straight from disk
+        self.stream_files = (
+            self.ffprobe_subsampler is None
+            and self.cut_detector is None
+            and self.broadcast_subsampler is self.noop_subsampler
+            and not any(self.subsamplers.values())
+        )
+        self.data_reader = VideoDataReader(encode_formats, tmp_dir, config["reading"], self.stream_files)
+
+        # shared by the shards the process downloads so what's learned about each domain carries over
+        rate_limit_args = config["reading"].get("rate_limit_args")
+        self.rate_limiter = AdaptiveRateLimiter(**rate_limit_args) if rate_limit_args is not None else None
+
     def __call__(
         self,
         row,
@@ -106,6 +185,56 @@ class DownloadWorker:
             print(f"shard {row[0]} failed with error {err}")
             return (False, row)
 
+    def shard_name(self, shard_id):
+        return "{shard_id:0{oom_shard_count}d}".format(  # pylint: disable=consider-using-f-string
+            shard_id=shard_id, oom_shard_count=self.config["storage"]["oom_shard_count"]
+        )
+
+    def part_name(self, shard_id, start):
+        oom_sample_per_shard = math.ceil(math.log10(self.config["storage"]["number_sample_per_shard"]))
+        return f"{self.shard_name(shard_id)}_{start:0{oom_sample_per_shard}d}"
+
+    def shard_parts(self, row, chunk_size):
+        """Splits a shard into part rows (shard_file, shard_id, start, end) of chunk_size samples"""
+        shard_file, shard_id = row
+        count = shard_file.num_rows if isinstance(shard_file, ParquetShard) else read_shard(shard_file).num_rows
+        return [(shard_file, shard_id, start, min(start + chunk_size, count)) for start in range(0, count, chunk_size)]
+
+    def download_shard_part(self, part):
+        """Downloads the samples [start, end) of a shard to a part of the shard in parts_folder"""
+        try:
+            shard_file, shard_id, start, end = part
+            fs, parts_path = fsspec.core.url_to_fs(self.parts_folder)
+            fs.makedirs(parts_path, exist_ok=True)
+            self.download_samples(shard_file, shard_id, self.parts_folder, self.part_name(shard_id, start), start, end)
+            return (True, part)
+        except Exception as err:  # pylint: disable=broad-except
+            traceback.print_exc()
+            print(f"part {part[:3]} failed with error {err}")
+            return (False, part)
+
+    def merge_shard_parts(self, row, parts):
+        """Merges the parts of a shard written by download_shard_part into the shard, in order"""
+        try:
+            shard_file, shard_id = row
+            part_names = [self.part_name(shard_id, start) for _, _, start, _ in parts]
+            self.sample_writer_class.merge(self.parts_folder, part_names, self.output_folder, self.shard_name(shard_id))
+            # the stats are written last since they mark the shard as done
+            merge_stats(
+                [f"{self.parts_folder}/{part}_stats.json" for part in part_names],
+                self.output_folder,
+                shard_id,
+                self.config["storage"]["oom_shard_count"],
+            )
+            fs, parts_path = fsspec.core.url_to_fs(self.parts_folder)
+            fs.rm([path for part in part_names for path in fs.glob(f"{parts_path}/{part}*")], recursive=True)
+            remove_shard(shard_file)
+            return (True, row)
+        except Exception as err:  # pylint: disable=broad-except
+            traceback.print_exc()
+            print(f"merging shard {row[0]} failed with error {err}")
+            return (False, row)
+
     def download_shard(
         self,
         row,
@@ -114,11 +243,61 @@ class DownloadWorker:
 
         # shard_id, shard_file = row
         shard_file, shard_id = row
+        self.download_samples(shard_file, shard_id, self.output_folder, shard_id)
+        remove_shard(shard_file)
+
+    def run_modal_subsamplers(self, streams, metas, stage_stats, pool=None):
+        """
+        Runs the subsamplers of each modality on the broadcasted streams. Without a pool the chains of the
+        modalities run one after the other on the same streams and metas. With a pool they run concurrently, each
+        on its own copy of the streams and metas, and their results are merged: the modality of each chain and the
+        streams it added (f.e. the jpg of a FrameSubsampler), and the metadata fields each chain set.
+        Returns (streams, metas, error_message)
+        """
+
+        def run_chain(modality, chain_streams, chain_metas):
+            for modality_subsampler in self.subsamplers[modality]:
+                chain_streams, chain_metas, error_message = stage_stats.run(
+                    type(modality_subsampler).__name__, modality_subsampler, chain_streams, chain_metas
+                )
+                if error_message is not None:
+                    return chain_streams, chain_metas, error_message
+            return chain_streams, chain_metas, None
+
+        modalities = [modality for modality in streams if self.subsamplers.get(modality)]
+        if pool is None or len(modalities) < 2:
+            chain_streams, chain_metas = dict(streams), metas
+            for modality in modalities:
+                chain_streams, chain_metas, error_message = run_chain(modality, chain_streams, chain_metas)
+                if error_message is not None:
+                    return {}, metas, error_message
+            return chain_streams, chain_metas, None
+
+        def run_chain_copy(modality):
+            return run_chain(modality, dict(streams), [dict(meta) for meta in metas])
+
+        futures = [pool.submit(run_chain_copy, modality) for modality in modalities[1:]]
+        results = [run_chain_copy(modalities[0])]
+        # the pool also runs the samples, a chain no thread picked up yet runs here rather than being waited for
+        results += [run_chain_copy(m) if f.cancel() else f.result() for m, f in zip(modalities[1:], futures)]
+
+        merged_streams = dict(streams)
+        for modality, (chain_streams, _, error_message) in zip(modalities, results):
+            if error_message is not None:
+                return {}, metas, error_message
+            for stream_modality, stream in chain_streams.items():
+                if stream_modality == modality or stream_modality not in streams:
+                    merged_streams[stream_modality] = stream
+        merged_metas, error_message = merge_modal_metas(metas, {m: r[1] for m, r in zip(modalities, results)})
+        if error_message is not None:
+            return {}, metas, error_message
+        return merged_streams, merged_metas, None
+
+    def download_samples(self, shard_file, shard_id, output_folder, shard_name, start=0, end=None):
+        """Downloads the samples [start, end) of a shard and writes them to shard_name in output_folder"""
         start_time = time.time()
 
-        fs, shard_path = fsspec.core.url_to_fs(shard_file)
-        with fs.open(shard_path, "rb") as f:
-            df = pa.ipc.open_file(f).read_all()
+        df = read_shard(shard_file, start, end)
         schema = df.schema
         schema = (
             schema.append(pa.field("key", pa.string()))
@@ -127,11 +306,12 @@ class DownloadWorker:
         )
 
         pydict = df.select(self.column_list).to_pydict()
-        shard_to_dl = list(enumerate(zip(*(pydict[col] for col in self.column_list))))
+        shard_to_dl = list(enumerate(zip(*(pydict[col] for col in self.column_list)), start))
         del pydict
         del df
 
         status_dict = CappedCounter()
+        stage_stats = StageStats()
 
         count = len(shard_to_dl)
         successes = 0
@@ -144,17 +324,47 @@ class DownloadWorker:
         caption_indice = self.column_list.index("caption") if "caption" in self.column_list else None
         key_url_list = [(key, x[url_indice]) for key, x in shard_to_dl]
 
-        semaphore = Semaphore(self.config["distribution"]["thread_count"])
+        # rows with the same url (f.e. several clips of a video) are served by the download of the first one
+        same_url_keys: Dict[int, List[int]] = {}
+        first_keys: Dict[str, int] = {}
+        for key, url in key_url_list:
+            same_url_keys.setdefault(first_keys.setdefault(url, key), []).append(key)
+        key_url_list = [(key, url) for key, url in key_url_list if key in same_url_keys]
+
+        # direct links are cheap to have in flight when downloaded asynchronously
+        max_in_flight = self.config["distribution"]["thread_count"]
+        if self.config["reading"].get("async_args") is not None:
+            max_in_flight = max(max_in_flight, self.config["reading"]["async_args"].get("limit", 256))
+        semaphore = Semaphore(max_in_flight)
+
+        # when each sample was handed to the readers, to time their download
+        submit_times = {}
+
+        # samples that failed with a transient error are handed to the readers again after a backoff
+        retry_args = self.config["reading"].get("retry_args")
+        if retry_args is None:
+            retry_args = {"max_retries": 0}
+        retry_queue = SampleRetryQueue(len(key_url_list), **retry_args)
+
+        rows = retry_queue.iterate(key_url_list)
+        # the slots this shard holds in the rate limiter, shared with the other shards the process downloads
+        domain_schedule = self.rate_limiter.schedule(rows) if self.rate_limiter is not None else None
+        if domain_schedule is not None:
+            rows = domain_schedule
 
         def data_generator():
-            for e in key_url_list:
-                semaphore.acquire()  # pylint: disable=(consider-using-with)
+            for e in rows:
+                with stage_stats.time("semaphore_wait"):
+                    semaphore.acquire()  # pylint: disable=(consider-using-with)
+                submit_times[e[0]] = time.perf_counter()
                 yield e
 
         loader = data_generator()
 
         # The subsamplers might change the output format, so we need to update the writer
         writer_encode_formats = self.encode_formats.copy()
+        if self.fused_encode_format is not None:
+            writer_encode_formats["video"] = self.fused_encode_format
         if self.subsamplers["audio"]:
             writer_encode_formats["audio"] = self.subsamplers["audio"][0].encode_formats["audio"]
         if self.subsamplers["video"]:
@@ -162,8 +372,8 @@ class DownloadWorker:
 
         # give schema to writer
         sample_writer = self.sample_writer_class(
-            shard_id,
-            self.output_folder,
+            shard_name,
+            output_folder,
             self.save_caption,
             self.config["storage"]["oom_shard_count"],
             schema,
@@ -171,125 +381,209 @@ class DownloadWorker:
         )
         oom_sample_per_shard = math.ceil(math.log10(self.config["storage"]["number_sample_per_shard"]))
 
-        with ThreadPool(self.config["distribution"]["thread_count"]) as thread_pool:
-            for key, streams, yt_meta_dict, error_message in thread_pool.imap_unordered(
-                self.data_reader,  # pylint: disable=(unnecessary-lambda)
-                loader,
-            ):
-                try:
-                    _, sample_data = shard_to_dl[key]
-                    str_key = compute_key(
-                        key, shard_id, oom_sample_per_shard, self.config["storage"]["oom_shard_count"]
-                    )
-                    meta = {
-                        **{self.column_list[i]: sample_data[i] for i in range(len(self.column_list))},
-                        "key": str_key,
-                        "status": None,
-                        "error_message": error_message,
-                        "yt_meta_dict": yt_meta_dict,
-                    }
-
-                    if error_message is not None:
-                        print(error_message)
-                        if "[youtube]" in error_message:  # video-specific error, remove videoID
-                            error_message = "ERROR: [youtube]:" + error_message.split(":")[-1]
-                        raise ValueError("failed_to_download")
-
-                    for stream in streams.values():
-                        bytes_downloaded += len(stream)
-                    for mod in streams:
-                        streams[mod] = [streams[mod]]
-
-                    if self.ffprobe_subsampler is not None:
-                        streams, meta, error_message = self.ffprobe_subsampler(streams, meta)
-                        if error_message is not None:
-                            raise ValueError("failed_to_subsample")
-
-                    if self.config["storage"]["captions_are_subtitles"]:  # create clips
-                        # all langs have same start and end times
-                        subtitles = meta["yt_meta_dict"]["subtitles"][list(meta["yt_meta_dict"]["subtitles"].keys())[0]]
-                        meta["clips"] = [[line_dict["start"], line_dict["end"]] for line_dict in subtitles]
-                    elif self.cut_detector is not None:  # apply cut detection to get clips
-                        streams, cuts, error_message = self.cut_detector(streams)
+        if self.config["reading"].get("async_args") is not None:
+            reader_pool: Union[AsyncDownloadPool, ThreadPool] = AsyncDownloadPool(
+                self.config["distribution"]["thread_count"],
+                self.tmp_dir,
+                self.encode_formats,
+                self.config["reading"],
+            )
+            read = self.data_reader  # the pool downloads direct links itself, the others go through data_reader.read
+        else:
+            reader_pool = ThreadPool(max(1, min(self.config["distribution"]["thread_count"], count)))
+            read = self.data_reader.read
+
+        # the subsampling of the samples runs in its own threads (ffmpeg releases the GIL) so it overlaps with
+        # the downloads, the semaphore bounds the number of samples being downloaded or waiting to be subsampled
+        subsampling_thread_count = self.config["distribution"].get("subsampling_thread_count")
+        subsampling_pool = ThreadPoolExecutor(subsampling_thread_count) if subsampling_thread_count else None
+        write_lock = Lock()
+
+        def process_download(download_key, downloaded, yt_meta_dict, download_error, download_bytes):
+            """Subsamples and writes the rows served by a download, then frees its slot for another download"""
+            nonlocal successes
+            try:
+                keys = same_url_keys[download_key]
+                for key in keys:
+                    error_message = download_error
+                    meta = {}
+                    clip_stack = contextlib.ExitStack()
+                    try:
+                        _, sample_data = shard_to_dl[key - start]
+                        str_key = compute_key(
+                            key, shard_id, oom_sample_per_shard, self.config["storage"]["oom_shard_count"]
+                        )
+                        meta = {
+                            **{self.column_list[i]: sample_data[i] for i in range(len(self.column_list))},
+                            "key": str_key,
+                            "status": None,
+                            "error_message": error_message,
+                            # subsamplers may replace fields of yt_meta_dict, each row gets its own shallow copy
+                            "yt_meta_dict": copy.copy(yt_meta_dict),
+                        }
 
                         if error_message is not None:
-                            raise ValueError("failed_to_subsample")
-
-                        meta["cuts"] = cuts
-
-                    if self.cuts_are_clips:
-                        cuts = meta["cuts"]["cuts_original_fps"]
-                        native_fps = meta["cuts"]["original_fps"]
-                        meta["clips"] = (np.array(cuts) / native_fps).tolist()
-
-                    # 1 video -> many videos (either clipping or noop which does identity broadcasting)
-                    broadcast_subsampler = (
-                        self.clipping_subsampler
-                        if (
-                            "clips" in self.column_list
-                            or self.config["storage"]["captions_are_subtitles"]
-                            or self.cuts_are_clips
+                            print(error_message)
+                            if "[youtube]" in error_message:  # video-specific error, remove videoID
+                                error_message = "ERROR: [youtube]:" + error_message.split(":")[-1]
+                            raise ValueError("failed_to_download")
+
+                        streams = {mod: [stream] for mod, stream in downloaded.items()}
+
+                        if self.ffprobe_subsampler is not None:
+                            streams, meta, error_message = stage_stats.run(
+                                "FFProbeSubsampler", self.ffprobe_subsampler, streams, meta
+                            )
+                            if error_message is not None:
+                                raise ValueError("failed_to_subsample")
+
+                        if self.config["storage"]["captions_are_subtitles"]:  # create clips
+                            # all langs have same start and end times
+                            subtitles = meta["yt_meta_dict"]["subtitles"][
+                                list(meta["yt_meta_dict"]["subtitles"].keys())[0]
+                            ]
+                            meta["clips"] = [[line_dict["start"], line_dict["end"]] for line_dict in subtitles]
+                        elif self.cut_detector is not None:  # apply cut detection to get clips
+                            streams, cuts, error_message = stage_stats.run(
+                                "CutDetectionSubsampler", self.cut_detector, streams
+                            )
+
+                            if error_message is not None:
+                                raise ValueError("failed_to_subsample")
+
+                            meta["cuts"] = cuts
+
+                        if self.cuts_are_clips:
+                            cuts = meta["cuts"]["cuts_original_fps"]
+                            native_fps = meta["cuts"]["original_fps"]
+                            meta["clips"] = (np.array(cuts) / native_fps).tolist()
+
+                        if self.write_clips_incrementally:
+                            try:
+                                with stage_stats.time("ClippingSubsampler"):
+                                    subsampled_clips = clip_stack.enter_context(
+                                        self.clipping_subsampler.clip_files(streams, meta)
+                                    )
+                            except Exception as err:  # pylint: disable=broad-except
+                                error_message = str(err)
+                                meta["clips"] = []
+                                raise ValueError("failed_to_subsample") from err
+                        else:
+                            subsampled_streams, metas, error_message = stage_stats.run(
+                                type(self.broadcast_subsampler).__name__, self.broadcast_subsampler, streams, meta
+                            )
+
+                            if error_message is None:
+                                subsampled_streams, metas, error_message = self.run_modal_subsamplers(
+                                    subsampled_streams, metas, stage_stats, subsampling_pool
+                                )
+
+                            if error_message is not None:
+                                meta["clips"] = []
+                                raise ValueError("failed_to_subsample")
+
+                            subsampled_clips = list(
+                                zip(
+                                    [dict(zip(subsampled_streams, s)) for s in zip(*subsampled_streams.values())],
+                                    metas,
+                                )
+                            )
+
+                        status = "success"
+                        # every clip is cut and captioned before the first one is written so that a failing sample
+                        # doesn't leave some of its clips in the shard, the cut clips are read one at a time
+                        text_captions = []
+                        for _, clip_meta in subsampled_clips:
+                            clip_meta["status"] = status
+                            text_caption = sample_data[caption_indice] if caption_indice is not None else None
+                            if self.config["storage"]["captions_are_subtitles"]:
+                                text_caption = clip_meta.get("clip_subtitles")[0]["lines"]
+                            text_captions.append(text_caption)
+
+                        for (subsampled_streams, clip_meta), text_caption in zip(subsampled_clips, text_captions):
+                            if self.write_clips_incrementally:
+                                subsampled_streams = self.clipping_subsampler.read_clip(subsampled_streams)
+                            with write_lock, stage_stats.time("write"):
+                                sample_writer.write(
+                                    subsampled_streams,
+                                    clip_meta["key"],
+                                    text_caption,
+                                    clip_meta,
+                                )
+                        with write_lock:
+                            successes += 1
+                            status_dict.increment(status)
+                    except Exception as err:  # pylint: disable=broad-except
+                        status = str(err)
+                        if status.startswith("failed_to_"):
+                            meta["status"] = status
+                            meta["error_message"] = error_message
+                            with write_lock:
+                                failed[status] += 1
+                                status_dict.increment(error_message)
+                                sample_writer.write(
+                                    {},
+                                    str_key,
+                                    sample_data[caption_indice] if caption_indice is not None else None,
+                                    meta,
+                                )
+                        else:
+                            traceback.print_exc()
+                            print(f"Sample {key} failed to download: {err}")
+                    finally:
+                        clip_stack.close()
+                    if status == "success" or status.startswith("failed_to_"):
+                        with write_lock:
+                            report_sample(status, download_bytes if key == keys[0] else 0)
+            finally:
+                if self.stream_files:
+                    for stream in downloaded.values():
+                        os.remove(stream.path)
+                retry_queue.done()
+                semaphore.release()
+
+        futures = []
+        # the retry queue is closed first so the readers stop waiting for retries if the shard fails, the slots
+        # the shard still holds in the rate limiter are freed last
+        with domain_schedule or contextlib.nullcontext(), reader_pool, retry_queue:
+            for download_key, downloaded, yt_meta_dict, download_error, cache_hit in reader_pool.imap_unordered(
+                read,
+                loader,
+            ):
+                download_bytes = sum(stream_size(stream) for stream in downloaded.values())
+                bytes_downloaded += download_bytes
+                download_time = time.perf_counter() - submit_times.pop(download_key)
+                # samples read from the download cache show up as their own stage
+                stage_stats.add("download_cache" if cache_hit else "download", download_time, bytes_out=download_bytes)
+                url = shard_to_dl[download_key - start][1][url_indice]
+                if domain_schedule is not None:
+                    domain_schedule.done(url, None if cache_hit else download_time, download_error, download_bytes)
+                if download_error is not None and retry_queue.retry(download_key, url, download_error):
+                    print(f"retrying sample {download_key} after error: {download_error}")
+                    semaphore.release()
+                    continue
+                if subsampling_pool is None:
+                    process_download(download_key, downloaded, yt_meta_dict, download_error, download_bytes)
+                else:
+                    futures.append(
+                        subsampling_pool.submit(
+                            process_download, download_key, downloaded, yt_meta_dict, download_error, download_bytes
                         )
-                        else self.noop_subsampler
                     )
-                    subsampled_streams, metas, error_message = broadcast_subsampler(streams, meta)
-
-                    for modality in subsampled_streams:
-                        for modality_subsampler in self.subsamplers[modality]:
-                            subsampled_streams, metas, error_message = modality_subsampler(subsampled_streams, metas)
-
-                    if error_message is not None:
-                        meta["clips"] = []
-                        raise ValueError("failed_to_subsample")
-
-                    successes += 1
-                    status = "success"
-                    status_dict.increment(status)
-                    subsampled_streams_list = [
-                        dict(zip(subsampled_streams, s)) for s in zip(*subsampled_streams.values())
-                    ]
-                    for subsampled_streams, meta in zip(subsampled_streams_list, metas):
-                        meta["status"] = status
-
-                        text_caption = sample_data[caption_indice] if caption_indice is not None else None
-                        if self.config["storage"]["captions_are_subtitles"]:
-                            text_caption = meta.get("clip_subtitles")[0]["lines"]
-
-                        sample_writer.write(
-                            subsampled_streams,
-                            meta["key"],
-                            text_caption,
-                            meta,
-                        )
-                except Exception as err:  # pylint: disable=broad-except
-                    status = str(err)
-                    if status.startswith("failed_to_"):
-                        failed[status] += 1
-                        status_dict.increment(error_message)
-                        meta["status"] = status
-                        meta["error_message"] = error_message
-                        sample_writer.write(
-                            {},
-                            str_key,
-                            sample_data[caption_indice] if caption_indice is not None else None,
-                            meta,
-                        )
-                        semaphore.release()
-                    else:
-                        traceback.print_exc()
-                        print(f"Sample {key} failed to download: {err}")
-
-                semaphore.release()
+            for future in futures:
+                future.result()
 
             sample_writer.close()
-            thread_pool.terminate()
-            thread_pool.join()
-            del thread_pool
+            reader_pool.terminate()
+            reader_pool.join()
+            del reader_pool
+            if subsampling_pool is not None:
+                subsampling_pool.shutdown()
 
         end_time = time.time()
         write_stats(
-            self.output_folder,
-            shard_id,
+            output_folder,
+            shard_name,
             count,
             successes,
             failed["failed_to_download"],
@@ -299,5 +593,6 @@ class DownloadWorker:
             end_time,
             status_dict,
             self.config["storage"]["oom_shard_count"],
+            stage_stats,
+            domain_schedule.dump() if domain_schedule is not None else None,
         )
-        fs.rm(shard_path)
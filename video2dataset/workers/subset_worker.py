@@ -1,4 +1,5 @@
 """creates a subset of an existing dataset inside the sample dimension"""
+from contextlib import ExitStack
 from dataclasses import dataclass, field
 import time
 import json
@@ -11,15 +12,17 @@ import webdataset as wds
 from typing import List, Any, Optional, Literal, cast
 
 from video2dataset.dataloader import get_video_dataset
-from video2dataset.logger import CappedCounter, write_stats
+from video2dataset.logger import CappedCounter, StageStats, write_stats
 from video2dataset.subsamplers import (
     ClippingSubsampler,
     CutDetectionSubsampler,
     FrameSubsampler,
     FFProbeSubsampler,
+    FusedSubsampler,
     NoOpSubsampler,
     ResolutionSubsampler,
     AudioRateSubsampler,
+    split_fusable,
 )
 from video2dataset.v2d_types import EncodeFormats, Streams
 
@@ -60,6 +63,16 @@ def get_subsamplers(config: dict, encode_formats: EncodeFormats):
     if "AudioRateSubsampler" in config["subsampling"]:
         audio_subsamplers.append(AudioRateSubsampler(**config["subsampling"]["AudioRateSubsampler"]["args"]))
 
+    # decode and encode once for clipping + resizing + fps subsampling
+    if "FusedSubsampler" in config["subsampling"]:
+        fused_video_subsamplers, video_subsamplers = split_fusable(video_subsamplers)
+        if fused_video_subsamplers:
+            broadcast_subsampler = FusedSubsampler(
+                broadcast_subsampler,
+                fused_video_subsamplers,
+                fused_video_subsamplers[0].encode_formats,
+            )
+
     modal_subsamplers = {"video": video_subsamplers, "audio": audio_subsamplers}
 
     return ffprobe_subsampler, modal_subsamplers, cut_detection_subsampler, cuts_are_clips, broadcast_subsampler
@@ -70,6 +83,7 @@ class ShardStatus:
     successes: int = 0
     failed_to_subsample: int = 0
     status_dict: CappedCounter = field(default_factory=CappedCounter)
+    stage_stats: StageStats = field(default_factory=StageStats)
     error_message: Optional[str] = None
     count: int = 0
 
@@ -98,16 +112,24 @@ class SubsetWorker:
         # set encoding formats
         self.input_encode_formats = encode_formats
         self.output_encode_formats = self.input_encode_formats.copy()
+        if isinstance(self.broadcast_subsampler, FusedSubsampler):
+            self.output_encode_formats["video"] = self.broadcast_subsampler.encode_formats["video"]
         if self.modal_subsamplers["audio"]:
             assert (
-                len({s.encode_format for s in self.modal_subsamplers["audio"]}) == 1
+                len({s.encode_formats["audio"] for s in self.modal_subsamplers["audio"]}) == 1
             )  # assert that all audio subsamplers have the same output format
-            self.output_encode_formats["audio"] = self.modal_subsamplers["audio"][0].encode_format
+            self.output_encode_formats["audio"] = self.modal_subsamplers["audio"][0].encode_formats["audio"]
         if self.modal_subsamplers["video"]:
             assert (
-                len({s.encode_format for s in self.modal_subsamplers["video"]}) == 1
+                len({s.encode_formats["video"] for s in self.modal_subsamplers["video"]}) == 1
             )  # assert that all video subsamplers have the same output format
-            self.output_encode_formats["video"] = self.modal_subsamplers["video"][0].encode_format
+            self.output_encode_formats["video"] = self.modal_subsamplers["video"][0].encode_formats["video"]
+
+        # when clipping is the only subsampling after the broadcast, each clip is written as soon as it's read
+        # instead of holding all the clips of the video in memory
+        self.write_clips_incrementally = isinstance(self.broadcast_subsampler, ClippingSubsampler) and not any(
+            self.modal_subsamplers.values()
+        )
 
     def __call__(
         self,
@@ -168,8 +190,9 @@ class SubsetWorker:
         start_time = time.time()
         shard_sample_writer, shard_dataloader = self.get_shard_processors(shard, shard_id)
         shard_status = ShardStatus()
+        stage_stats = shard_status.stage_stats
 
-        for sample in shard_dataloader:
+        for sample in stage_stats.iterate("read", shard_dataloader):
             shard_status.count += 1
             key = sample["__key__"]
             try:
@@ -180,6 +203,7 @@ class SubsetWorker:
                 print(f"Sample {key} failed to download: {err}")
                 return
 
+            clip_stack = ExitStack()
             try:
                 streams: Streams = {}
                 for modality, encode_format in self.input_encode_formats.items():
@@ -187,58 +211,89 @@ class SubsetWorker:
                     streams[modality] = [sample[encode_format]]
 
                 if self.ffprobe_subsampler is not None:
-                    streams, meta, shard_status.error_message = self.ffprobe_subsampler(streams, meta)
+                    streams, meta, shard_status.error_message = stage_stats.run(
+                        "FFProbeSubsampler", self.ffprobe_subsampler, streams, meta
+                    )
                     assert shard_status.error_message is None
 
                 if self.config["storage"]["captions_are_subtitles"]:  # create clips
                     subtitles = meta["yt_meta_dict"]["subtitles"]
                     meta["clips"] = [[line_dict["start"], line_dict["end"]] for line_dict in subtitles]
                 elif self.cut_detection_subsampler is not None:  # apply cut detection to get clips
-                    streams, cuts, shard_status.error_message = self.cut_detection_subsampler(streams)
+                    streams, cuts, shard_status.error_message = stage_stats.run(
+                        "CutDetectionSubsampler", self.cut_detection_subsampler, streams
+                    )
                     assert shard_status.error_message is None
                     meta["cuts"] = cuts
                     assert cuts is not None
                     if self.cuts_are_clips:
                         meta["clips"] = (np.array(cuts["cuts_original_fps"]) / cuts["original_fps"]).tolist()
 
-                # 1 video -> many videos (either clipping or noop which does identity broadcasting)
-                subsampled_streams, metas, shard_status.error_message = self.broadcast_subsampler(streams, meta)
-                if shard_status.error_message is not None:
-                    meta["clips"] = []
-                    assert False
-
-                for modality in list(subsampled_streams.keys()):
-                    for modality_subsampler in self.modal_subsamplers[modality]:
-                        subsampled_streams, metas, shard_status.error_message = modality_subsampler(
-                            subsampled_streams, metas
+                if self.write_clips_incrementally:
+                    try:
+                        with stage_stats.time("ClippingSubsampler"):
+                            subsampled_clips = clip_stack.enter_context(
+                                self.broadcast_subsampler.clip_files(streams, meta)
+                            )
+                    except Exception as err:  # pylint: disable=broad-except
+                        shard_status.error_message = str(err)
+                        meta["clips"] = []
+                        raise
+                else:
+                    # 1 video -> many videos (either clipping or noop which does identity broadcasting)
+                    subsampled_streams, metas, shard_status.error_message = stage_stats.run(
+                        type(self.broadcast_subsampler).__name__, self.broadcast_subsampler, streams, meta
+                    )
+                    if shard_status.error_message is not None:
+                        meta["clips"] = []
+                        assert False
+
+                    for modality in list(subsampled_streams.keys()):
+                        for modality_subsampler in self.modal_subsamplers[modality]:
+                            subsampled_streams, metas, shard_status.error_message = stage_stats.run(
+                                type(modality_subsampler).__name__, modality_subsampler, subsampled_streams, metas
+                            )
+                            assert shard_status.error_message is None
+
+                    subsampled_streams_list = [
+                        dict(zip(subsampled_streams, s)) for s in zip(*subsampled_streams.values())
+                    ]
+                    if len(subsampled_streams_list) == 0:  # no audio or video, just write meta
+                        shard_status.successes += 1
+                        shard_status.status_dict.increment("success")
+                        meta["status"] = "success"
+                        shard_sample_writer.write(
+                            {},
+                            key,
+                            caption,
+                            meta,
                         )
-                        assert shard_status.error_message is None
+                        continue
+                    subsampled_clips = list(zip(subsampled_streams_list, metas))
 
-                shard_status.successes += 1
                 status = "success"
-                shard_status.status_dict.increment(status)
-
-                subsampled_streams_list = [dict(zip(subsampled_streams, s)) for s in zip(*subsampled_streams.values())]
-                if len(subsampled_streams_list) == 0:  # no audio or video, just write meta
-                    meta["status"] = status
-                    shard_sample_writer.write(
-                        {},
-                        key,
-                        caption,
-                        meta,
-                    )
-                    continue
-                for subsampled_streams, meta in zip(subsampled_streams_list, metas):
-                    meta["status"] = status
+                # every clip is cut and captioned before the first one is written so that a failing sample
+                # doesn't leave some of its clips in the shard, the cut clips are read one at a time
+                text_captions = []
+                for _, clip_meta in subsampled_clips:
+                    clip_meta["status"] = status
                     text_caption = caption
                     if self.config["storage"]["captions_are_subtitles"]:
-                        text_caption = meta.get("clip_subtitles")[0]["lines"][0]
-                    shard_sample_writer.write(
-                        subsampled_streams,
-                        meta["key"],
-                        text_caption,
-                        meta,
-                    )
+                        text_caption = clip_meta.get("clip_subtitles")[0]["lines"][0]
+                    text_captions.append(text_caption)
+
+                for (subsampled_streams, clip_meta), text_caption in zip(subsampled_clips, text_captions):
+                    if self.write_clips_incrementally:
+                        subsampled_streams = self.broadcast_subsampler.read_clip(subsampled_streams)
+                    with stage_stats.time("write"):
+                        shard_sample_writer.write(
+                            subsampled_streams,
+                            clip_meta["key"],
+                            text_caption,
+                            clip_meta,
+                        )
+                shard_status.successes += 1
+                shard_status.status_dict.increment(status)
             except Exception:  # pylint: disable=broad-except
                 shard_status.failed_to_subsample += 1
                 shard_status.status_dict.increment(shard_status.error_message)
@@ -250,6 +305,8 @@ class SubsetWorker:
                     caption,
                     meta,
                 )
+            finally:
+                clip_stack.close()
 
         shard_sample_writer.close()
         end_time = time.time()
@@ -266,4 +323,5 @@ class SubsetWorker:
             end_time,
             shard_status.status_dict,
             self.config["storage"]["oom_shard_count"],
+            stage_stats,
         )
@@ -13,6 +13,7 @@ from multiprocessing.pool import ThreadPool
 from threading import Semaphore
 
 from video2dataset.data_reader import VideoDataReader
+from video2dataset.input_sharder import read_shard
 from video2dataset.logger import CappedCounter, write_stats
 from video2dataset.subsamplers import WhisperSubsampler
 from video2dataset.dataloader import get_video_dataset
@@ -114,9 +115,7 @@ class WhisperWorker:
                 schema = pa.schema(fields)
             semaphore = None
         else:
-            fs, shard_path = fsspec.core.url_to_fs(shard)
-            with fs.open(shard_path, "rb") as f:
-                df = pa.ipc.open_file(f).read_all()
+            df = read_shard(shard)
             schema = df.schema
             schema = (
                 schema.append(pa.field("key", pa.string()))